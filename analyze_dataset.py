@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+from cache_store import Revalidation
+from checkpoint import Checkpoint, checkpoint_chunk_size
 from data_tool import DataTool
 from pikmin_decor_predictor import PikminDecorPredictor
 import argparse
@@ -19,13 +21,36 @@ def cli_to_args():
     cli.add_argument('-pull_latest_data',
                      default=False, action="store_true",
                      help='Pulls latest data instead of using an input file. Either this, or input_file is required.')
+    cli.add_argument('-enriched_input_file',
+                     type=str, default=None,
+                     help='Enriched dataset written by a previous run (see -enriched_output_file). When given, the \
+                     data sources and caches are skipped and predictions run straight on this file. Foursquare, \
+                     Google Places and Yelp are only scored when their API key is given, but they aren\'t queried.')
     cli.add_argument('-output_file',
                      type=str, default='output/output.csv',
                      help='Output file, a CSV that stores the predictions from data sources like OSM.')
+    cli.add_argument('-enriched_output_file',
+                     type=str, default='output/enriched.parquet',
+                     help='Output file for the enriched dataset, a compressed binary file that can be passed to \
+                     -enriched_input_file to run predictions again without querying any data source.')
 
     cli.add_argument('-email',
                      type=str,
                      help='Email for Nominatim, required to convert location data to GPS.')
+    cli.add_argument('-geocoder_url',
+                     type=str, default=None,
+                     help='Optional URL of a self-hosted Nominatim instance, IE http://localhost:8080. When given, \
+                     locations are geocoded through it with several requests at once, instead of through the public \
+                     Nominatim at one request every 1.5 seconds.')
+    cli.add_argument('-gazetteer',
+                     type=str, default=None,
+                     help='Optional path to a GeoNames dump (IE cities500.txt), with admin1CodesASCII.txt and \
+                     countryInfo.txt next to it. When given, locations are looked up in it first, and only the ones \
+                     it doesn\'t have are geocoded through Nominatim.')
+    cli.add_argument('-osm_extract',
+                     type=str, default=None,
+                     help='Optional path to a local OpenStreetMap extract (.osm.pbf or .osm). When given, OSM data is \
+                     read from an index built from this file instead of querying Overpass.')
     cli.add_argument('-foursquare_api_key',
                      type=str, default=None,
                      help='Required to enable foursquare data. Requires a Foursquare developer account to generate. \
@@ -41,7 +66,44 @@ def cli_to_args():
 
     cli.add_argument('-invalidate_caches',
                      default=False, action="store_true",
-                     help='Add this flag to invalidate caches and run predictions from scratch.')
+                     help='Add this flag to invalidate caches and run predictions from scratch. The rate limits and \
+                     the quotas used today are kept.')
+    cli.add_argument('-revalidate',
+                     default=False, action="store_true",
+                     help='Add this flag to query expired cache entries again, instead of invalidating every cache. \
+                     Use -positive_ttl_days and -negative_ttl_days to decide what is expired.')
+    cli.add_argument('-positive_ttl_days',
+                     type=float, default=None,
+                     help='When revalidating, how many days a cached match is kept before being queried again. \
+                     Matches never expire if this is not given.')
+    cli.add_argument('-negative_ttl_days',
+                     type=float, default=0,
+                     help='When revalidating, how many days a cached "no match" result is kept before being queried \
+                     again. Defaults to 0, which queries every "no match" result again.')
+    cli.add_argument('-revalidate_providers',
+                     nargs='+', default=None,
+                     choices=["location", "osm", "foursquare", "google_places", "yelp"],
+                     help='When revalidating, only revalidate these caches. Defaults to all of them.')
+    cli.add_argument('-revalidate_regions',
+                     nargs='+', default=None,
+                     help='When revalidating, only revalidate rows in these regions, given as the end of a \
+                     "Suburb, State, Country" string, IE "Australia" or "Western Australia, Australia".')
+    cli.add_argument('-resume',
+                     default=False, action="store_true",
+                     help='Add this flag to resume an interrupted run from its checkpoint, on the same dataset it \
+                     started with. -input_file and -pull_latest_data are ignored when resuming.')
+    cli.add_argument('-checkpoint_file',
+                     type=str, default='output/checkpoint.sqlite',
+                     help='Where the progress of the run is recorded, so it can be resumed with -resume.')
+    cli.add_argument('-checkpoint_rows',
+                     type=int, default=checkpoint_chunk_size,
+                     help='About how many rows each data source works through before its progress is saved. Rows of \
+                     the same location are never split, and geocoding saves its progress once it is done. Smaller \
+                     values lose less work when a run is interrupted, larger ones batch the queries better.')
+    cli.add_argument('-batch_scoring',
+                     default=False, action="store_true",
+                     help='Add this flag to score the whole dataset at once with sparse matrices, instead of row by \
+                     row. Much faster on large datasets, but skips the per row debug output.')
     cli.add_argument('-debug',
                      default=False, action="store_true",
                      help='Add this flag to print extra debug info.')
@@ -49,7 +111,7 @@ def cli_to_args():
 
 
 def validate_args(args):
-    if args.input_file or args.pull_latest_data:
+    if args.input_file or args.pull_latest_data or args.enriched_input_file or args.resume:
         print(f"Running on a dataset...")
         return
     else:
@@ -63,7 +125,10 @@ if __name__ == '__main__':
     decor_predictor = PikminDecorPredictor(osm_email=args.email,
                                            foursquare_key=args.foursquare_api_key,
                                            google_places_key=args.google_places_api_key,
-                                           yelp_key=args.yelp_api_key)
+                                           yelp_key=args.yelp_api_key,
+                                           osm_extract=args.osm_extract,
+                                           geocoder_url=args.geocoder_url,
+                                           gazetteer_path=args.gazetteer)
 
     data_tool = DataTool()
     data_tool.generate_directories()
@@ -72,29 +137,65 @@ if __name__ == '__main__':
     # as most of these APIs only allow _x_ calls per day, and rerunning calls each time the script runs
     # would push you over their thresholds.
     if args.invalidate_caches:
-        print("WARNING: Removing all caches for foursquare, yelp, osm locations, and google places.")
+        print("WARNING: Removing all caches for foursquare, yelp, osm locations, osm data, and google places. "
+              "Rate limits and quotas used today are kept.")
         data_tool.invalidate_caches()
 
-    if args.pull_latest_data:
-        data = data_tool.pull_latest_data()
+    if args.enriched_input_file:
+        # a previous run already filled in the data, so skip straight to the predictions.
+        data = data_tool.load_enriched(args.enriched_input_file)
+        if data is None:
+            raise Exception("Invalid path to enriched data, check if your enriched input file exists.")
+        # the API data sources are only scored when their key is given, say so when the file has data for them
+        for column, key in [("Foursquare Data", args.foursquare_api_key),
+                            ("Google Places Data", args.google_places_api_key),
+                            ("Yelp Data", args.yelp_api_key)]:
+            if key is None and column in data.columns and data[column].notna().any():
+                print(f"NOTE: {column} is in the enriched file but its API key wasn't given, so it isn't scored.")
     else:
-        data = data_tool.load_csv(args.input_file)
-    if data is None:
-        raise Exception("Invalid path to input data, check if your input file exists.")
-
-    # this uses OSM to convert the suburb, city, country fields to an OSM Location, then this location is used
-    # to query whatever datasets are enabled.
-    data = decor_predictor.fill_in_data(data, debug_mode=args.debug)
-
-    # save the dataframe to file
-    data_tool.output_to_file(data, args.output_file)
+        checkpoint = Checkpoint(args.checkpoint_file, chunk_rows=args.checkpoint_rows)
+        if args.resume:
+            # continue on the dataset the interrupted run started with, rows it finished are skipped.
+            data = checkpoint.dataset()
+            if data is None:
+                raise Exception("Nothing to resume, check if your checkpoint file exists.")
+        else:
+            if args.pull_latest_data:
+                data = data_tool.pull_latest_data()
+            else:
+                data = data_tool.load_csv(args.input_file)
+            if data is None:
+                raise Exception("Invalid path to input data, check if your input file exists.")
+            checkpoint.start(data)
+
+        # this uses OSM to convert the suburb, city, country fields to an OSM Location, then this location is used
+        # to query whatever datasets are enabled.
+        revalidation = None
+        if args.revalidate:
+            revalidation = Revalidation(
+                positive_ttl=args.positive_ttl_days * 86400 if args.positive_ttl_days is not None else None,
+                negative_ttl=args.negative_ttl_days * 86400 if args.negative_ttl_days is not None else None,
+                providers=args.revalidate_providers,
+                regions=args.revalidate_regions)
+        data = decor_predictor.fill_in_data(data,
+                                            debug_mode=args.debug,
+                                            revalidation=revalidation,
+                                            checkpoint=checkpoint)
+
+        # save the dataframe to file, once as CSV to read, and once in the enriched format to run from later.
+        data_tool.output_to_file(data, args.output_file)
+        if args.enriched_output_file:
+            data_tool.output_enriched(data, args.enriched_output_file)
 
     # prepare the data for running predictions on it. This includes splitting the dataset,
     # and removing rows based on the dataset rule.
     decors_ground_truth, data = data_tool.prepare_dataset_for_predictions(data)
 
     # run through the data points and create a prediction for each, output as a dataframe
-    predictions = decor_predictor.predict_dataset(data, decors_ground_truth, debug_mode=args.debug)
+    predictions = decor_predictor.predict_dataset(data,
+                                                  decors_ground_truth,
+                                                  debug_mode=args.debug,
+                                                  batch_mode=args.batch_scoring)
 
     data_tool.analyze_data(data, predictions, decors_ground_truth)
 
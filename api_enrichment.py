@@ -0,0 +1,47 @@
+def fill_in_api_column(data, provider, cache, create_row_key, fill_in_row, transport, column, compact,
+                       revalidation=None):
+    # Shared fill_in_data of the API data sources. Every uncached row is collected first, once per row key, so the
+    # queries can run concurrently through the data source's shared transport. fill_in_row(row_key, row) queries a
+    # row and stores the full response in cache under row_key. When revalidating, expired entries are queried again
+    # as if they weren't cached. column is then filled in with compact(response), or None for rows without a match.
+    # Rows that fail are reported and skipped rather than stopping the others.
+    if revalidation:
+        refresh = revalidation.stale_keys(provider,
+                                          cache,
+                                          ((create_row_key(row), row) for index, row in data.iterrows()))
+    else:
+        refresh = set()
+    pending = {}
+    for index, row in data.iterrows():
+        row_key = create_row_key(row)
+        if (row_key not in cache or row_key in refresh) and row_key not in pending:
+            pending[row_key] = row
+    errors = {}
+
+    def fill_in(item):
+        # a failing row, IE once the daily quota is used up, is left out of the cache so a later run queries it
+        # again, and the rest of the rows go on
+        try:
+            fill_in_row(item[0], item[1])
+        except Exception as e:
+            errors[item[0]] = e
+    transport.run_concurrently(fill_in, pending.items())
+    if len(errors) > 0:
+        first_error = next(iter(errors.values()))
+        print(f"WARNING: {provider} failed for {len(errors)} of {len(pending)} locations, IE "
+              f"{type(first_error).__name__}: {first_error}. They aren't cached, so a later run queries them again.")
+
+    # the cache keeps the full response, the dataset only keeps the fields the predictors use. Rows that failed
+    # without an older cached response are None, and listed in data.attrs["skipped_rows"] so they aren't recorded
+    # as done.
+    payloads = []
+    skipped_rows = []
+    for index, row in data.iterrows():
+        row_key = create_row_key(row)
+        response = cache.get(row_key)
+        if row_key in errors and row_key not in cache:
+            skipped_rows.append(index)
+        payloads.append(compact(response) if response else None)
+    data[column] = payloads
+    data.attrs["skipped_rows"] = skipped_rows
+    return data
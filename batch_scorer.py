@@ -0,0 +1,139 @@
+from datetime import datetime
+from dataset import Dataset
+from decor_type import DecorType
+from decor_to_tag_mapping import foursquare_tags_to_decors, google_places_tags_to_decors, yelp_tags_to_decors
+from osm_tool import osm_tags_to_rules
+from scipy import sparse
+import numpy as np
+import pandas as pd
+
+
+class BatchScorer:
+    # Scores a whole enriched dataset at once. Every row's provider data is encoded as a sparse row of features
+    # (OSM tags, Foursquare categories, Google Places types, Yelp aliases), the decor mappings are encoded as a
+    # sparse feature -> rule matrix, and one matrix product gives every rule that fires for every row. Rule columns
+    # are laid out in the order the row-wise predictors emit their predictions, so the predictions, and the tag
+    # usage counts built from them, match PikminDecorPredictor.predict_row exactly.
+    #
+    # The OSM date rules only compare the seedling date to the burger shop start date, so OSM features are split
+    # into "before" and "after" that date, and each rule's predicate is evaluated once per side.
+    def __init__(self, foursquare_enabled, google_places_enabled, yelp_enabled):
+        self.foursquare_enabled = foursquare_enabled
+        self.google_places_enabled = google_places_enabled
+        self.yelp_enabled = yelp_enabled
+        self.burger_shop_start_date = datetime.strptime("12/18/2021", '%m/%d/%Y')
+
+    def score(self, data, truth):
+        features = {}
+        feature_rules = []
+        rules = {}
+        x_rows = []
+        x_columns = []
+
+        # only the rows' dates matter for the OSM date rules, so compare them all at once
+        before_burger_shop = (pd.to_datetime(data["Date"], format='%m/%d/%Y') < self.burger_shop_start_date).tolist()
+
+        row_columns = zip(data["OSM Data"].tolist(),
+                          data["Foursquare Data"].tolist(),
+                          data["Google Places Data"].tolist(),
+                          data["Yelp Data"].tolist(),
+                          before_burger_shop)
+        for i, (osm_data, foursquare_data, google_places_data, yelp_data, before) in enumerate(row_columns):
+            for feature in self.__row_features(osm_data, foursquare_data, google_places_data, yelp_data, before):
+                if feature not in features:
+                    features[feature] = len(features)
+                    feature_rules.append(self.__feature_rules(feature, rules))
+                x_rows.append(i)
+                x_columns.append(features[feature])
+
+        # lay the rule columns out in prediction order
+        rule_keys = sorted(rules)
+        rule_columns = {rule_key: column for column, rule_key in enumerate(rule_keys)}
+        m_rows = []
+        m_columns = []
+        for feature_index, feature_rule_keys in enumerate(feature_rules):
+            for rule_key in feature_rule_keys:
+                m_rows.append(feature_index)
+                m_columns.append(rule_columns[rule_key])
+
+        row_count = len(data.index)
+        x = sparse.csr_matrix((np.ones(len(x_rows)), (x_rows, x_columns)), shape=(row_count, len(features)))
+        m = sparse.csr_matrix((np.ones(len(m_rows)), (m_rows, m_columns)), shape=(len(features), len(rule_keys)))
+        fired = (x @ m).tocsr()
+        fired.sort_indices()
+
+        decor_predictions = []
+        usage_dict = {Dataset.osm: {},
+                      Dataset.foursquare: {},
+                      Dataset.google_places: {},
+                      Dataset.yelp: {}}
+        for i, row_truth in enumerate(truth):
+            predictions = []
+            groups = set()
+            for column in fired.indices[fired.indptr[i]:fired.indptr[i + 1]]:
+                decor_type, dataset, label, group = rules[rule_keys[column]]
+                # Yelp and Google Places only use the first listed tag of each decor
+                if group is not None:
+                    if group in groups:
+                        continue
+                    groups.add(group)
+                predictions.append((decor_type, dataset, label))
+
+            if len(predictions) > 0:
+                prediction_index = 0
+                for x_index, (decor_type, dataset, label) in enumerate(predictions):
+                    if decor_type == row_truth:
+                        prediction_index = x_index
+                        usage_dict[dataset][label] = usage_dict[dataset].get(label, 0) + 1
+                decor_predictions.append(predictions[prediction_index][0])
+            else:
+                decor_predictions.append(DecorType.roadside)
+        return decor_predictions, usage_dict
+
+    def __row_features(self, osm_data, foursquare_data, google_places_data, yelp_data, before):
+        if osm_data:
+            for key, value in (osm_data.tags() or {}).items():
+                yield Dataset.osm, key, value, before
+        if foursquare_data and self.foursquare_enabled:
+            if "categories" in foursquare_data:
+                for position, category in enumerate(foursquare_data["categories"]):
+                    if "name" in category:
+                        yield Dataset.foursquare, position, category["name"]
+        if google_places_data and self.google_places_enabled:
+            if "types" in google_places_data:
+                for google_places_type in google_places_data["types"]:
+                    yield Dataset.google_places, google_places_type
+        if yelp_data and self.yelp_enabled:
+            if "categories" in yelp_data:
+                for category in yelp_data["categories"]:
+                    if "alias" in category:
+                        yield Dataset.yelp, category["alias"]
+
+    def __feature_rules(self, feature, rules):
+        # returns the keys of the rules a feature fires, registering each rule as (decor, dataset, label, group).
+        # Rule keys sort in prediction order: by data source, then in the order that source's predictor emits them.
+        rule_keys = []
+        if feature[0] == Dataset.osm:
+            dataset, key, value, before = feature
+            # any date on the right side of the burger shop start date gives the same predicate results
+            seedling_date, burger_shop_start_date = (0, 1) if before else (1, 1)
+            for order, decor_type, label, predicate in osm_tags_to_rules.get((key, value), ()):
+                if predicate is None or predicate(seedling_date, burger_shop_start_date):
+                    rule_keys.append((0, order))
+                    rules[(0, order)] = (decor_type, Dataset.osm, label, None)
+        elif feature[0] == Dataset.foursquare:
+            dataset, position, name = feature
+            for decor_order, tag_order, decor_type in foursquare_tags_to_decors.get(name, ()):
+                rule_keys.append((1, position, decor_order, name))
+                rules[(1, position, decor_order, name)] = (decor_type, Dataset.foursquare, name, None)
+        elif feature[0] == Dataset.google_places:
+            dataset, tag = feature
+            for decor_order, tag_order, decor_type in google_places_tags_to_decors.get(tag, ()):
+                rule_keys.append((2, decor_order, tag_order))
+                rules[(2, decor_order, tag_order)] = (decor_type, Dataset.google_places, tag, (2, decor_order))
+        else:
+            dataset, tag = feature
+            for decor_order, tag_order, decor_type in yelp_tags_to_decors.get(tag, ()):
+                rule_keys.append((3, decor_order, tag_order))
+                rules[(3, decor_order, tag_order)] = (decor_type, Dataset.yelp, tag, (3, decor_order))
+        return rule_keys
@@ -0,0 +1,135 @@
+import os.path
+import pickle
+import sqlite3
+import threading
+import time
+
+
+class CacheStore:
+    # Persistent key/value cache backed by SQLite in WAL mode. Entries are written as soon as they are set and read
+    # on demand, so a crash only loses the query in flight, large caches open instantly, and any number of threads
+    # or processes can read while one writes. Keys are strings (or tuples, stored by their repr) and values are
+    # pickled, so anything the old pickle caches held can be stored as is. It supports the dict operations the
+    # tools use on their caches: in, [], []=, get and len. Every entry also records when it was fetched, see entry().
+    def __init__(self, path, legacy_pickle=None):
+        self.path = path
+        self.legacy_pickle = legacy_pickle
+        self.local = threading.local()
+        self.setup_lock = threading.Lock()
+
+    def __contains__(self, key):
+        return self.__connection().execute("SELECT 1 FROM cache WHERE key = ?",
+                                           (self.__key(key),)).fetchone() is not None
+
+    def __getitem__(self, key):
+        row = self.__connection().execute("SELECT value FROM cache WHERE key = ?", (self.__key(key),)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def __setitem__(self, key, value):
+        self.__connection().execute("INSERT OR REPLACE INTO cache (key, value, fetched_at) VALUES (?, ?, ?)",
+                                    (self.__key(key), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),
+                                     time.time()))
+
+    def __len__(self):
+        return self.__connection().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def entry(self, key):
+        # returns (value, fetched_at) for a cached key, or None if it isn't cached. fetched_at is None for
+        # entries that were cached before fetch times were recorded.
+        row = self.__connection().execute("SELECT value, fetched_at FROM cache WHERE key = ?",
+                                          (self.__key(key),)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0]), row[1]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __key(self, key):
+        return key if isinstance(key, str) else repr(key)
+
+    def __connection(self):
+        # sqlite connections can't be shared between threads, so each thread opens its own. The connection is only
+        # opened on first use, so invalidating the cache directory before a run is still safe.
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            with self.setup_lock:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                is_new = not os.path.exists(self.path)
+                connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, fetched_at REAL)")
+                columns = [column[1] for column in connection.execute("PRAGMA table_info(cache)")]
+                if "fetched_at" not in columns:
+                    connection.execute("ALTER TABLE cache ADD COLUMN fetched_at REAL")
+                if is_new:
+                    self.__import_legacy_pickle(connection)
+            self.local.connection = connection
+        return connection
+
+    def __import_legacy_pickle(self, connection):
+        # carry over the whole-file pickle cache from older versions, so existing caches aren't queried again
+        if self.legacy_pickle is None or not os.path.exists(self.legacy_pickle):
+            return
+        with open(self.legacy_pickle, 'rb') as handle:
+            legacy_dict = pickle.load(handle)
+        print(f"Importing {len(legacy_dict)} entries from {self.legacy_pickle} into {self.path}")
+        # the pickle was last written at the end of the run that fetched its newest entries
+        fetched_at = os.path.getmtime(self.legacy_pickle)
+        connection.execute("BEGIN")
+        connection.executemany("INSERT OR REPLACE INTO cache (key, value, fetched_at) VALUES (?, ?, ?)",
+                               [(self.__key(key), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), fetched_at)
+                                for key, value in legacy_dict.items()])
+        connection.execute("COMMIT")
+
+
+class Revalidation:
+    # Picks which cached entries a revalidation run queries again. An entry is expired once it is older than its
+    # TTL (in seconds), and negative results (None, IE nothing was found) have their own TTL, so they can be retried
+    # much sooner than real matches. A TTL of None never expires, and a negative TTL of 0 retries every negative
+    # result. The run can be limited to some data sources (IE "foursquare", "location") and to regions, given as the
+    # trailing parts of a "Suburb, State, Country" key, IE "Australia" or "Western Australia, Australia".
+    def __init__(self, positive_ttl=None, negative_ttl=0, providers=None, regions=None):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.providers = set(providers) if providers else None
+        self.regions = [self.__split_region(region) for region in regions] if regions else None
+
+    def stale_keys(self, provider, cache, keyed_rows):
+        # keyed_rows is an iterable of (cache key, row). Returns the set of cached keys to query again.
+        stale = set()
+        if self.providers is not None and provider not in self.providers:
+            return stale
+        now = time.time()
+        for key, row in keyed_rows:
+            if key in stale or not self.in_region(row):
+                continue
+            entry = cache.entry(key)
+            if entry is not None and self.is_expired(entry[0], entry[1], now):
+                stale.add(key)
+        if len(stale) > 0:
+            print(f"Revalidating {len(stale)} cached {provider} entries.")
+        return stale
+
+    def is_expired(self, value, fetched_at, now):
+        ttl = self.positive_ttl if value else self.negative_ttl
+        if ttl is None:
+            return False
+        if fetched_at is None:
+            # unknown age, so it is as old as it gets
+            return True
+        return now - fetched_at >= ttl
+
+    def in_region(self, row):
+        if self.regions is None:
+            return True
+        row_region = self.__split_region(f"{row['Suburb']}, {row['State']}, {row['Country']}")
+        return any(row_region[-len(region):] == region for region in self.regions)
+
+    def __split_region(self, region):
+        return [part.strip().lower() for part in str(region).split(",")]
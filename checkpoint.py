@@ -0,0 +1,73 @@
+import os.path
+import pickle
+import sqlite3
+import threading
+import time
+
+# default for about how many rows each data source stage processes between checkpoint markers. Chunks never split
+# the rows of a location, so per suburb batching and deduplication still see every row they would without a
+# checkpoint.
+checkpoint_chunk_size = 1000
+
+
+class Checkpoint:
+    # Records the progress of an enrichment run, so an interrupted run can resume where it stopped. The input
+    # dataset is stored when the run starts, then every stage (IE "location", "osm", "foursquare") fills in its rows
+    # in chunks of about chunk_rows rows, and marks each chunk along with the column values it filled in as soon as
+    # the chunk is done. An interruption loses at most the chunk each stage was working on, and the caches keep every
+    # query regardless, so those rows are answered from cache on resume.
+    def __init__(self, path, chunk_rows=checkpoint_chunk_size):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def start(self, data):
+        # starts a new run on data, dropping the progress of any previous run
+        with self.lock:
+            connection = self.__connection()
+            connection.execute("BEGIN")
+            connection.execute("DELETE FROM markers")
+            connection.execute("DELETE FROM meta")
+            connection.execute("INSERT INTO meta (key, value) VALUES (?, ?)",
+                               ("dataset", pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)))
+            connection.execute("INSERT INTO meta (key, value) VALUES (?, ?)",
+                               ("started_at", pickle.dumps(time.time())))
+            connection.execute("COMMIT")
+
+    def dataset(self):
+        # the dataset the previous run started on, or None if there is nothing to resume
+        if not os.path.exists(self.path):
+            return None
+        with self.lock:
+            row = self.__connection().execute("SELECT value FROM meta WHERE key = 'dataset'").fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def completed(self, stage):
+        # returns {row index: column values} for every row stage has finished. Rows are identified by their index
+        # in the dataset, which is why the dataset itself is stored with the checkpoint.
+        with self.lock:
+            rows = self.__connection().execute("SELECT row_index, value FROM markers WHERE stage = ?",
+                                               (stage,)).fetchall()
+        return {index: pickle.loads(value) for index, value in rows}
+
+    def mark(self, stage, row_values):
+        # row_values maps each finished row index to the column values the stage filled in
+        with self.lock:
+            connection = self.__connection()
+            connection.execute("BEGIN")
+            connection.executemany("INSERT OR REPLACE INTO markers (stage, row_index, value) VALUES (?, ?, ?)",
+                                   [(stage, int(index), pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL))
+                                    for index, values in row_values.items()])
+            connection.execute("COMMIT")
+
+    def __connection(self):
+        # one connection shared by the stage threads, guarded by self.lock
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS markers "
+                                    "(stage TEXT, row_index INTEGER, value BLOB, PRIMARY KEY (stage, row_index))")
+        return self.connection
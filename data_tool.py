@@ -1,9 +1,11 @@
 import pandas as pd
+import json
 import os
 import requests
 from datetime import datetime
-from sklearn.metrics import classification_report, confusion_matrix
 from decor_type import DecorType
+from provider_payloads import save_payloads, load_payloads
+from rate_limit_service import rate_limits_path
 from pathlib import Path
 
 class DataTool:
@@ -21,26 +23,26 @@ class DataTool:
         Path("./output").mkdir(parents=True, exist_ok=True)
 
     def invalidate_caches(self):
+        # the rate limit database (and its -wal and -shm files) is kept, so a reset doesn't forget how much of
+        # today's quotas were used or that a data source asked us to back off
         dir = "./caches"
+        rate_limits_file = os.path.basename(rate_limits_path)
         for f in os.listdir(dir):
-            os.remove(os.path.join(dir, f))
+            if not f.startswith(rate_limits_file):
+                os.remove(os.path.join(dir, f))
 
     def prepare_dataset_for_predictions(self, df):
         df = df.drop_duplicates(subset=["Location", "Decor", "Country", "State", "Suburb"])
-        drop_count = 0
-        for index, row in df.iterrows():
-            # drop cases where theres no OSM data
-            if (row["OSM Data"] is None) \
-                    and (row["Foursquare Data"] is None) \
-                    and (row["Yelp Data"] is None) \
-                    and (row["Google Places Data"] is None):
-                # print(f"DROPPING THIS {location}")
-                df = df.drop(index)
-                drop_count += 1
-            elif row["Location"] == row["Suburb"]:
-                # print(f"Dropping due to matched location and suburb {location}")
-                df = df.drop(index)
-                drop_count += 1
+        # drop cases where theres no data from any data source, and cases where the location
+        # is just the suburb name.
+        no_data = df["OSM Data"].isna() \
+            & df["Foursquare Data"].isna() \
+            & df["Yelp Data"].isna() \
+            & df["Google Places Data"].isna()
+        matched_location_and_suburb = df["Location"] == df["Suburb"]
+        dropped = no_data | matched_location_and_suburb
+        drop_count = int(dropped.sum())
+        df = df[~dropped]
         df = self.filter_by_ground_truth(df, [DecorType.forest, DecorType.park, DecorType.waterside])
         print(f"Total number of samples: {len(df.index)}, total number dropped: {drop_count}")
         decors = df['Decor'].copy()
@@ -84,56 +86,47 @@ class DataTool:
         return None
 
     def filter_by_ground_truth(self, data, tags):
-        for index, row in data.iterrows():
-            for tag in tags:
-                if row["Decor"] == tag:
-                    data = data.drop(index)
-        return data
+        # compare against the plain string values, DecorType members don't hash like the strings they equal
+        return data[~data["Decor"].isin([str(getattr(tag, "value", tag)) for tag in tags])]
 
     def output_to_file(self, df, output_file):
-        # save data frame to disk
+        # save data frame to disk, with the provider payloads written as JSON
+        df = df.copy()
+        for column in ["Foursquare Data", "Google Places Data", "Yelp Data"]:
+            df[column] = [json.dumps(x) if x else None for x in df[column]]
         df.to_csv(output_file, index=False)
 
+    def output_enriched(self, df, enriched_file):
+        # save the enriched data frame in a binary form that load_enriched can read back
+        save_payloads(df, enriched_file)
+
+    def load_enriched(self, enriched_file):
+        if not os.path.exists(enriched_file):
+            return None
+        return load_payloads(enriched_file)
+
     def analyze_data(self, df, predictions, decors_ground_truth):
-        osm_count = 0
-        osm_only_count = 0
+        # imported here since scikit-learn is slow to load and only needed for the final report
+        from sklearn.metrics import classification_report, confusion_matrix
+        has_osm = df["OSM Data"].notna()
+        has_foursquare = df["Foursquare Data"].notna()
+        has_google_places = df["Google Places Data"].notna()
+        has_yelp = df["Yelp Data"].notna()
+
+        osm_count = int(has_osm.sum())
+        osm_only_count = int((has_osm & ~has_foursquare & ~has_google_places & ~has_yelp).sum())
+
+        foursquare_count = int(has_foursquare.sum())
+        foursquare_only_count = int((~has_osm & has_foursquare & ~has_google_places & ~has_yelp).sum())
 
-        foursquare_count = 0
-        foursquare_only_count = 0
+        google_places_count = int(has_google_places.sum())
+        google_places_only_count = int((~has_osm & ~has_foursquare & has_google_places & ~has_yelp).sum())
 
-        google_places_count = 0
-        google_places_only_count = 0
+        yelp_count = int(has_yelp.sum())
+        yelp_only_count = int((~has_osm & ~has_foursquare & ~has_google_places & has_yelp).sum())
 
-        yelp_count = 0
-        yelp_only_count = 0
+        total_count = df.shape[0]
         print("--------------------------------")
-        for index, row in df.iterrows():
-            if row["OSM Data"]:
-                osm_count = osm_count + 1
-            if row["OSM Data"] and not row["Foursquare Data"] \
-                    and not row["Google Places Data"] and not row["Yelp Data"]:
-                osm_only_count = osm_only_count + 1
-
-            if row["Foursquare Data"]:
-                foursquare_count = foursquare_count + 1
-            if not row["OSM Data"] and row["Foursquare Data"] \
-                    and not row["Google Places Data"] and not row["Yelp Data"]:
-                foursquare_only_count = foursquare_only_count + 1
-
-            if row["Google Places Data"]:
-                google_places_count = google_places_count + 1
-            if not row["OSM Data"] and not row["Foursquare Data"] \
-                    and row["Google Places Data"] and not row["Yelp Data"]:
-                #print(f"{row['Location']} is {decors_ground_truth[index]} for {row['Google Places Data']}")
-                google_places_only_count = google_places_only_count + 1
-
-            if row["Yelp Data"]:
-                yelp_count = yelp_count + 1
-            if not row["OSM Data"] and not row["Foursquare Data"] \
-                    and not row["Google Places Data"] and row["Yelp Data"]:
-                yelp_only_count = yelp_only_count + 1
-
-            total_count = df.shape[0]
         print(f"Total Samples:{df.shape[0]} "
               f"\nFoursquare Samples: {foursquare_count} ({round(foursquare_count / total_count * 100.0)}%) "
               f"\nGoogle Places Samples: {google_places_count} ({round(google_places_count / total_count * 100.0)}%) "
@@ -107,3 +107,33 @@ google_places_decors_to_tags = {
     DecorType.clothes_store: ["shoe_store", 'clothing_store']
     # no known park
 }
+
+
+def reverse_index(decors_to_tags):
+    # inverts a decor mapping into tag -> [(decor order, tag order, decor)], listed in mapping order, so an element
+    # can be matched with one lookup per category/type it has. A tag listed twice under the same decor keeps its
+    # first position.
+    tags_to_decors = {}
+    for decor_order, (decor_type, tag_list) in enumerate(decors_to_tags.items()):
+        for tag_order, tag in enumerate(tag_list):
+            entries = tags_to_decors.setdefault(tag, [])
+            if not any(entry[2] == decor_type for entry in entries):
+                entries.append((decor_order, tag_order, decor_type))
+    return tags_to_decors
+
+
+def first_tag_matches(tags_to_decors, tags):
+    # for every decor that any of the tags maps to, returns (decor, tag) using the tag listed first for that decor
+    # in the mapping, in mapping order. This is the same as walking each decor's tag list and taking the first tag
+    # that is present.
+    best = {}
+    for tag in tags:
+        for decor_order, tag_order, decor_type in tags_to_decors.get(tag, ()):
+            if decor_order not in best or tag_order < best[decor_order][0]:
+                best[decor_order] = (tag_order, decor_type, tag)
+    return [(decor_type, tag) for decor_order, (tag_order, decor_type, tag) in sorted(best.items())]
+
+
+foursquare_tags_to_decors = reverse_index(foursquare_decors_to_tags)
+yelp_tags_to_decors = reverse_index(yelp_decors_to_tags)
+google_places_tags_to_decors = reverse_index(google_places_decors_to_tags)
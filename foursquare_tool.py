@@ -1,20 +1,25 @@
 
-import requests
 import urllib.parse
-import json
-import os.path
-import pickle
-from decor_to_tag_mapping import foursquare_decors_to_tags
+from decor_to_tag_mapping import foursquare_tags_to_decors
 from prediction import Prediction
 from dataset import Dataset
-from ratelimiter import RateLimiter
+from provider_payloads import compact_foursquare
+from cache_store import CacheStore
+from http_transport import shared_transport
+from api_enrichment import fill_in_api_column
+from single_flight import shared_single_flight, query_key
 
 
 class FoursquareTool:
+    # largest radius a place search accepts, in meters: https://developer.foursquare.com/reference/place-search
+    max_radius = 100000
+
     def __init__(self, api_key):
         self.api_key = api_key
-        self.foursquare_cache = 'caches/foursquare_cache.pickle'
-        self.foursquare_dict = {}
+        self.foursquare_cache = 'caches/foursquare_cache.sqlite'
+        self.foursquare_dict = CacheStore(self.foursquare_cache, legacy_pickle='caches/foursquare_cache.pickle')
+        self.transport = shared_transport("foursquare")
+        self.single_flight = shared_single_flight("foursquare")
 
     def __predict(self, element, seedling_date, burger_shop_start_date):
         decors = []
@@ -22,13 +27,20 @@ class FoursquareTool:
             for category in element["categories"]:
                 if "name" in category:
                     category_name = category["name"]
-                    for decor_type, tag_list in foursquare_decors_to_tags.items():
-                        if category_name in tag_list:
-                            decors.append(Prediction(decor_type, Dataset.foursquare, category_name))
-        return list(set(decors))
+                    for decor_order, tag_order, decor_type in foursquare_tags_to_decors.get(category_name, ()):
+                        decors.append(Prediction(decor_type, Dataset.foursquare, category_name))
+        return decors
 
     def predict(self, longitude, latitude, radius, seedling_date, burger_shop_start_date, debug_mode=False):
         result = self.__query(longitude=longitude, latitude=latitude, radius=radius)
+        return self.predict_pois(result, seedling_date, burger_shop_start_date, debug_mode)
+
+    def query_pois(self, longitude, latitude, radius):
+        # every place around the point as a compact payload, which is what the tile cache stores
+        return [compact_foursquare(x)
+                for x in self.__query(longitude=longitude, latitude=latitude, radius=radius)]
+
+    def predict_pois(self, result, seedling_date, burger_shop_start_date, debug_mode=False):
         if debug_mode:
             print(f"DEBUG: {result}")
         ret_dict = {}
@@ -42,51 +54,32 @@ class FoursquareTool:
     def predict_row(self, foursquare_data, seedling_date, burger_shop_start_date):
         return self.__predict(foursquare_data, seedling_date, burger_shop_start_date)
 
-    def fill_in_data(self, data, location_tool, debug_mode=False):
-        # initialize a dict to cache gps coords for locations
-        if os.path.exists(self.foursquare_cache):
-            with open(self.foursquare_cache, 'rb') as handle:
-                # print(f"Loading foursquare data from disk")
-                self.foursquare_dict = pickle.load(handle)
+    def fill_in_data(self, data, location_tool, debug_mode=False, revalidation=None):
+        return fill_in_api_column(data, "foursquare", self.foursquare_dict, self.__create_row_key,
+                                  lambda row_key, row: self.__fill_in_row(row_key, row, location_tool, debug_mode),
+                                  self.transport, "Foursquare Data", compact_foursquare, revalidation)
+
+    def __fill_in_row(self, row_key, row, location_tool, debug_mode):
+        if debug_mode:
+            print(f"running {row['Location']} through foursquare.")
+        # get GPS location of row
+        location = location_tool.lookup_location(row)
+
+        if location:
+            data_foursquare = self.__query_location(location,
+                                                    self.__clean_decor_title(row["Location"]),
+                                                    debug_mode)
         else:
-            print(f"No cache found, creating new foursquare dictionary (This may take a while)...")
-            self.foursquare_dict = {}
-
-        for index, row in data.iterrows():
-            row_key = self.__create_row_key(row)
-            if row_key not in self.foursquare_dict:
-                if debug_mode:
-                    print(f"running {row['Location']} through foursquare.")
-                # get GPS location of row
-                location = location_tool.lookup_location(row)
-
-                if location:
-                    data_foursquare = self.__query_location(location,
-                                                            self.__clean_decor_title(row["Location"]),
-                                                            debug_mode)
-                else:
-                    data_foursquare = None
-
-                self.foursquare_dict[row_key] = data_foursquare
-            else:
-                # it exists, load from cache
-                data_foursquare = self.foursquare_dict[row_key]
-
-            if data_foursquare:
-                # print(f"found foursquare match for {row_key}")
-                data.loc[index, "Foursquare Data"] = json.dumps(data_foursquare)
-            else:
-                # print(f"NO MATCH found foursquare match for {row_key}")
-                data.loc[index, "Foursquare Data"] = None
-
-        with open(self.foursquare_cache, 'wb') as handle:
-            pickle.dump(self.foursquare_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-        return data
-
-    @RateLimiter(max_calls=10, period=1)
+            data_foursquare = None
+
+        self.foursquare_dict[row_key] = data_foursquare
+
     def __query(self, latitude, longitude, radius):
-        # hacky rate limiter
+        # identical queries that are in flight at the same time share one request
+        return self.single_flight.do(query_key("query", latitude, longitude, radius),
+                                     lambda: self.__query_upstream(latitude, longitude, radius))
+
+    def __query_upstream(self, latitude, longitude, radius):
         limit = 50
 
         url = f"https://api.foursquare.com/v3/places/search?ll={latitude},{longitude}" \
@@ -96,12 +89,12 @@ class FoursquareTool:
             "Accept": "application/json",
             "Authorization": f"{self.api_key}"
         }
-        response = requests.request("GET", url, headers=headers).json()
+        response = self.transport.request("GET", url, headers=headers).json()
         if "results" in response:
             return response["results"]
-        return None
+        # an error, IE an invalid key or radius. Raised rather than treated as no results, so it isn't cached.
+        raise Exception(f"Foursquare query failed: {response.get('message', response)}")
 
-    @RateLimiter(max_calls=10, period=1)
     def __query_location(self, location_osm, location_name, debug_mode=False):
         # convert gps location to a gps bounding box
         min_lat, min_long, max_lat, max_long = self.__location_to_bounding_box(location_osm)
@@ -117,14 +110,17 @@ class FoursquareTool:
             "Accept": "application/json",
             "Authorization": f"{self.api_key}"
         }
-        response = requests.request("GET", url, headers=headers).json()
+        response = self.transport.request("GET", url, headers=headers).json()
         if debug_mode:
             print(f"{response}")
-        if "results" in response:
-            for result in response["results"]:
-                if "name" in result:
-                    if location_name in result["name"]:
-                        return result
+        if "results" not in response:
+            # an error, IE an invalid key or an exceeded quota. Raised rather than treated as no match, so it isn't
+            # cached.
+            raise Exception(f"Foursquare query failed: {response.get('message', response)}")
+        for result in response["results"]:
+            if "name" in result:
+                if location_name in result["name"]:
+                    return result
         return None
 
     def __location_to_bounding_box(self, location):
@@ -0,0 +1,215 @@
+from geopy.location import Location
+import difflib
+import math
+import os.path
+import pickle
+import re
+import unicodedata
+
+# GeoNames feature codes that are parts of a bigger place (IE suburbs of a city) rather than the whole place,
+# these get a small bounding box regardless of population.
+section_feature_codes = {"PPLX"}
+# half the width of the bounding box built around a place, in km. GeoNames only has a point for each place,
+# so the box is estimated from its population, between these bounds.
+min_place_radius = 1.5
+max_place_radius = 10
+
+
+class Gazetteer:
+    # Offline geocoder built from a GeoNames dump (IE cities500.txt or allCountries.txt from
+    # https://download.geonames.org/export/dump/). admin1CodesASCII.txt and countryInfo.txt from the same page are
+    # read from the dump's directory when present, so states and countries can be matched by name and not only by
+    # code. Every populated place is indexed by its normalised name (and alternate names) per country and state.
+    # Lookups take a "Suburb, State, Country" key like the one LocationTool geocodes, and only match places in that
+    # state, by name or else by the closest spelling. The whole country is only searched, by exact name, when the
+    # state isn't one the gazetteer knows. The index is pickled next to the other caches and reused until the dump
+    # changes.
+    index_version = 2
+
+    def __init__(self, places_path, index_path=None, fuzzy_cutoff=0.85):
+        self.places_path = places_path
+        self.fuzzy_cutoff = fuzzy_cutoff
+        directory = os.path.dirname(places_path)
+        self.admin1_path = os.path.join(directory, "admin1CodesASCII.txt")
+        self.country_info_path = os.path.join(directory, "countryInfo.txt")
+        if index_path is None:
+            places_name = os.path.basename(places_path).split(".")[0]
+            index_path = f"caches/gazetteer_{places_name}.pickle"
+        self.index_path = index_path
+        # places are stored as (name, lat, lon, radius in km, state, country) tuples, the indexes hold indices into
+        # this list
+        self.places = []
+        self.country_codes = {}
+        self.region_index = {}
+        self.country_index = {}
+        # (country code, state) -> {(first letter, name length): [names]}, built the first time a region needs a
+        # spelling fallback
+        self.fuzzy_index = {}
+        self.load()
+
+    def load(self):
+        index = self.__read_index()
+        if index is not None:
+            self.places = index["places"]
+            self.country_codes = index["country_codes"]
+            self.region_index = index["region_index"]
+            self.country_index = index["country_index"]
+            return
+        print(f"Building gazetteer from {self.places_path} (This may take a while)...")
+        self.build()
+        index = {"version": self.index_version,
+                 "sources": self.__source_mtimes(),
+                 "places": self.places,
+                 "country_codes": self.country_codes,
+                 "region_index": self.region_index,
+                 "country_index": self.country_index}
+        os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+        with open(self.index_path, 'wb') as handle:
+            pickle.dump(index, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def build(self):
+        country_names = self.__read_country_info()
+        admin1_names = self.__read_admin1_names()
+        self.places = []
+        self.region_index = {}
+        self.country_index = {}
+        # https://download.geonames.org/export/dump/readme.txt for the columns
+        with open(self.places_path, encoding="utf-8") as handle:
+            for line in handle:
+                columns = line.rstrip("\n").split("\t")
+                if len(columns) < 15 or columns[6] != "P":
+                    continue
+                name, ascii_name, alternate_names = columns[1], columns[2], columns[3]
+                country_code, admin1_code = columns[8], columns[10]
+                population = int(columns[14] or 0)
+                self.country_codes.setdefault(normalise(country_code), country_code)
+                # states can be given by name or by their admin1 code, IE "Western Australia" or "08"
+                state_names = admin1_names.get(f"{country_code}.{admin1_code}", []) + [admin1_code]
+                if columns[7] in section_feature_codes:
+                    radius = min_place_radius
+                else:
+                    radius = min(max_place_radius, max(min_place_radius, math.sqrt(population) / 50))
+                place_index = len(self.places)
+                self.places.append((name, float(columns[4]), float(columns[5]), radius, state_names[0],
+                                    country_names.get(country_code, country_code)))
+
+                # when names collide, the most populated place wins
+                names = {normalise(x) for x in [name, ascii_name] + alternate_names.split(",") if x}
+                for place_name in names:
+                    for state_name in state_names:
+                        self.__add(self.region_index.setdefault((country_code, normalise(state_name)), {}),
+                                   place_name, place_index, population)
+                    self.__add(self.country_index.setdefault(country_code, {}), place_name, place_index, population)
+
+        # drop the populations the collisions were decided with
+        self.region_index = {region: {name: entry[0] for name, entry in names.items()}
+                             for region, names in self.region_index.items()}
+        self.country_index = {country: {name: entry[0] for name, entry in names.items()}
+                              for country, names in self.country_index.items()}
+        print(f"Gazetteer built with {len(self.places)} places in {len(self.country_index)} countries.")
+
+    def geocode(self, query):
+        # query is "Suburb, State, Country". Returns a geopy Location shaped like Nominatim's, or None.
+        parts = [x.strip() for x in query.split(",")]
+        if len(parts) != 3:
+            return None
+        suburb, state, country = (normalise(x) for x in parts)
+        country_code = self.country_codes.get(country)
+        if country_code is None:
+            return None
+        region = self.region_index.get((country_code, state))
+        if region is None:
+            # a state the gazetteer doesn't know, so the best it can do is the most populated place of that name
+            place_index = self.country_index.get(country_code, {}).get(suburb)
+        else:
+            place_index = region.get(suburb)
+            if place_index is None:
+                place_index = self.__closest_spelling(country_code, state, suburb)
+        if place_index is None:
+            return None
+        return self.__to_location(self.places[place_index])
+
+    def __closest_spelling(self, country_code, state, suburb):
+        # spelling fallback within the state. Only names that start with the same letter and are close enough in
+        # length to pass fuzzy_cutoff are compared, so a miss doesn't scan every name in the state.
+        if len(suburb) == 0:
+            return None
+        region = self.region_index[(country_code, state)]
+        buckets = self.fuzzy_index.get((country_code, state))
+        if buckets is None:
+            buckets = {}
+            for name in region:
+                buckets.setdefault((name[:1], len(name)), []).append(name)
+            self.fuzzy_index[(country_code, state)] = buckets
+        # difflib's ratio is 2 * matches / total length, which can't reach the cutoff outside these lengths
+        min_length = math.floor(len(suburb) * self.fuzzy_cutoff / (2 - self.fuzzy_cutoff))
+        max_length = math.ceil(len(suburb) * (2 - self.fuzzy_cutoff) / self.fuzzy_cutoff)
+        candidates = [name for length in range(min_length, max_length + 1)
+                      for name in buckets.get((suburb[0], length), [])]
+        close_matches = difflib.get_close_matches(suburb, candidates, n=1, cutoff=self.fuzzy_cutoff)
+        return region[close_matches[0]] if len(close_matches) > 0 else None
+
+    def __to_location(self, place):
+        name, latitude, longitude, radius, state, country = place
+        radius_latitude = radius / 111.32
+        radius_longitude = radius / (111.32 * max(0.01, math.cos(math.radians(latitude))))
+        raw = {"lat": str(latitude),
+               "lon": str(longitude),
+               "display_name": f"{name}, {state}, {country}",
+               # same order and string form as Nominatim: min lat, max lat, min long, max long
+               "boundingbox": [str(latitude - radius_latitude), str(latitude + radius_latitude),
+                               str(longitude - radius_longitude), str(longitude + radius_longitude)],
+               "source": "gazetteer"}
+        return Location(raw["display_name"], (latitude, longitude), raw)
+
+    def __add(self, names, name, place_index, population):
+        if name not in names or names[name][1] < population:
+            names[name] = (place_index, population)
+
+    def __read_country_info(self):
+        # country code -> name. Countries are matched by their name, ISO code or ISO3 code.
+        country_names = {}
+        self.country_codes = {}
+        if os.path.exists(self.country_info_path):
+            with open(self.country_info_path, encoding="utf-8") as handle:
+                for line in handle:
+                    if line.startswith("#"):
+                        continue
+                    columns = line.rstrip("\n").split("\t")
+                    if len(columns) < 5:
+                        continue
+                    country_names[columns[0]] = columns[4]
+                    for alias in [columns[0], columns[1], columns[4]]:
+                        self.country_codes[normalise(alias)] = columns[0]
+        return country_names
+
+    def __read_admin1_names(self):
+        # "AU.08" -> [name, ascii name]
+        admin1_names = {}
+        if os.path.exists(self.admin1_path):
+            with open(self.admin1_path, encoding="utf-8") as handle:
+                for line in handle:
+                    columns = line.rstrip("\n").split("\t")
+                    if len(columns) >= 3:
+                        admin1_names[columns[0]] = list(dict.fromkeys([columns[1], columns[2]]))
+        return admin1_names
+
+    def __source_mtimes(self):
+        return {os.path.abspath(path): os.path.getmtime(path)
+                for path in [self.places_path, self.admin1_path, self.country_info_path] if os.path.exists(path)}
+
+    def __read_index(self):
+        # the pickled index, or None if there is none or it was built by another version or from other files
+        if not os.path.exists(self.index_path):
+            return None
+        with open(self.index_path, 'rb') as handle:
+            index = pickle.load(handle)
+        if index.get("version") != self.index_version or index.get("sources") != self.__source_mtimes():
+            return None
+        return index
+
+
+def normalise(name):
+    # lower case ascii with single spaces, IE "Saint-Étienne" -> "saint etienne"
+    name = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"[^a-z0-9]+", " ", name.lower()).strip()
@@ -0,0 +1,113 @@
+from geopy import Nominatim
+from geopy.exc import GeocoderRateLimited, GeocoderTimedOut, GeocoderUnavailable
+from rate_limit_service import shared_rate_limits
+from urllib.parse import urlparse
+import threading
+import time
+
+# how many worker threads geocode against each kind of endpoint. The rate limit budget of the same name has the
+# final say, these only decide how many requests can be waiting on it at once.
+geocoder_workers = {"nominatim": 1,
+                    "nominatim_self_hosted": 8}
+
+# how often progress is reported while geocoding, in seconds
+progress_interval = 30
+
+
+class GeocoderPool:
+    # Resolves many "Suburb, State, Country" keys at once through one or more geocoding endpoints. Each endpoint is
+    # (rate limit budget name, geocoder, workers), where the geocoder is anything with a geopy style
+    # geocode(query) method. By default this is the public Nominatim, or a self-hosted Nominatim if its URL is given,
+    # which is usually allowed far more requests per second. Every worker pulls the next key from a shared queue, so
+    # keys are resolved in the order given, by whichever endpoint is free first.
+    def __init__(self, email, geocoder_url=None, endpoints=None, retries=3, rate_limits=None):
+        self.retries = retries
+        self.rate_limits = rate_limits if rate_limits is not None else shared_rate_limits()
+        if endpoints is not None:
+            self.endpoints = endpoints
+        elif geocoder_url:
+            url = urlparse(geocoder_url)
+            self.endpoints = [("nominatim_self_hosted",
+                               Nominatim(user_agent=email, domain=url.netloc + url.path.rstrip("/"), scheme=url.scheme),
+                               geocoder_workers["nominatim_self_hosted"])]
+        else:
+            self.endpoints = [("nominatim", Nominatim(user_agent=email), geocoder_workers["nominatim"])]
+
+    def geocode_all(self, keys, on_result):
+        # geocodes every key, calling on_result(key, location) as each one is resolved. on_result is only ever
+        # called by one thread at a time. If any key fails after its retries, the rest are dropped and the error is
+        # raised once the workers stop.
+        keys = list(keys)
+        if len(keys) == 0:
+            return
+        queue = iter(keys)
+        lock = threading.Lock()
+        progress = {"done": 0, "started": time.time(), "reported": time.time(), "error": None}
+
+        def work(name, geocoder):
+            while True:
+                with lock:
+                    if progress["error"] is not None:
+                        return
+                    key = next(queue, None)
+                if key is None:
+                    return
+                try:
+                    location = self.geocode(name, geocoder, key)
+                except Exception as e:
+                    with lock:
+                        progress["error"] = e
+                    return
+                with lock:
+                    on_result(key, location)
+                    progress["done"] += 1
+                    self.__report_progress(progress, len(keys))
+
+        print(f"Geocoding {len(keys)} locations through {', '.join(x[0] for x in self.endpoints)}...")
+        threads = [threading.Thread(target=work, args=(name, geocoder), daemon=True)
+                   for name, geocoder, workers in self.endpoints
+                   for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if progress["error"] is not None:
+            raise progress["error"]
+        print(f"Geocoded {progress['done']} locations in {round(time.time() - progress['started'])}s.")
+
+    def geocode(self, name, geocoder, key):
+        # each request is budgeted by the shared rate limit service under the endpoint's name, which also backs off
+        # when the endpoint returns a 429. Timeouts and outages are retried with exponential backoff. An empty result
+        # is an answer, the location is unknown to the geocoder, so it is returned as is.
+        attempt = 0
+        while True:
+            lease_id = self.rate_limits.acquire(name)
+            try:
+                location = geocoder.geocode(key)
+            except GeocoderRateLimited as e:
+                self.rate_limits.release(name, lease_id, 429, e.retry_after)
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                continue
+            except (GeocoderTimedOut, GeocoderUnavailable):
+                self.rate_limits.release(name, lease_id)
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                time.sleep(2 ** attempt)
+                continue
+            except Exception:
+                self.rate_limits.release(name, lease_id)
+                raise
+            self.rate_limits.release(name, lease_id, 200)
+            return location
+
+    def __report_progress(self, progress, total):
+        now = time.time()
+        done = progress["done"]
+        if done == total or now - progress["reported"] < progress_interval:
+            return
+        progress["reported"] = now
+        remaining = (now - progress["started"]) / done * (total - done)
+        print(f"Geocoded {done}/{total} locations, about {round(remaining)}s left.")
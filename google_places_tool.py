@@ -1,21 +1,35 @@
-import requests
 import urllib.parse
-import json
-import os.path
-import pickle
-from decor_to_tag_mapping import google_places_decors_to_tags
+from decor_to_tag_mapping import google_places_tags_to_decors, first_tag_matches
 from prediction import Prediction
 from dataset import Dataset
-from ratelimiter import RateLimiter
+from provider_payloads import compact_google_places
+from cache_store import CacheStore
+from http_transport import shared_transport
+from api_enrichment import fill_in_api_column
+from single_flight import shared_single_flight, query_key
 
 class GooglePlacesTool:
+    # largest radius a nearby search accepts, in meters:
+    # https://developers.google.com/maps/documentation/places/web-service/search-nearby
+    max_radius = 50000
+
     def __init__(self, api_key):
         self.api_key = api_key
-        self.google_places_cache = 'caches/google_places_cache.pickle'
-        self.google_places_dict = {}
+        self.google_places_cache = 'caches/google_places_cache.sqlite'
+        self.google_places_dict = CacheStore(self.google_places_cache, legacy_pickle='caches/google_places_cache.pickle')
+        self.transport = shared_transport("google_places")
+        self.single_flight = shared_single_flight("google_places")
 
     def predict(self, longitude, latitude, radius, seedling_date, burger_shop_start_date, debug_mode=False):
         result = self.__query(longitude=longitude, latitude=latitude, radius=radius)
+        return self.predict_pois(result, seedling_date, burger_shop_start_date, debug_mode)
+
+    def query_pois(self, longitude, latitude, radius):
+        # every place around the point as a compact payload, which is what the tile cache stores
+        return [compact_google_places(x)
+                for x in self.__query(longitude=longitude, latitude=latitude, radius=radius)]
+
+    def predict_pois(self, result, seedling_date, burger_shop_start_date, debug_mode=False):
         ret_dict = {}
         if debug_mode:
             print(f"DEBUG: {result}")
@@ -34,65 +48,39 @@ class GooglePlacesTool:
         decors = []
         if "types" in google_places_data:
             tags = google_places_data["types"]
-            for decor_type, tag_list in google_places_decors_to_tags.items():
-                result = self.__any_in(tag_list, tags)
-                if result is not None:
-                    decors.append(Prediction(decor_type, Dataset.google_places, result))
+            for decor_type, tag in first_tag_matches(google_places_tags_to_decors, tags):
+                decors.append(Prediction(decor_type, Dataset.google_places, tag))
         return decors
 
-    def __any_in(self, list_1, list_2):
-        for element in list_1:
-            if element in list_2:
-                return element
-        return None
-
-    def fill_in_data(self, data, location_tool, debug_mode=False):
-        # initialize a dict to cache gps coords for locations
-        if os.path.exists(self.google_places_cache):
-            with open(self.google_places_cache, 'rb') as handle:
-                # print(f"Loading google_places data from disk")
-                self.google_places_dict = pickle.load(handle)
-        else:
-            print(f"No cache found, creating new google_places dictionary (This may take a while)...")
-            self.google_places_dict = {}
-
-        for index, row in data.iterrows():
-            row_key = self.__create_row_key(row)
-            if row_key not in self.google_places_dict:
-                # get GPS location of row
-                location = location_tool.lookup_location(row)
+    def fill_in_data(self, data, location_tool, debug_mode=False, revalidation=None):
+        return fill_in_api_column(data, "google_places", self.google_places_dict, self.__create_row_key,
+                                  lambda row_key, row: self.__fill_in_row(row_key, row, location_tool, debug_mode),
+                                  self.transport, "Google Places Data", compact_google_places, revalidation)
 
-                if location:
-                    if debug_mode:
-                        print(f"running {row['Location']} through google places.")
+    def __fill_in_row(self, row_key, row, location_tool, debug_mode):
+        # get GPS location of row
+        location = location_tool.lookup_location(row)
 
-                    data_google_places = self.__query_location(location,
-                                                               self.__clean_decor_title(row["Location"]))
-                else:
-                    data_google_places = None
+        if location:
+            if debug_mode:
+                print(f"running {row['Location']} through google places.")
 
-                if debug_mode and data_google_places is not None:
-                    print(data_google_places)
-
-                self.google_places_dict[row_key] = data_google_places
-            else:
-                # it exists, load from cache
-                data_google_places = self.google_places_dict[row_key]
-
-            if data_google_places:
-                # print(f"found google_places match for {row_key}")
-                data.loc[index, "Google Places Data"] = json.dumps(data_google_places)
-            else:
-                # print(f"NO MATCH found google_places match for {row_key}")
-                data.loc[index, "Google Places Data"] = None
+            data_google_places = self.__query_location(location,
+                                                       self.__clean_decor_title(row["Location"]))
+        else:
+            data_google_places = None
 
-        with open(self.google_places_cache, 'wb') as handle:
-            pickle.dump(self.google_places_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        if debug_mode and data_google_places is not None:
+            print(data_google_places)
 
-        return data
+        self.google_places_dict[row_key] = data_google_places
 
-    @RateLimiter(max_calls=10, period=1)
     def __query(self, latitude, longitude, radius):
+        # identical queries that are in flight at the same time share one request
+        return self.single_flight.do(query_key("query", latitude, longitude, radius),
+                                     lambda: self.__query_upstream(latitude, longitude, radius))
+
+    def __query_upstream(self, latitude, longitude, radius):
         url = f"https://maps.googleapis.com/maps/api/place/nearbysearch/json?" \
               f"location={latitude}%2C{longitude}" \
               f"&radius={radius}" \
@@ -100,12 +88,13 @@ class GooglePlacesTool:
               f"&key={self.api_key}"
         payload = {}
         headers = {}
-        response = requests.request("GET", url, headers=headers, data=payload).json()
-        if "results" in response:
-            return response["results"]
-        return None
+        response = self.transport.request("GET", url, headers=headers, data=payload).json()
+        if response.get("status") in ("OK", "ZERO_RESULTS"):
+            return response.get("results", [])
+        # an error, IE an invalid key, radius or an exceeded quota. Errors come with an empty result list too, so
+        # they are raised rather than treated as no results, so they aren't cached.
+        raise Exception(f"Google Places query failed: {response.get('status')} {response.get('error_message', '')}")
 
-    @RateLimiter(max_calls=10, period=1)
     def __query_location(self, location_osm, location_name):
         # converting into a bounding box:
         # https://developers.google.com/maps/documentation/places/web-service/search-find-place
@@ -119,13 +108,16 @@ class GooglePlacesTool:
               f"&key={self.api_key}"
         payload = {}
         headers = {}
-        response = requests.request("GET", url, headers=headers, data=payload).json()
-
-        if "candidates" in response:
-            for result in response["candidates"]:
-                if "name" in result:
-                    if location_name in result["name"]:
-                        return result
+        response = self.transport.request("GET", url, headers=headers, data=payload).json()
+
+        if response.get("status") not in ("OK", "ZERO_RESULTS"):
+            # an error, IE an invalid key or an exceeded quota. Raised rather than treated as no match, so it isn't
+            # cached.
+            raise Exception(f"Google Places query failed: {response.get('status')} {response.get('error_message', '')}")
+        for result in response.get("candidates", []):
+            if "name" in result:
+                if location_name in result["name"]:
+                    return result
         return None
 
     def __create_rect_string(self, location):
@@ -0,0 +1,91 @@
+from concurrent.futures import ThreadPoolExecutor
+from rate_limit_service import shared_rate_limits
+from request_deadline import remaining_time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+import requests
+
+# per data source transport settings. max_concurrency is how many requests may be in flight at once,
+# timeout is in seconds and applies to both connecting and reading. Request rates and quotas are budgeted
+# per data source by the rate limit service, see rate_limit_service.provider_budgets.
+transport_settings = {
+    "foursquare": {"max_concurrency": 10, "timeout": 30, "retries": 3},
+    "google_places": {"max_concurrency": 10, "timeout": 30, "retries": 3},
+    "yelp": {"max_concurrency": 10, "timeout": 30, "retries": 3},
+}
+
+transports = {}
+transports_lock = threading.Lock()
+
+
+def shared_transport(name):
+    # one transport per data source for the whole process, so every tool instance shares the same
+    # connection pool and concurrency limit.
+    with transports_lock:
+        if name not in transports:
+            transports[name] = HttpTransport(rate_limit_name=name, **transport_settings.get(name, {}))
+        return transports[name]
+
+
+class HttpTransport:
+    def __init__(self, max_concurrency=10, timeout=30, retries=3, backoff_factor=0.5, rate_limit_name=None):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.rate_limit_name = rate_limit_name
+        self.rate_limits = shared_rate_limits() if rate_limit_name else None
+        # keep-alive connections are pooled per host, sized so every in-flight request gets a connection.
+        # 429s aren't retried here, they go back to the rate limit service which decides how long to back off.
+        retry = Retry(total=retries,
+                      connect=retries,
+                      read=retries,
+                      status=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=[500, 502, 503, 504],
+                      allowed_methods=["GET"],
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_concurrency, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.in_flight = threading.BoundedSemaphore(max_concurrency)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        if not self.in_flight.acquire(timeout=remaining_time()):
+            raise TimeoutError(f"No {self.rate_limit_name or 'HTTP'} request slot was free before the deadline.")
+        try:
+            if self.rate_limits is None:
+                return self.session.request(method, url, **self.__until_deadline(kwargs))
+            attempt = 0
+            while True:
+                lease_id = self.rate_limits.acquire(self.rate_limit_name, timeout=remaining_time())
+                response = None
+                try:
+                    response = self.session.request(method, url, **self.__until_deadline(kwargs))
+                finally:
+                    self.rate_limits.release(self.rate_limit_name,
+                                             lease_id,
+                                             response.status_code if response is not None else None,
+                                             response.headers.get("Retry-After") if response is not None else None)
+                attempt += 1
+                if response.status_code != 429 or attempt > self.retries:
+                    return response
+        finally:
+            self.in_flight.release()
+
+    def run_concurrently(self, function, items):
+        # calls function on every item with up to max_concurrency calls in flight, returning results in order.
+        items = list(items)
+        if len(items) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(items))) as executor:
+            return list(executor.map(function, items))
+
+    def __until_deadline(self, kwargs):
+        # when the caller has a deadline, the request times out with it, so the lease is released in time
+        remaining = remaining_time()
+        if remaining is None:
+            return kwargs
+        return dict(kwargs, timeout=min(kwargs["timeout"], remaining))
@@ -1,63 +1,66 @@
-from OSMPythonTools.overpass import overpassQueryBuilder, Overpass
-from geopy import Nominatim
-from geopy.extra.rate_limiter import RateLimiter
-import os.path
-import pickle
+from cache_store import CacheStore
+from geocoder_pool import GeocoderPool
+from gazetteer import Gazetteer
+from collections import Counter
 
 
 class LocationTool:
-    def __init__(self, email):
+    def __init__(self, email, geocoder_url=None, gazetteer_path=None):
         self.email = email
-        self.gps_cache = 'caches/gps_cache.pickle'
-        self.location_dict = {}
+        self.gps_cache = 'caches/gps_cache.sqlite'
+        self.location_dict = CacheStore(self.gps_cache, legacy_pickle='caches/gps_cache.pickle')
+        self.geocoder_pool = GeocoderPool(email, geocoder_url)
+        # keys found in the local gazetteer never reach the geocoder pool. Its locations are estimates, so they are
+        # only kept in memory and never written to the gps cache, where they would hide the place from a real
+        # geocoder on later runs.
+        self.gazetteer = Gazetteer(gazetteer_path) if gazetteer_path else None
+        self.gazetteer_locations = {}
 
-    def make_location_dict(self, df):
-        # Initialize Singletons
-        locator = Nominatim(user_agent=self.email)
-        geocode = RateLimiter(locator, min_delay_seconds=1.5)
-        # initialize a dict to cache gps coords for locations
-        if os.path.exists(self.gps_cache):
-            with open(self.gps_cache, 'rb') as handle:
-                # print(f"Loading gps from disk")
-                self.location_dict = pickle.load(handle)
+    def make_location_dict(self, df, revalidation=None):
+        # collect the unique location keys first, counting how many rows depend on each
+        row_counts = Counter(self.create_suburb_state_country_string(row) for index, row in df.iterrows())
+        # when revalidating, expired entries are geocoded again as if they weren't cached
+        if revalidation:
+            refresh = revalidation.stale_keys("location",
+                                              self.location_dict,
+                                              ((self.create_suburb_state_country_string(row), row)
+                                               for index, row in df.iterrows()))
         else:
-            print(f"No cache found, creating new location dictionary (This may take a while)...")
-            self.location_dict = {}
-        for index, row in df.iterrows():
-            # get GPS location of row
-            self.location_dict = self.generate_location_data(row, self.location_dict, locator)
-        # save the gps data to disk
-        with open(self.gps_cache, 'wb') as handle:
-            pickle.dump(self.location_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            refresh = set()
 
-    def generate_location_data(self, row, location_dict, locator):
-        city_key = self.create_suburb_state_country_string(row)
-        if city_key not in location_dict:
-            # print(f"not found: {city_key}")
+        # if the gps location does not exist, use geocoding to query. Note that this is rate limited and slow,
+        # so only the missing keys are geocoded, the ones most rows depend on first.
+        pending = [city_key for city_key, count in row_counts.most_common()
+                   if not self.__is_geocoded(city_key) or city_key in refresh]
+        if self.gazetteer and len(pending) > 0:
+            not_found = [city_key for city_key in pending if self.__gazetteer_location(city_key) is None]
+            print(f"Found {len(pending) - len(not_found)} of {len(pending)} locations in the gazetteer.")
+            pending = not_found
+        self.geocoder_pool.geocode_all(pending, self.__store_location)
+        return df
 
-            # if the gps location does not exist, use geocoding to query. Note that this
-            # rate limited and slow, so you only want to query this if totally necessary
-            location = locator.geocode(city_key)
+    def __store_location(self, city_key, location):
+        # add the new entry to the location dict
+        self.location_dict[city_key] = location
 
-            # add the new entry to the location dict
-            location_dict[city_key] = location
-        else:
-            # print(f"found: {city_key}")
-            pass
-            # if the gps location has already been searched, use the cached version
-            # location = location_dict[city_key]
+    def __is_geocoded(self, city_key):
+        # gazetteer locations cached by older versions don't count, so a geocoder replaces them
+        entry = self.location_dict.entry(city_key)
+        return entry is not None and not (entry[0] and entry[0].raw.get("source") == "gazetteer")
 
-        return location_dict
+    def __gazetteer_location(self, city_key):
+        if city_key not in self.gazetteer_locations:
+            self.gazetteer_locations[city_key] = self.gazetteer.geocode(city_key)
+        return self.gazetteer_locations[city_key]
 
     def lookup_location(self, row):
         city_key = self.create_suburb_state_country_string(row)
-        if city_key in self.location_dict:
-            # print(f"found: {city_key}")
-            # if the gps location has already been searched, use the cached version
-            return self.location_dict[city_key]
-        else:
-            # print(f"not found: {city_key}")
-            return None
+        location = self.location_dict.get(city_key)
+        if location is None and self.gazetteer:
+            # found locally, or not at all. Looked up here too, so rows a resumed run skipped geocoding for still
+            # find their gazetteer location.
+            return self.__gazetteer_location(city_key)
+        return location
 
     def create_suburb_state_country_string(self, row):
         country = row["Country"]
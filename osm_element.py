@@ -0,0 +1,49 @@
+class OSMElement:
+    # Compact stand-in for an OSMPythonTools element, keeping only what the predictors and caches need.
+    # It exposes the same id()/type()/tags()/tag() accessors, so it can be used anywhere an Overpass element is.
+    __slots__ = ("element_id", "element_type", "latitude", "longitude", "element_tags")
+
+    def __init__(self, element_id, element_type, tags, latitude=None, longitude=None):
+        self.element_id = element_id
+        self.element_type = element_type
+        self.element_tags = tags if tags is not None else {}
+        self.latitude = latitude
+        self.longitude = longitude
+
+    @classmethod
+    def from_overpass(cls, element):
+        latitude = None
+        longitude = None
+        if element.type() == "node":
+            latitude = element.lat()
+            longitude = element.lon()
+        return cls(element.id(), element.type(), dict(element.tags() or {}), latitude, longitude)
+
+    @classmethod
+    def from_compact(cls, compact):
+        element_id, element_type, latitude, longitude, tags = compact
+        return cls(element_id, element_type, tags, latitude, longitude)
+
+    def to_compact(self):
+        return self.element_id, self.element_type, self.latitude, self.longitude, self.element_tags
+
+    def id(self):
+        return self.element_id
+
+    def type(self):
+        return self.element_type
+
+    def lat(self):
+        return self.latitude
+
+    def lon(self):
+        return self.longitude
+
+    def tags(self):
+        return self.element_tags
+
+    def tag(self, key):
+        return self.element_tags.get(key)
+
+    def __repr__(self):
+        return f"OSMElement({self.element_type}/{self.element_id}, {self.element_tags})"
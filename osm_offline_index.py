@@ -0,0 +1,148 @@
+from osm_element import OSMElement
+import hashlib
+import math
+import os.path
+import pickle
+import xml.etree.ElementTree as ElementTree
+
+
+class OSMOfflineIndex:
+    # Local replacement for Overpass, built from an OSM extract (.osm.pbf or .osm XML). The extract is read once,
+    # every node that has a name or one of the selector tags is kept, and the nodes are bucketed into a lat/long
+    # grid. Named nodes get their own grid so name lookups never scan unnamed nodes. The index is pickled next to
+    # the other caches and reused until the extract changes. The file holds a small header pickle followed by the
+    # nodes and grids, so checking whether it is current doesn't unpickle the whole index.
+    index_version = 2
+
+    def __init__(self, extract_path, selectors, index_path=None, cell_size=0.01):
+        self.extract_path = extract_path
+        self.selectors = list(selectors)
+        self.cell_size = cell_size
+        if index_path is None:
+            # extracts with the same name in different directories each get their own index
+            extract_name = os.path.basename(extract_path).split(".")[0]
+            path_hash = hashlib.sha1(os.path.abspath(extract_path).encode()).hexdigest()[:12]
+            index_path = f"caches/osm_offline_index_{extract_name}_{path_hash}.pickle"
+        self.index_path = index_path
+        # nodes are stored as compact (id, type, lat, lon, tags) tuples, the grids hold indices into this list
+        self.nodes = []
+        self.grid = {}
+        self.name_grid = {}
+        self.load()
+
+    def load(self):
+        index = self.__read_index()
+        if index is not None:
+            self.nodes = index["nodes"]
+            self.grid = index["grid"]
+            self.name_grid = index["name_grid"]
+            return
+        print(f"Building offline OSM index from {self.extract_path} (This may take a while)...")
+        self.build()
+        index = {"nodes": self.nodes,
+                 "grid": self.grid,
+                 "name_grid": self.name_grid}
+        os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+        with open(self.index_path, 'wb') as handle:
+            pickle.dump(self.__header(), handle, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(index, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def build(self):
+        self.nodes = []
+        self.grid = {}
+        self.name_grid = {}
+        if self.extract_path.endswith(".pbf"):
+            nodes = self.__read_pbf_nodes()
+        else:
+            nodes = self.__read_xml_nodes()
+        for node_id, latitude, longitude, tags in nodes:
+            has_name = "name" in tags
+            if not has_name and not any(selector in tags for selector in self.selectors):
+                continue
+            node_index = len(self.nodes)
+            self.nodes.append((node_id, "node", latitude, longitude, tags))
+            cell = self.__cell(latitude, longitude)
+            self.grid.setdefault(cell, []).append(node_index)
+            if has_name:
+                self.name_grid.setdefault(cell, []).append(node_index)
+        print(f"Offline OSM index built with {len(self.nodes)} nodes in {len(self.grid)} cells.")
+
+    def query_bbox(self, min_lat, min_long, max_lat, max_long):
+        # same contents as the Overpass union query in OSMTool: every node in the box with a selector tag,
+        # in id order like Overpass' "out body".
+        matches = []
+        for node_index in self.__nodes_in_bbox(self.grid, min_lat, min_long, max_lat, max_long):
+            tags = self.nodes[node_index][4]
+            if any(selector in tags for selector in self.selectors):
+                matches.append(self.nodes[node_index])
+        return [OSMElement.from_compact(node) for node in sorted(matches, key=lambda node: node[0])]
+
+    def query_name(self, min_lat, min_long, max_lat, max_long, location_name):
+        # named nodes in the box whose name contains location_name, in id order.
+        matches = []
+        for node_index in self.__nodes_in_bbox(self.name_grid, min_lat, min_long, max_lat, max_long):
+            if location_name in self.nodes[node_index][4]["name"]:
+                matches.append(self.nodes[node_index])
+        return [OSMElement.from_compact(node) for node in sorted(matches, key=lambda node: node[0])]
+
+    def __nodes_in_bbox(self, grid, min_lat, min_long, max_lat, max_long):
+        min_lat, min_long, max_lat, max_long = float(min_lat), float(min_long), float(max_lat), float(max_long)
+        min_x, min_y = self.__cell(min_lat, min_long)
+        max_x, max_y = self.__cell(max_lat, max_long)
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                for node_index in grid.get((x, y), []):
+                    latitude, longitude = self.nodes[node_index][2], self.nodes[node_index][3]
+                    if min_lat <= latitude <= max_lat and min_long <= longitude <= max_long:
+                        yield node_index
+
+    def __cell(self, latitude, longitude):
+        return math.floor(latitude / self.cell_size), math.floor(longitude / self.cell_size)
+
+    def __header(self):
+        # what the index was built from, it is rebuilt when any of it changes
+        return {"version": self.index_version,
+                "extract_path": os.path.abspath(self.extract_path),
+                "extract_mtime": os.path.getmtime(self.extract_path),
+                "selectors": self.selectors,
+                "cell_size": self.cell_size}
+
+    def __read_index(self):
+        # the pickled index, or None if there is none or it is out of date. Only the header is read in that case.
+        if not os.path.exists(self.index_path):
+            return None
+        with open(self.index_path, 'rb') as handle:
+            header = pickle.load(handle)
+            if header != self.__header():
+                return None
+            return pickle.load(handle)
+
+    def __read_xml_nodes(self):
+        # stream the XML so large extracts don't have to fit in memory as a tree
+        for event, element in ElementTree.iterparse(self.extract_path, events=("end",)):
+            if element.tag == "node":
+                tags = {tag.get("k"): tag.get("v") for tag in element.iter("tag")}
+                if tags:
+                    yield int(element.get("id")), float(element.get("lat")), float(element.get("lon")), tags
+                element.clear()
+            elif element.tag in ("way", "relation"):
+                element.clear()
+
+    def __read_pbf_nodes(self):
+        # PBF support needs pyosmium, which is only required when using a .pbf extract
+        try:
+            import osmium
+        except ImportError:
+            raise Exception("Reading .osm.pbf extracts requires the osmium package "
+                            "(python3 -m pip install osmium), or convert the extract to .osm XML.")
+
+        nodes = []
+
+        class NodeHandler(osmium.SimpleHandler):
+            def node(self, node):
+                if len(node.tags) > 0 and node.location.valid():
+                    nodes.append((node.id, node.location.lat, node.location.lon,
+                                  {tag.k: tag.v for tag in node.tags}))
+
+        NodeHandler().apply_file(self.extract_path)
+        return nodes
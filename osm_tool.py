@@ -1,21 +1,107 @@
 
-from OSMPythonTools.overpass import overpassQueryBuilder, Overpass
 from prediction import Prediction
 from dataset import Dataset
 from decor_type import DecorType
 from decor_to_tag_mapping import osm_decors_to_tags
+from cache_store import CacheStore
+from osm_element import OSMElement
+from osm_offline_index import OSMOfflineIndex
+from rate_limit_service import shared_rate_limits
+from single_flight import shared_single_flight, query_key
+from request_deadline import remaining_time
+from tile_cache import distance, radius_to_bounding_box
 import math
 
+# every tag key the decor mapping reads. Overpass returns any node that has at least one of these keys,
+# so a single union query is enough to see every node that could map to a decor.
+osm_selectors = list(dict.fromkeys(tag[0] for tag_list in osm_decors_to_tags.values() for tag in tag_list))
+
+# decors whose OSM rule depends on the seedling date. Each maps to the label its predictions are counted under,
+# and the (key, value) tags that trigger it, each with an optional predicate on (seedling_date, burger_shop_start_date).
+osm_date_rules = {
+    DecorType.restaurant: ("amenity=restaurant", [(("amenity", "restaurant"), None),
+                                                  # early data shows that fast_food was originally used as restaurant.
+                                                  # Need a bit more data to verify the pattern.
+                                                  (("amenity", "fast_food"),
+                                                   lambda seedling_date, burger_shop_start_date:
+                                                   seedling_date < burger_shop_start_date)]),
+    DecorType.burger_place: ("amenity=fast_food", [(("amenity", "fast_food"),
+                                                    lambda seedling_date, burger_shop_start_date:
+                                                    seedling_date >= burger_shop_start_date),
+                                                   (("cuisine", "burger"), None)]),
+}
+
+
+def compile_osm_rules(decors_to_tags, date_rules):
+    # inverts the decor mapping into (key, value) -> [(order, decor, label, predicate)], so predicting an element
+    # costs one lookup per tag it has. order is the position of the rule in the mapping, which keeps predictions in
+    # mapping order, and lets a rule with several triggering tags fire only once.
+    tags_to_rules = {}
+    order = 0
+    for decor_type, tag_list in decors_to_tags.items():
+        if decor_type in date_rules:
+            label, triggers = date_rules[decor_type]
+            for tag, predicate in triggers:
+                tags_to_rules.setdefault(tag, []).append((order, decor_type, label, predicate))
+            order += 1
+        else:
+            for tag in tag_list:
+                tags_to_rules.setdefault(tuple(tag), []).append((order, decor_type, f"{tag[0]}={tag[1]}", None))
+                order += 1
+    return tags_to_rules
+
+
+osm_tags_to_rules = compile_osm_rules(osm_decors_to_tags, osm_date_rules)
+
+# how many location names are folded into a single name regex when batching enrichment queries.
+osm_batch_size = 20
+
+# largest box, in degrees on each side, that a region is fetched from Overpass in, so a whole city is split into
+# several queries that each finish well within the query timeout.
+osm_region_box_size = 0.05
+
+
+def overpass_query_builder(**kwargs):
+    # OSMPythonTools is only imported once Overpass is actually queried, so startup and runs on an offline extract
+    # never load it
+    from OSMPythonTools.overpass import overpassQueryBuilder
+    return overpassQueryBuilder(**kwargs)
+
 
 class OSMTool:
-    def __init__(self):
-        self.overpass = Overpass()
+    # Overpass searches a bounding box of any size
+    max_radius = None
+
+    def __init__(self, osm_extract=None):
+        self.overpass = None
+        # when a local extract is given, every lookup is answered from the offline index instead of Overpass
+        self.offline_index = OSMOfflineIndex(osm_extract, osm_selectors) if osm_extract else None
+        self.rate_limits = shared_rate_limits()
+        self.single_flight = shared_single_flight("overpass")
+        self.osm_cache = 'caches/osm_cache.sqlite'
+        self.osm_dict = CacheStore(self.osm_cache, legacy_pickle='caches/osm_cache.pickle')
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.overpass_calls = 0
 
     def predict_row(self, osm_data, seedling_date, burger_shop_start_date):
         return self.__predict(osm_data, seedling_date, burger_shop_start_date)
 
     def predict(self, longitude, latitude, radius, seedling_date, burger_shop_start_date, debug_mode=False):
         results = self.__query(longitude, latitude, radius)
+        return self.__predict_elements(results, seedling_date, burger_shop_start_date, debug_mode)
+
+    def query_pois(self, longitude, latitude, radius):
+        # every element around the point in compact tuple form, which is what the tile cache stores
+        return [OSMElement.from_overpass(x).to_compact() for x in self.__query(longitude, latitude, radius)]
+
+    def predict_pois(self, pois, seedling_date, burger_shop_start_date, debug_mode=False):
+        return self.__predict_elements([OSMElement.from_compact(x) for x in pois],
+                                       seedling_date,
+                                       burger_shop_start_date,
+                                       debug_mode)
+
+    def __predict_elements(self, results, seedling_date, burger_shop_start_date, debug_mode=False):
         if debug_mode:
             print(f"DEBUG:")
             for element in results:
@@ -28,68 +114,231 @@ class OSMTool:
         return ret_dict
 
     def __predict(self, osm_data, seedling_date, burger_shop_start_date):
-        decors = []
-        for decor_type, tag_list in osm_decors_to_tags.items():
-            if decor_type == DecorType.restaurant:
-                if osm_data.tag('amenity') == "restaurant" or (
-                        seedling_date < burger_shop_start_date and osm_data.tag('amenity') == "fast_food"):
-                    # early data shows that fast_food was originally used as restaurant.
-                    # Need a bit more data to verify the pattern.
-                    decors.append(Prediction(DecorType.restaurant, Dataset.osm, "amenity=restaurant"))
-            elif decor_type == DecorType.burger_place:
-                if (seedling_date >= burger_shop_start_date and osm_data.tag('amenity') == "fast_food") or osm_data.tag(
-                        'cuisine') == 'burger':
-                    decors.append(Prediction(DecorType.burger_place, Dataset.osm, "amenity=fast_food"))
-            else:
-                for tag in tag_list:
-                    if osm_data.tag(tag[0]) == tag[1]:
-                        decors.append(Prediction(decor_type, Dataset.osm, f"{tag[0]}={tag[1]}"))
-        return list(set(decors))
+        fired = {}
+        for tag in (osm_data.tags() or {}).items():
+            for order, decor_type, label, predicate in osm_tags_to_rules.get(tag, ()):
+                if order not in fired and (predicate is None or predicate(seedling_date, burger_shop_start_date)):
+                    fired[order] = Prediction(decor_type, Dataset.osm, label)
+        return [fired[order] for order in sorted(fired)]
+
+    def fill_in_data(self, df, location_tool, batched=True, debug_mode=False, revalidation=None):
+        # the cache is keyed by (bounding box, cleaned location name) and stores the matched element in its
+        # compact tuple form, or None when Overpass had no match.
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.overpass_calls = 0
 
-    def fill_in_data(self, df, location_tool):
+        # when revalidating, expired entries are queried again as if they weren't cached
+        if revalidation:
+            refresh = revalidation.stale_keys("osm", self.osm_dict, self.__keyed_rows(df, location_tool))
+        else:
+            refresh = set()
+
+        # in batched mode, every uncached row that shares a suburb is fetched up front with one query,
+        # and the per row loop below is then answered from the cache.
+        # batching is pointless for the offline index, as each lookup is already local.
+        if batched and not self.offline_index:
+            prefetched = self.__prefetch_by_location(df, location_tool, refresh)
+        else:
+            prefetched = set()
+
+        osm_payloads = []
         for index, row in df.iterrows():
             # get GPS location of row
             location = location_tool.lookup_location(row)
             if location:
-                data_osm = self.__query_location(location, self.__clean_decor_title(row["Location"]))
+                if debug_mode:
+                    print(f"running {row['Location']} through osm.")
+                data_osm = self.__cached_query_location(location,
+                                                        self.__clean_decor_title(row["Location"]),
+                                                        prefetched,
+                                                        refresh)
             else:
                 data_osm = None
 
-            df.loc[index, "OSM Data"] = data_osm
-            if data_osm:
-                df.loc[index, "OSM Tags"] = str(data_osm.tags())
+            osm_payloads.append(data_osm)
+        df["OSM Data"] = osm_payloads
+        df["OSM Tags"] = [str(x.tags()) if x else None for x in osm_payloads]
+
+        print(f"OSM cache hits: {self.cache_hits}, misses: {self.cache_misses}, "
+              f"overpass calls: {self.overpass_calls}")
         return df
 
+    def __keyed_rows(self, df, location_tool):
+        for index, row in df.iterrows():
+            location = location_tool.lookup_location(row)
+            if location:
+                yield (self.__location_to_bounding_box(location), self.__clean_decor_title(row["Location"])), row
+
+    def __cached_query_location(self, location_osm, location_name, prefetched=(), refresh=()):
+        cache_key = (self.__location_to_bounding_box(location_osm), location_name)
+        if cache_key in self.osm_dict and cache_key not in refresh:
+            if cache_key in prefetched:
+                # fetched by the batch pass during this run, so it counts as a miss the first time it is used.
+                prefetched.discard(cache_key)
+                self.cache_misses += 1
+            else:
+                self.cache_hits += 1
+            compact = self.osm_dict[cache_key]
+        else:
+            self.cache_misses += 1
+            element = self.__query_location(location_osm, location_name)
+            compact = OSMElement.from_overpass(element).to_compact() if element else None
+            self.osm_dict[cache_key] = compact
+            if cache_key in refresh:
+                refresh.discard(cache_key)
+        return OSMElement.from_compact(compact) if compact else None
+
+    def __prefetch_by_location(self, df, location_tool, refresh=()):
+        # group the uncached location names by the suburb they are in, since rows in the same suburb
+        # share the same bounding box.
+        groups = {}
+        for index, row in df.iterrows():
+            location = location_tool.lookup_location(row)
+            if not location:
+                continue
+            location_name = self.__clean_decor_title(row["Location"])
+            bounding_box = self.__location_to_bounding_box(location)
+            if (bounding_box, location_name) in self.osm_dict and (bounding_box, location_name) not in refresh:
+                continue
+            location_key = location_tool.create_suburb_state_country_string(row)
+            if location_key not in groups:
+                groups[location_key] = (location, [])
+            if location_name not in groups[location_key][1]:
+                groups[location_key][1].append(location_name)
+
+        prefetched = set()
+        for location_key, (location, location_names) in groups.items():
+            bounding_box = self.__location_to_bounding_box(location)
+            for i in range(0, len(location_names), osm_batch_size):
+                batch = location_names[i:i + osm_batch_size]
+                elements = self.__query_location_names(location, batch)
+                for location_name in batch:
+                    match = None
+                    for element in elements:
+                        if location_name in element.tag('name'):
+                            # exact match for substring!
+                            match = OSMElement.from_overpass(element).to_compact()
+                            break
+                    self.osm_dict[(bounding_box, location_name)] = match
+                    prefetched.add((bounding_box, location_name))
+                    if (bounding_box, location_name) in refresh:
+                        refresh.discard((bounding_box, location_name))
+        return prefetched
+
+    def __query_location_names(self, location_osm, location_names):
+        min_long, min_lat, max_long, max_lat = self.__location_to_bounding_box(location_osm)
+        # one regex alternation of every name. The names are only used as a pre-filter, rows are matched
+        # locally by substring afterwards, so characters that are awkward to escape are widened to "."
+        name_regex = "|".join(self.__name_to_regex(location_name) for location_name in location_names)
+        query = overpass_query_builder(bbox=[min_lat, min_long, max_lat, max_long],
+                                       elementType='node',
+                                       selector=[f'"name"~"{name_regex}"'],
+                                       out='body')
+        result = self.__overpass_query(query)
+        return result.elements() or []
+
+    def __name_to_regex(self, location_name):
+        regex = ""
+        for character in location_name:
+            if character in '^]\\"':
+                regex += "."
+            elif character in ".$*+?()[{}|":
+                regex += f"[{character}]"
+            else:
+                regex += character
+        return regex
+
+    def query_region(self, min_lat, min_long, max_lat, max_long):
+        # every element in the box in compact tuple form. Large regions are fetched one sub-box at a time, and
+        # elements on the edge between two sub-boxes are only returned once.
+        rows = max(1, math.ceil((max_lat - min_lat) / osm_region_box_size))
+        columns = max(1, math.ceil((max_long - min_long) / osm_region_box_size))
+        height = (max_lat - min_lat) / rows
+        width = (max_long - min_long) / columns
+        elements = {}
+        for row in range(rows):
+            for column in range(columns):
+                south = min_lat + row * height
+                west = min_long + column * width
+                north = max_lat if row == rows - 1 else south + height
+                east = max_long if column == columns - 1 else west + width
+                for element in self.__query_bbox(south, west, north, east):
+                    compact = OSMElement.from_overpass(element).to_compact()
+                    elements.setdefault((compact[0], compact[1]), compact)
+        return list(elements.values())
+
     def __query(self, longitude, latitude, radius):
+        # every element within radius meters of the point, the same circle the other data sources search
         min_long, min_lat, max_long, max_lat = self.__longitude_latitude_radius_to_bounding_box(longitude,
                                                                                                 latitude,
                                                                                                 radius)
+        return [x for x in self.__query_bbox(min_lat, min_long, max_lat, max_long)
+                if x.lat() is None or distance(latitude, longitude, x.lat(), x.lon()) <= radius]
+
+    def __query_bbox(self, min_lat, min_long, max_lat, max_long):
+        if self.offline_index:
+            return self.offline_index.query_bbox(min_lat, min_long, max_lat, max_long)
+        # identical queries that are in flight at the same time share one request
+        return self.single_flight.do(query_key("bbox", min_lat, min_long, max_lat, max_long),
+                                     lambda: self.__query_overpass_bbox(min_lat, min_long, max_lat, max_long))
+
+    def __query_overpass_bbox(self, min_lat, min_long, max_lat, max_long):
         # https://wiki.openstreetmap.org/wiki/Overpass_API/Language_Guide
-        results = []
-        for selector in ["amenity", "shop", "aeroway", "tourism", "cuisine", "leisure", "natural", "railway"]:
-            query = overpassQueryBuilder(bbox=[min_lat, min_long, max_lat, max_long],
-                                         selector=[f'"{selector}"'],
-                                         elementType='node',
-                                         out='body')
-            result = self.overpass.query(query, timeout=60)
-            if result.elements():
-                results = list(set(results + result.elements()))
+        query = self.__build_union_query([min_lat, min_long, max_lat, max_long], osm_selectors)
+        result = self.__overpass_query(query)
+
+        # a node can match several selectors, so de-duplicate by element id while streaming through the results.
         # https://github.com/mocnik-science/osm-python-tools/issues/39
+        results = []
+        seen = set()
+        for element in result.elements() or []:
+            element_key = (element.type(), element.id())
+            if element_key not in seen:
+                seen.add(element_key)
+                results.append(element)
         return results
 
+    def __overpass_query(self, query):
+        # the public Overpass instances allow a couple of slots per user, budgeted by the shared rate limit service
+        self.overpass_calls += 1
+        if self.overpass is None:
+            from OSMPythonTools.overpass import Overpass
+            self.overpass = Overpass()
+        lease_id = self.rate_limits.acquire("overpass", timeout=remaining_time())
+        try:
+            # Overpass stops the query at its timeout, which is cut short when the caller has a deadline, so the
+            # slot is given back once the caller stops waiting
+            remaining = remaining_time()
+            timeout = 60 if remaining is None else max(1, min(60, math.ceil(remaining)))
+            return self.overpass.query(query, timeout=timeout)
+        finally:
+            self.rate_limits.release("overpass", lease_id)
+
+    def __build_union_query(self, bbox, selectors):
+        # overpassQueryBuilder ANDs a list of selectors together, so build the union query by hand:
+        # (node["amenity"](bbox);node["shop"](bbox);...); out body;
+        # bbox is given as lat before long, matching overpassQueryBuilder, see __query_location.
+        bbox_string = ",".join(str(x) for x in bbox)
+        statements = "".join(f'node["{selector}"]({bbox_string});' for selector in selectors)
+        return f"({statements}); out body;"
+
     def __query_location(self, location_osm, location_name):
         # convert gps location to a gps bounding box
         min_long, min_lat, max_long, max_lat = self.__location_to_bounding_box(location_osm)
+        if self.offline_index:
+            elements = self.offline_index.query_name(min_lat, min_long, max_lat, max_long, location_name)
+            return elements[0] if elements else None
 
         # NOTE: this is why we aren't passing a completed bounding box object. For some reason,
         # overpassQueryBuilder breaks OSM standard and puts lat before long, reference:
         # https://github.com/mocnik-science/osm-python-tools/issues/14
         # full docs for this function: https://github.com/mocnik-science/osm-python-tools/blob/master/docs/overpass.md
-        query = overpassQueryBuilder(bbox=[min_lat, min_long, max_lat, max_long],
-                                     elementType='node',
-                                     selector=[f'"name"~"{location_name}"'],
-                                     out='body')
-        result = self.overpass.query(query, timeout=60)
+        query = overpass_query_builder(bbox=[min_lat, min_long, max_lat, max_long],
+                                       elementType='node',
+                                       selector=[f'"name"~"{location_name}"'],
+                                       out='body')
+        result = self.__overpass_query(query)
         # print(f"query complete for {location} with elements: {len(result.elements())}")
         for element in result.elements():
             if location_name in element.tag('name'):
@@ -114,21 +363,10 @@ class OSMTool:
         return min_long, min_lat, max_long, max_lat
 
     def __longitude_latitude_radius_to_bounding_box(self, longitude, latitude, radius):
-
-        radius_latitude = abs(radius / 111320) / 2
-        radius_longitude = abs(radius / (40075000 * math.cos(latitude) / 360)) / 2
-        # print(f"longitude : {radius_longitude} and latitude {radius_latitude}")
-
-        # print(location.raw)
-        min_lat = latitude - radius_latitude
-        max_lat = latitude + radius_latitude
-        min_long = longitude - radius_longitude
-        max_long = longitude + radius_longitude
-
+        # the box that holds the whole circle, radius meters either side of the point
         # box = left,bottom,right,top
         # bbox = min Longitude , min Latitude , max Longitude , max Latitude
-        # print(f"Output: {min_long},{min_lat},{max_long},{max_lat}")
-        return min_long, min_lat, max_long, max_lat
+        return radius_to_bounding_box(longitude, latitude, abs(radius))
 
 
     def __clean_decor_title(self, title):
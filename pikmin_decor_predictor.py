@@ -1,49 +1,163 @@
 from osm_tool import OSMTool
-from location_tool import LocationTool
-from foursquare_tool import FoursquareTool
-from google_places_tool import GooglePlacesTool
-from yelp_tool import YelpTool
 from decor_type import DecorType
 from dataset import Dataset
+from tile_cache import TileCache
+from request_deadline import run_with_deadline
 
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from datetime import datetime
-import json
-import pandas as pd
+import threading
+import time
+
+# how long predict waits on each data source, in seconds. Sources are queried concurrently, so a slow
+# source only costs its own timeout instead of delaying the others.
+provider_timeouts = {Dataset.osm: 90,
+                     Dataset.foursquare: 30,
+                     Dataset.google_places: 30,
+                     Dataset.yelp: 30}
+
+# how many data source lookups predict runs at once, across every call to predict_providers on a predictor. Lookups
+# past this wait their turn, and still time out from when they were asked for.
+predict_workers = 16
+
+# the columns each data source fills in during fill_in_data
+provider_columns = {Dataset.osm: ["OSM Data", "OSM Tags"],
+                    Dataset.foursquare: ["Foursquare Data"],
+                    Dataset.google_places: ["Google Places Data"],
+                    Dataset.yelp: ["Yelp Data"]}
+
+# the columns every data source reads to look up a row
+row_key_columns = ["Country", "State", "Suburb", "Location"]
+# the columns rows are geocoded by, rows that share them share a location
+location_key_columns = ["Country", "State", "Suburb"]
+
+provider_titles = {Dataset.osm: "OSM",
+                   Dataset.foursquare: "Foursquare",
+                   Dataset.google_places: "Google Places",
+                   Dataset.yelp: "Yelp"}
+
+def results_to_json(results):
+    # splits predict_providers' output into JSON friendly dicts of data source title to
+    # {place name: [decors]}, and data source title to error message.
+    predictions = {}
+    errors = {}
+    for dataset, (result, error) in results.items():
+        if error is not None:
+            errors[provider_titles[dataset]] = error
+        else:
+            predictions[provider_titles[dataset]] = {name: [x.value for x in decors] for name, decors in result.items()}
+    return predictions, errors
 
 class PikminDecorPredictor:
-    def __init__(self, osm_email=None, foursquare_key=None, google_places_key=None, yelp_key=None):
+    def __init__(self, osm_email=None, foursquare_key=None, google_places_key=None, yelp_key=None, osm_extract=None,
+                 geocoder_url=None, gazetteer_path=None, tile_cache_ttl=None):
         self.foursquare_key = foursquare_key
         self.google_places_key = google_places_key
         self.yelp_key = yelp_key
         self.osm_email = osm_email
 
+        # the geocoding and API data sources are only imported when they are enabled, so predicting a single point
+        # with OSM alone doesn't load them
         if osm_email:
-            self.location_tool = LocationTool(osm_email)
-        self.osm_tool = OSMTool()
+            from location_tool import LocationTool
+            self.location_tool = LocationTool(osm_email, geocoder_url, gazetteer_path)
+        self.osm_tool = OSMTool(osm_extract)
         if self.foursquare_enabled():
+            from foursquare_tool import FoursquareTool
             self.foursquare_tool = FoursquareTool(self.foursquare_key)
         if self.google_places_enabled():
+            from google_places_tool import GooglePlacesTool
             self.google_places_tool = GooglePlacesTool(self.google_places_key)
         if self.yelp_enabled():
+            from yelp_tool import YelpTool
             self.yelp_tool = YelpTool(self.yelp_key)
+        # predict lookups are only cached when a TTL (in seconds) is given
+        self.tile_cache = TileCache(ttl=tile_cache_ttl) if tile_cache_ttl else None
+        # created on the first predict, and shared by every predict after it
+        self.executor = None
+        self.executor_lock = threading.Lock()
 
-    def fill_in_data(self, data, debug_mode=False):
+    def fill_in_data(self, data, debug_mode=False, revalidation=None, checkpoint=None):
         print("Starting to fill in data, this my take a while...")
         # do a pass through the dataset and convert the suburb, city, country fields to a GPS coordinate.
-        self.location_tool.make_location_dict(data)
+        # geocoding runs over every remaining row at once, as the geocoder pool orders and deduplicates the
+        # locations across the whole dataset, and caches each one as soon as it is found.
+        self.__fill_in_stage("location",
+                             data,
+                             [],
+                             lambda chunk: self.location_tool.make_location_dict(chunk, revalidation=revalidation),
+                             checkpoint,
+                             chunked=False)
 
-        # do another pass through the dataset and fill in OSM data, if it can be found.
-        data = self.osm_tool.fill_in_data(data, self.location_tool)
-        # if the foursquare credentials are defined, do another pass through the
-        # dataset and fill in foursquare data, if it can be found.
-        if self.foursquare_enabled():
-            data = self.foursquare_tool.fill_in_data(data, self.location_tool, debug_mode=debug_mode)
-        if self.google_places_enabled():
-            data = self.google_places_tool.fill_in_data(data, self.location_tool, debug_mode=debug_mode)
-        if self.yelp_enabled():
-            data = self.yelp_tool.fill_in_data(data, self.location_tool, debug_mode=debug_mode)
+        # do a pass through the dataset per data source, each filling in its own columns if the data can be
+        # found. The passes are throttled independently, so they run at the same time, each on its own copy of
+        # the row keys, and their columns are merged back once every pass is done.
+        providers = self.enabled_providers()
+        executor = ThreadPoolExecutor(max_workers=len(providers))
+        futures = {}
+        for dataset, tool in providers:
+            columns = row_key_columns + [x for x in provider_columns[dataset] if x in data.columns]
+            fill = lambda chunk, tool=tool: tool.fill_in_data(chunk,
+                                                              self.location_tool,
+                                                              debug_mode=debug_mode,
+                                                              revalidation=revalidation)
+            futures[dataset] = executor.submit(self.__fill_in_stage,
+                                               dataset.value,
+                                               data[columns].copy(),
+                                               provider_columns[dataset],
+                                               fill,
+                                               checkpoint)
+        for dataset, future in futures.items():
+            provider_data = future.result()
+            for column in provider_columns[dataset]:
+                if column in provider_data.columns:
+                    data[column] = provider_data[column]
+        executor.shutdown()
+        return data
+
+    def __fill_in_stage(self, stage, data, columns, fill, checkpoint, chunked=True):
+        # runs fill over data, which fills in columns. With a checkpoint, rows the checkpoint has already seen
+        # finish this stage are restored from it, and the rest are filled in, in chunks of whole locations when
+        # chunked, marking each chunk in the checkpoint once it is done.
+        if checkpoint is None:
+            return fill(data)
+
+        values = checkpoint.completed(stage)
+        remaining = data[~data.index.isin(list(values))]
+        if len(values) > 0:
+            print(f"Resuming {stage}: {len(data.index) - len(remaining.index)} rows already done, "
+                  f"{len(remaining.index)} to go.")
+        chunks = self.__location_chunks(remaining, checkpoint.chunk_rows) if chunked else [remaining.index]
+        for chunk_index in chunks:
+            if len(chunk_index) == 0:
+                continue
+            chunk = fill(remaining.loc[chunk_index].copy())
+            chunk_values = {index: row_values for index, *row_values in zip(chunk.index,
+                                                                             *(chunk[x].tolist() for x in columns))}
+            # rows the data source skipped, IE once its quota ran out, aren't recorded, so a resume retries them
+            skipped_rows = set(chunk.attrs.get("skipped_rows", []))
+            checkpoint.mark(stage, {index: row_values for index, row_values in chunk_values.items()
+                                    if index not in skipped_rows})
+            values.update(chunk_values)
+
+        for position, column in enumerate(columns):
+            data[column] = [values[index][position] for index in data.index]
         return data
 
+    def __location_chunks(self, data, chunk_rows):
+        # splits data's index into chunks of at least chunk_rows rows, or whatever is left for the last one, keeping
+        # every row of a location in the same chunk
+        chunks = []
+        chunk = []
+        for location_index in data.groupby(location_key_columns, sort=False, dropna=False).indices.values():
+            chunk.extend(data.index[location_index])
+            if len(chunk) >= chunk_rows:
+                chunks.append(chunk)
+                chunk = []
+        if len(chunk) > 0:
+            chunks.append(chunk)
+        return chunks
+
     def predict_row(self, row, truth):
         osm_data = row["OSM Data"]
         foursquare_data = row["Foursquare Data"]
@@ -62,15 +176,15 @@ class PikminDecorPredictor:
         if osm_data:
             decors.extend(self.osm_tool.predict_row(osm_data, seedling_date, burger_shop_start_date))
         if foursquare_data and self.foursquare_enabled():
-            decors.extend(self.foursquare_tool.predict_row(json.loads(foursquare_data),
+            decors.extend(self.foursquare_tool.predict_row(foursquare_data,
                                                            seedling_date,
                                                            burger_shop_start_date))
         if google_places_data and self.google_places_enabled():
-            decors.extend(self.google_places_tool.predict_row(json.loads(google_places_data),
+            decors.extend(self.google_places_tool.predict_row(google_places_data,
                                                               seedling_date,
                                                               burger_shop_start_date))
         if yelp_data and self.yelp_enabled():
-            decors.extend(self.yelp_tool.predict_row(json.loads(yelp_data),
+            decors.extend(self.yelp_tool.predict_row(yelp_data,
                                                      seedling_date,
                                                      burger_shop_start_date))
         if len(decors) > 0:
@@ -79,6 +193,21 @@ class PikminDecorPredictor:
             return []
 
     def predict(self, longitude, latitude, radius, date, debug_mode):
+        results = self.predict_providers(longitude, latitude, radius, date, debug_mode)
+        for dataset, (result, error) in results.items():
+            print(f"\n{provider_titles[dataset]} Results:")
+            if error is not None:
+                print(f"ERROR: {error}")
+            else:
+                self.pretty_print_dict(result)
+            print(f"==========================")
+
+    def predict_providers(self, longitude, latitude, radius, date, debug_mode=False, timeouts=None):
+        # queries every enabled data source at the same time, and returns a dict of dataset to
+        # (predictions, error) in a stable order: OSM, Foursquare, Google Places, then Yelp.
+        if timeouts is None:
+            timeouts = provider_timeouts
+
         # convert date to integer
         if not date:
             seedling_date = datetime.now().timestamp()
@@ -88,43 +217,73 @@ class PikminDecorPredictor:
         # convert the date that burger_shop went live to an integer
         burger_shop_start_date = datetime.strptime("12/18/2021", '%m/%d/%Y').timestamp()
 
-        print(f"\nOSM Results:")
-        self.pretty_print_dict(self.osm_tool.predict(longitude=longitude,
-                                                     latitude=latitude,
-                                                     radius=radius,
-                                                     seedling_date=seedling_date,
-                                                     burger_shop_start_date=burger_shop_start_date,
-                                                     debug_mode=debug_mode))
-        print(f"==========================")
+        providers = self.enabled_providers()
+        executor = self.__get_executor()
+        start_time = time.monotonic()
+        futures = {}
+        for dataset, tool in providers:
+            if self.tile_cache:
+                predict = lambda tool=tool, dataset=dataset, **kwargs: self.__predict_tiled(dataset, tool, **kwargs)
+            else:
+                predict = tool.predict
+            # every request the lookup makes is cut off at its timeout, so a lookup that timed out stops soon after
+            # and gives its worker and rate limit lease back
+            futures[dataset] = executor.submit(run_with_deadline,
+                                               start_time + timeouts[dataset],
+                                               predict,
+                                               longitude=longitude,
+                                               latitude=latitude,
+                                               radius=radius,
+                                               seedling_date=seedling_date,
+                                               burger_shop_start_date=burger_shop_start_date,
+                                               debug_mode=debug_mode)
+        results = {}
+        for dataset, future in futures.items():
+            # every source started at the same time, so each timeout is measured from the start.
+            remaining = max(0.0, timeouts[dataset] - (time.monotonic() - start_time))
+            try:
+                results[dataset] = (future.result(timeout=remaining), None)
+            except TimeoutError:
+                # lookups still waiting for a worker are dropped, running ones stop at their deadline
+                future.cancel()
+                results[dataset] = (None, f"timed out after {timeouts[dataset]}s")
+            except Exception as e:
+                results[dataset] = (None, f"{type(e).__name__}: {e}")
+        return results
+
+    def __predict_tiled(self, dataset, tool, longitude, latitude, radius, seedling_date, burger_shop_start_date,
+                        debug_mode=False):
+        # same as tool.predict, but the POIs come from the tile cache, which only queries tiles it doesn't have
+        pois = self.tile_cache.query(dataset.value, tool.query_pois, longitude, latitude, radius, tool.max_radius)
+        return tool.predict_pois(pois, seedling_date, burger_shop_start_date, debug_mode)
+
+    def __get_executor(self):
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=predict_workers)
+            return self.executor
+
+    def enabled_providers(self):
+        providers = [(Dataset.osm, self.osm_tool)]
         if self.foursquare_enabled():
-            print(f"\nFoursquare Results:")
-            self.pretty_print_dict(self.foursquare_tool.predict(longitude=longitude,
-                                                                latitude=latitude,
-                                                                radius=radius,
-                                                                seedling_date=seedling_date,
-                                                                burger_shop_start_date=burger_shop_start_date,
-                                                                debug_mode=debug_mode))
-            print(f"==========================")
+            providers.append((Dataset.foursquare, self.foursquare_tool))
         if self.google_places_enabled():
-            print(f"\nGoogle Places Results:")
-            self.pretty_print_dict(self.google_places_tool.predict(longitude=longitude,
-                                                                   latitude=latitude,
-                                                                   radius=radius,
-                                                                   seedling_date=seedling_date,
-                                                                   burger_shop_start_date=burger_shop_start_date,
-                                                                   debug_mode=debug_mode))
-            print(f"==========================")
+            providers.append((Dataset.google_places, self.google_places_tool))
         if self.yelp_enabled():
-            print(f"\nYelp Results:")
-            self.pretty_print_dict(self.yelp_tool.predict(longitude=longitude,
-                                                          latitude=latitude,
-                                                          radius=radius,
-                                                          seedling_date=seedling_date,
-                                                          burger_shop_start_date=burger_shop_start_date,
-                                                          debug_mode=debug_mode))
-            print(f"==========================")
+            providers.append((Dataset.yelp, self.yelp_tool))
+        return providers
+
+    def predict_dataset(self, data, truth, debug_mode=False, batch_mode=False):
+        # imported here since only the dataset flows need pandas, the single point predictions don't
+        import pandas as pd
+        if batch_mode:
+            # imported here since only batch scoring needs scipy
+            from batch_scorer import BatchScorer
+            scorer = BatchScorer(self.foursquare_enabled(), self.google_places_enabled(), self.yelp_enabled())
+            decor_predictions, usage_dict = scorer.score(data, [truth[index] for index in data.index])
+            self.print_tag_usage(usage_dict)
+            return pd.DataFrame(decor_predictions, columns=['Decor'])
 
-    def predict_dataset(self, data, truth, debug_mode=False):
         # initialize list for predictions output
         decor_predictions = []
         usage_dict = {Dataset.osm: {},
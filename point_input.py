@@ -0,0 +1,54 @@
+from datetime import datetime
+import argparse
+
+# Parsing of the points the scripts predict, shared by the command line options and the prediction service.
+
+
+def parse_point(point, default_radius, default_date, max_radius=None):
+    # returns (latitude, longitude, radius, date) of a point dict, raising ValueError, TypeError, KeyError or
+    # argparse.ArgumentTypeError if any of them is missing or invalid
+    latitude = range_limited_latitude_type(point["latitude"])
+    longitude = range_limited_longitude_type(point["longitude"])
+    radius = int(point.get("radius") or default_radius)
+    if radius <= 0:
+        raise argparse.ArgumentTypeError("radius must be above 0")
+    if max_radius is not None and radius > max_radius:
+        raise argparse.ArgumentTypeError(f"radius must be at most {max_radius}")
+    date = point.get("date") or default_date
+    if date:
+        # checked here, so a bad date is reported as an invalid point rather than failing every data source
+        datetime.strptime(date, '%m/%d/%Y')
+    return latitude, longitude, radius, date
+
+
+def range_limited_longitude_type(arg):
+    min_val = -180.0
+    max_val = 180.0
+    try:
+        f = float(arg)
+    except (TypeError, ValueError):
+        raise argparse.ArgumentTypeError("Must be a floating point number")
+    if f < min_val or f > max_val:
+        raise argparse.ArgumentTypeError("Argument must be <= " + str(max_val) + " and >= " + str(min_val))
+    return f
+
+
+def range_limited_latitude_type(arg):
+    min_val = -90.0
+    max_val = 90.0
+    try:
+        f = float(arg)
+    except (TypeError, ValueError):
+        raise argparse.ArgumentTypeError("Must be a floating point number")
+    if f < min_val or f > max_val:
+        raise argparse.ArgumentTypeError("Argument must be <= " + str(max_val) + " and >= " + str(min_val))
+    return f
+
+
+def date_type(arg):
+    # a m/d/Y date, kept as the string the predictors take
+    try:
+        datetime.strptime(arg, '%m/%d/%Y')
+    except ValueError:
+        raise argparse.ArgumentTypeError("Must be a date formatted as m/d/Y, IE 12/18/2021")
+    return arg
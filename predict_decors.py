@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 
-from pikmin_decor_predictor import PikminDecorPredictor
+from pikmin_decor_predictor import PikminDecorPredictor, results_to_json
+from single_flight import single_flight_stats
+from point_input import date_type, parse_point, range_limited_latitude_type, range_limited_longitude_type
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 import argparse
+import csv
+import json
+import sys
 
 def cli_to_args():
     """
@@ -15,21 +21,39 @@ def cli_to_args():
     cli.add_argument('-latitude',
                      type=range_limited_latitude_type,
                      default=None,
-                     required=True,
-                     help='Latitude for where to look for decors. Must be a value between -90.0 and 90.0')
+                     help='Latitude for where to look for decors. Must be a value between -90.0 and 90.0. \
+                     Required unless -input is given.')
     cli.add_argument('-longitude',
                      type=range_limited_longitude_type,
                      default=None,
-                     required=True,
-                     help='Longitude for where to look for decors. Must be a value between -180.0 and 180.')
+                     help='Longitude for where to look for decors. Must be a value between -180.0 and 180. \
+                     Required unless -input is given.')
     cli.add_argument('-radius',
                      type=int, default=150,
                      help='Radius for how far to predict the decors. Given in meters, each dataset has its own rules as '
                           'to how large this radius can be.')
     cli.add_argument('-date',
-                     type=int, default=None,
+                     type=date_type, default=None,
                      help='Date formatted as m/d/Y, IE 12/18/2021.')
+    cli.add_argument('-input',
+                     type=str, default=None,
+                     help='Predict every point in this CSV or JSONL file instead of a single point, use - to read \
+                     JSONL from stdin. Each point needs a latitude and longitude, and can have its own radius and \
+                     date, the -radius and -date options are used otherwise. Any other fields are copied to the \
+                     output. Points that can\'t be read or predicted get an error field instead of results.')
+    cli.add_argument('-output',
+                     type=str, default=None,
+                     help='With -input, write one JSON line per point to this file instead of stdout, in the order \
+                     the points finish.')
+    cli.add_argument('-workers',
+                     type=int, default=8,
+                     help='With -input, how many points are predicted at the same time. Every data source is still \
+                     held to its own rate limit.')
 
+    cli.add_argument('-osm_extract',
+                     type=str, default=None,
+                     help='Optional path to a local OpenStreetMap extract (.osm.pbf or .osm). When given, OSM data is \
+                     read from an index built from this file instead of querying Overpass.')
     cli.add_argument('-foursquare_api_key',
                      type=str, default=None,
                      help='Required to enable foursquare data. Requires a Foursquare developer account to generate. \
@@ -43,34 +67,106 @@ def cli_to_args():
                      help='Required to enable Yelp data. Requires a Yelp developer account to generate. \
                      Without this option, Yelp is skipped')
 
+    cli.add_argument('-cache_hours',
+                     type=float, default=0,
+                     help='How many hours the results of each data source are cached for, per map tile, so repeated \
+                     and nearby lookups don\'t query the data sources again. Off by default, as a lookup that isn\'t \
+                     cached yet costs one query per tile it covers, usually 9 to 16, instead of one. Only worth it \
+                     when the same area is looked up many times.')
     cli.add_argument('-debug',
                      default=False, action="store_true",
                      help='Add this flag to print extra debug info.')
     return cli.parse_args()
 
 
-def range_limited_longitude_type(arg):
-    min_val = -180.0
-    max_val = 180.0
+def read_points(input_path):
+    # yields (line number, point dict, error) for every point in a CSV or JSONL file, or JSONL from stdin, without
+    # reading the whole file at once. error is None, or why the line couldn't be read as a point.
+    if input_path == "-":
+        handle = sys.stdin
+    else:
+        handle = open(input_path, newline='')
+    try:
+        if input_path.endswith(".csv"):
+            for line_number, point in enumerate(csv.DictReader(handle), start=2):
+                yield line_number, point, None
+        else:
+            for line_number, line in enumerate(handle, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    point = json.loads(line)
+                except ValueError as e:
+                    yield line_number, None, f"invalid JSON: {e}"
+                    continue
+                if isinstance(point, dict):
+                    yield line_number, point, None
+                else:
+                    yield line_number, None, "invalid JSON: expected an object"
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+
+
+def predict_point(decor_predictor, point, args):
+    # predicts a single point from -input, returning the JSON line for it. Errors are reported in the line, so one
+    # bad point doesn't stop the rest.
+    output = dict(point)
+    try:
+        latitude, longitude, radius, date = parse_point(point, args.radius, args.date)
+    except (KeyError, ValueError, TypeError, argparse.ArgumentTypeError) as e:
+        output["error"] = f"invalid point: {type(e).__name__}: {e}"
+        return json.dumps(output)
     try:
-        f = float(arg)
-    except ValueError:
-        raise argparse.ArgumentTypeError("Must be a floating point number")
-    if f < min_val or f > max_val:
-        raise argparse.ArgumentTypeError("Argument must be <= " + str(max_val) + " and >= " + str(min_val))
-    return f
+        results = decor_predictor.predict_providers(longitude, latitude, radius, date, debug_mode=args.debug)
+    except Exception as e:
+        output["error"] = f"{type(e).__name__}: {e}"
+        return json.dumps(output)
+    output["results"], output["errors"] = results_to_json(results)
+    return json.dumps(output)
 
 
-def range_limited_latitude_type(arg):
-    min_val = -90.0
-    max_val = 90.0
+def predict_points(decor_predictor, args):
+    # predicts every point in -input with one predictor, so its caches and connections are shared, and streams
+    # each result out as soon as it is done. Only a few points per worker are read ahead, so memory stays flat
+    # however long the input is.
+    output = open(args.output, 'w') if args.output else sys.stdout
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    in_flight = set()
+    count = 0
     try:
-        f = float(arg)
-    except ValueError:
-        raise argparse.ArgumentTypeError("Must be a floating point number")
-    if f < min_val or f > max_val:
-        raise argparse.ArgumentTypeError("Argument must be <= " + str(max_val) + " and >= " + str(min_val))
-    return f
+        for line_number, point, error in read_points(args.input):
+            if error is not None:
+                output.write(json.dumps({"line": line_number, "error": error}) + "\n")
+                count += 1
+                continue
+            if len(in_flight) >= args.workers * 2:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                count += write_results(done, output)
+            in_flight.add(executor.submit(predict_point, decor_predictor, point, args))
+            # also write whatever else has finished, so it is on disk even if the run is stopped
+            done = {x for x in in_flight if x.done()}
+            in_flight -= done
+            count += write_results(done, output)
+        count += write_results(in_flight, output)
+        in_flight = set()
+    finally:
+        # when the run is stopped, keep the points that finished, the ones still in flight are lost
+        count += write_results({x for x in in_flight if x.done()}, output)
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=False)
+        if output is not sys.stdout:
+            output.close()
+    saved_calls = sum(x["saved_calls"] for x in single_flight_stats().values())
+    print(f"Predicted {count} points, {saved_calls} data source queries were shared between points.", file=sys.stderr)
+
+
+def write_results(futures, output):
+    for future in as_completed(futures):
+        output.write(future.result() + "\n")
+    output.flush()
+    return len(futures)
 
 
 if __name__ == '__main__':
@@ -78,7 +174,15 @@ if __name__ == '__main__':
 
     decor_predictor = PikminDecorPredictor(foursquare_key=args.foursquare_api_key,
                                            google_places_key=args.google_places_api_key,
-                                           yelp_key=args.yelp_api_key)
+                                           yelp_key=args.yelp_api_key,
+                                           osm_extract=args.osm_extract,
+                                           tile_cache_ttl=args.cache_hours * 3600)
+
+    if args.input:
+        predict_points(decor_predictor, args)
+        sys.exit(0)
+    if args.latitude is None or args.longitude is None:
+        raise Exception("Invalid CLI arguments. Either provide a latitude and a longitude, or an input file.")
 
     print(f"Predicting Latitude:{args.latitude} Longitude:{args.longitude} Radius:{args.radius}m")
     decor_predictor.predict(latitude=args.latitude,
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+from pikmin_decor_predictor import PikminDecorPredictor
+from region_grid import RegionGrid, fetch_region_pois, score_region, write_geojson, write_raster
+from point_input import date_type, range_limited_latitude_type, range_limited_longitude_type
+from datetime import datetime
+from pathlib import Path
+import argparse
+import time
+
+def cli_to_args():
+    """
+    converts the command line interface to a series of args
+    """
+    cli = argparse.ArgumentParser(description="Script that takes a bounding box, splits it into a grid of cells, and "
+                                              "counts the potential Pikmin Bloom decors in each cell, to map decor "
+                                              "coverage across a whole area. API keys from developer accounts must "
+                                              "be given to query data sources such as Foursquare and Yelp.")
+    cli.add_argument('-min_latitude',
+                     type=range_limited_latitude_type, required=True,
+                     help='Southern edge of the area. Must be a value between -90.0 and 90.0')
+    cli.add_argument('-min_longitude',
+                     type=range_limited_longitude_type, required=True,
+                     help='Western edge of the area. Must be a value between -180.0 and 180.')
+    cli.add_argument('-max_latitude',
+                     type=range_limited_latitude_type, required=True,
+                     help='Northern edge of the area. Must be a value between -90.0 and 90.0')
+    cli.add_argument('-max_longitude',
+                     type=range_limited_longitude_type, required=True,
+                     help='Eastern edge of the area. Must be a value between -180.0 and 180.')
+    cli.add_argument('-cell_size',
+                     type=int, default=250,
+                     help='Width of each grid cell, in meters.')
+    cli.add_argument('-date',
+                     type=date_type, default=None,
+                     help='Date formatted as m/d/Y, IE 12/18/2021. Defaults to today.')
+    cli.add_argument('-output_file',
+                     type=str, default='output/region.geojson',
+                     help='Output file. A .geojson file gets one polygon per cell with its decor counts, a .npz file '
+                          'gets a compressed numpy raster of counts per cell and decor.')
+    cli.add_argument('-workers',
+                     type=int, default=None,
+                     help='How many processes score the cells. Defaults to the number of CPUs.')
+
+    cli.add_argument('-osm_extract',
+                     type=str, default=None,
+                     help='Optional path to a local OpenStreetMap extract (.osm.pbf or .osm). When given, OSM data is \
+                     read from an index built from this file instead of querying Overpass.')
+    cli.add_argument('-foursquare_api_key',
+                     type=str, default=None,
+                     help='Required to enable foursquare data. Requires a Foursquare developer account to generate. \
+                     Without this option, foursquare is skipped')
+    cli.add_argument('-google_places_api_key',
+                     type=str, default=None,
+                     help='Required to enable Google Places data. Requires a Google Places developer account to generate. \
+                     Without this option, Google Places is skipped')
+    cli.add_argument('-yelp_api_key',
+                     type=str, default=None,
+                     help='Required to enable Yelp data. Requires a Yelp developer account to generate. \
+                     Without this option, Yelp is skipped')
+    cli.add_argument('-cache_hours',
+                     type=float, default=24,
+                     help='How many hours the results of each data source are cached for, per map tile, so areas \
+                     that overlap earlier runs don\'t query the data sources again. The region is fetched one tile \
+                     at a time either way, so the cache costs no extra queries. Set to 0 to disable the cache.')
+
+    cli.add_argument('-debug',
+                     default=False, action="store_true",
+                     help='Add this flag to print extra debug info.')
+    return cli.parse_args()
+
+
+if __name__ == '__main__':
+    args = cli_to_args()
+    if args.min_latitude >= args.max_latitude or args.min_longitude >= args.max_longitude:
+        raise Exception("Invalid CLI arguments. The minimum latitude and longitude must be below the maximums.")
+
+    predictor_keys = {"foursquare_key": args.foursquare_api_key,
+                      "google_places_key": args.google_places_api_key,
+                      "yelp_key": args.yelp_api_key}
+    decor_predictor = PikminDecorPredictor(osm_extract=args.osm_extract,
+                                           tile_cache_ttl=args.cache_hours * 3600,
+                                           **predictor_keys)
+    grid = RegionGrid(args.min_latitude, args.min_longitude, args.max_latitude, args.max_longitude, args.cell_size)
+    date = args.date if args.date else datetime.now().strftime('%m/%d/%Y')
+
+    start_time = time.monotonic()
+    print(f"Predicting {grid.rows}x{grid.columns} cells of {args.cell_size}m...")
+    cell_pois = fetch_region_pois(decor_predictor, grid, debug_mode=args.debug)
+    print(f"Fetched {sum(len(x) for x in cell_pois.values())} POIs in {round(time.monotonic() - start_time)}s, "
+          f"scoring...")
+    counts = score_region(cell_pois, date, predictor_keys, workers=args.workers)
+
+    Path(args.output_file).parent.mkdir(parents=True, exist_ok=True)
+    if args.output_file.endswith(".npz"):
+        write_raster(grid, counts, args.output_file)
+    else:
+        write_geojson(grid, counts, args.output_file)
+    print(f"{len(counts)} of {grid.rows * grid.columns} cells have decors, written to {args.output_file} "
+          f"in {round(time.monotonic() - start_time)}s.")
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+from pikmin_decor_predictor import PikminDecorPredictor, results_to_json
+from single_flight import single_flight_stats
+from point_input import parse_point
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from collections import deque
+from urllib.parse import urlparse, parse_qs
+import argparse
+import json
+import os
+import threading
+import time
+
+# how many recent requests per endpoint the latency percentiles are computed from
+latency_window = 10000
+
+
+class LatencyStats:
+    # request count, error count and latency percentiles per endpoint, over the last latency_window requests
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, seconds, failed):
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, {"count": 0, "errors": 0,
+                                                         "latencies": deque(maxlen=latency_window)})
+            stats["count"] += 1
+            if failed:
+                stats["errors"] += 1
+            stats["latencies"].append(seconds)
+
+    def summary(self):
+        with self.lock:
+            summary = {}
+            for endpoint, stats in self.endpoints.items():
+                latencies = sorted(stats["latencies"])
+                summary[endpoint] = {"count": stats["count"],
+                                     "errors": stats["errors"],
+                                     "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+                                     "p50_ms": round(self.__percentile(latencies, 0.5) * 1000, 2),
+                                     "p95_ms": round(self.__percentile(latencies, 0.95) * 1000, 2),
+                                     "p99_ms": round(self.__percentile(latencies, 0.99) * 1000, 2),
+                                     "max_ms": round(latencies[-1] * 1000, 2)}
+            return summary
+
+    def __percentile(self, latencies, fraction):
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+class PredictionService:
+    # Keeps one PikminDecorPredictor loaded, with its data sources, tag indexes, HTTP sessions and caches, and
+    # answers predictions over HTTP as JSON, so each request only pays for the lookup itself. Requests are handled
+    # on their own threads, with every data source still held to its rate limit.
+    #   GET /predict?latitude=..&longitude=..[&radius=..&date=m/d/Y], or POST /predict with the same fields as JSON
+    #   GET /stats for request counts and latency percentiles per endpoint, and how many data source queries were
+    #   shared between concurrent requests
+    #   GET /health
+    def __init__(self, decor_predictor, default_radius=150, max_radius=50000):
+        self.decor_predictor = decor_predictor
+        self.default_radius = default_radius
+        # larger lookups would fan out into thousands of tile queries, so they are refused
+        self.max_radius = max_radius
+        self.stats = LatencyStats()
+        self.started = time.time()
+
+    def handle(self, method, path, body):
+        # returns (status code, JSON response) for a request
+        url = urlparse(path)
+        if url.path == "/predict" and method in ("GET", "POST"):
+            if method == "POST":
+                try:
+                    point = json.loads(body or b"{}")
+                except ValueError as e:
+                    return 400, {"error": f"invalid JSON body: {e}"}
+            else:
+                point = {key: values[0] for key, values in parse_qs(url.query).items()}
+            return self.predict(point)
+        if url.path == "/stats" and method == "GET":
+            return 200, {"uptime_seconds": round(time.time() - self.started),
+                         "endpoints": self.stats.summary(),
+                         "single_flight": single_flight_stats()}
+        if url.path == "/health" and method == "GET":
+            return 200, {"status": "ok"}
+        return 404, {"error": f"unknown endpoint {method} {url.path}"}
+
+    def predict(self, point):
+        try:
+            latitude, longitude, radius, date = parse_point(point, self.default_radius, None, self.max_radius)
+        except (KeyError, ValueError, TypeError, argparse.ArgumentTypeError) as e:
+            return 400, {"error": f"invalid point: {type(e).__name__}: {e}"}
+        results = self.decor_predictor.predict_providers(longitude, latitude, radius, date)
+        predictions, errors = results_to_json(results)
+        return 200, {"latitude": latitude,
+                     "longitude": longitude,
+                     "radius": radius,
+                     "date": date,
+                     "results": predictions,
+                     "errors": errors}
+
+    def make_handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.__respond("GET", b"")
+
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                    if length < 0:
+                        raise ValueError("must not be negative")
+                except ValueError as e:
+                    # the body can't be skipped without its length, so the connection is closed after answering
+                    self.close_connection = True
+                    self.__respond("POST", b"", invalid_request=f"invalid Content-Length: {e}")
+                    return
+                self.__respond("POST", self.rfile.read(length))
+
+            def __respond(self, method, body, invalid_request=None):
+                start_time = time.perf_counter()
+                try:
+                    if invalid_request:
+                        status, response = 400, {"error": invalid_request}
+                    else:
+                        status, response = service.handle(method, self.path, body)
+                except Exception as e:
+                    status, response = 500, {"error": f"{type(e).__name__}: {e}"}
+                content = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+                # unknown endpoints share one entry, so stray paths can't grow the stats
+                endpoint = f"{method} {urlparse(self.path).path}" if status != 404 else "unknown"
+                service.stats.record(endpoint, time.perf_counter() - start_time, status >= 500)
+
+            def address_string(self):
+                # unix socket clients have no address
+                return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def cli_to_args():
+    """
+    converts the command line interface to a series of args
+    """
+    cli = argparse.ArgumentParser(description="Local service that keeps the decor predictor loaded and answers "
+                                              "predictions over HTTP as JSON, IE "
+                                              "GET /predict?latitude=-31.95&longitude=115.86. GET /stats reports "
+                                              "latency per endpoint.")
+    cli.add_argument('-host',
+                     type=str, default='127.0.0.1',
+                     help='Address to listen on.')
+    cli.add_argument('-port',
+                     type=int, default=8765,
+                     help='Port to listen on.')
+    cli.add_argument('-unix_socket',
+                     type=str, default=None,
+                     help='Listen on this Unix socket path instead of a TCP port.')
+    cli.add_argument('-radius',
+                     type=int, default=150,
+                     help='Radius used when a request doesn\'t give one, in meters.')
+    cli.add_argument('-max_radius',
+                     type=int, default=50000,
+                     help='Largest radius a request can ask for, in meters. Larger ones are refused.')
+
+    cli.add_argument('-osm_extract',
+                     type=str, default=None,
+                     help='Optional path to a local OpenStreetMap extract (.osm.pbf or .osm). When given, OSM data is \
+                     read from an index built from this file instead of querying Overpass.')
+    cli.add_argument('-foursquare_api_key',
+                     type=str, default=None,
+                     help='Required to enable foursquare data. Requires a Foursquare developer account to generate. \
+                     Without this option, foursquare is skipped')
+    cli.add_argument('-google_places_api_key',
+                     type=str, default=None,
+                     help='Required to enable Google Places data. Requires a Google Places developer account to generate. \
+                     Without this option, Google Places is skipped')
+    cli.add_argument('-yelp_api_key',
+                     type=str, default=None,
+                     help='Required to enable Yelp data. Requires a Yelp developer account to generate. \
+                     Without this option, Yelp is skipped')
+    cli.add_argument('-cache_hours',
+                     type=float, default=0,
+                     help='How many hours the results of each data source are cached for, per map tile, so repeated \
+                     and nearby lookups don\'t query the data sources again. Off by default, as a lookup that isn\'t \
+                     cached yet costs one query per tile it covers, usually 9 to 16, instead of one. Only worth it \
+                     when the same area is looked up many times.')
+    return cli.parse_args()
+
+
+if __name__ == '__main__':
+    args = cli_to_args()
+
+    decor_predictor = PikminDecorPredictor(foursquare_key=args.foursquare_api_key,
+                                           google_places_key=args.google_places_api_key,
+                                           yelp_key=args.yelp_api_key,
+                                           osm_extract=args.osm_extract,
+                                           tile_cache_ttl=args.cache_hours * 3600)
+    service = PredictionService(decor_predictor, default_radius=args.radius, max_radius=args.max_radius)
+
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, service.make_handler())
+        print(f"Serving predictions on {args.unix_socket}")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), service.make_handler())
+        print(f"Serving predictions on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix_socket and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
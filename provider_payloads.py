@@ -0,0 +1,150 @@
+from osm_element import OSMElement
+
+# Enriched rows keep a compact payload per data source instead of the raw API response: the name, the
+# categories/types/aliases the predictors match on, and coordinates. The payloads keep the shape of the raw
+# responses ("categories" of {"name"} or {"alias"}, "types"), so the predictors read both the same way. The full
+# responses stay in the caches, so fields can be added here later without querying anything again.
+#
+# For storage, the payload columns are converted to flat typed columns (see to_columnar), which are written to
+# Parquet without any JSON in between.
+
+# version of the enriched dataset files written by save_payloads. Bump it whenever the columns or payloads change
+# shape, so older files are rejected instead of being read wrong.
+enriched_schema_version = 1
+enriched_schema_key = b"pikmin_decor_schema_version"
+
+
+def compact_foursquare(result):
+    # https://developer.foursquare.com/reference/response-fields
+    geocode = result.get("geocodes", {}).get("main", {})
+    return {"id": result.get("fsq_id"),
+            "name": result.get("name"),
+            "categories": [{"name": category["name"]} for category in result.get("categories", [])
+                           if "name" in category],
+            "latitude": geocode.get("latitude"),
+            "longitude": geocode.get("longitude")}
+
+
+def compact_google_places(result):
+    location = result.get("geometry", {}).get("location", {})
+    return {"id": result.get("place_id"),
+            "name": result.get("name"),
+            "types": list(result.get("types", [])),
+            "latitude": location.get("lat"),
+            "longitude": location.get("lng")}
+
+
+def compact_yelp(result):
+    coordinates = result.get("coordinates") or {}
+    return {"id": result.get("id"),
+            "name": result.get("name"),
+            "categories": [{"alias": category["alias"]} for category in result.get("categories", [])
+                           if "alias" in category],
+            "latitude": coordinates.get("latitude"),
+            "longitude": coordinates.get("longitude")}
+
+
+# payload column -> (column prefix, name of the list field, key inside each list entry or None for plain strings)
+payload_list_fields = {"Foursquare Data": ("foursquare", "categories", "name"),
+                       "Google Places Data": ("google_places", "types", None),
+                       "Yelp Data": ("yelp", "categories", "alias")}
+
+
+def to_columnar(df):
+    # flattens the payload columns into typed columns: <prefix>_id, _name, _latitude, _longitude and a list column
+    # of category names/types/aliases for the APIs, and osm_id, _type, _latitude, _longitude plus parallel lists of
+    # tag keys and values for OSM. Every other column is kept as is.
+    columnar = df.drop(columns=["OSM Data", "OSM Tags"] + list(payload_list_fields), errors="ignore").copy()
+
+    osm_payloads = df["OSM Data"].tolist()
+    columnar["osm_id"] = [x.id() if x else None for x in osm_payloads]
+    columnar["osm_type"] = [x.type() if x else None for x in osm_payloads]
+    columnar["osm_latitude"] = [x.lat() if x else None for x in osm_payloads]
+    columnar["osm_longitude"] = [x.lon() if x else None for x in osm_payloads]
+    columnar["osm_tag_keys"] = [list(x.tags().keys()) if x else None for x in osm_payloads]
+    columnar["osm_tag_values"] = [list(x.tags().values()) if x else None for x in osm_payloads]
+
+    for column, (prefix, list_field, entry_key) in payload_list_fields.items():
+        payloads = df[column].tolist()
+        columnar[f"{prefix}_id"] = [x["id"] if x else None for x in payloads]
+        columnar[f"{prefix}_name"] = [x["name"] if x else None for x in payloads]
+        columnar[f"{prefix}_latitude"] = [x["latitude"] if x else None for x in payloads]
+        columnar[f"{prefix}_longitude"] = [x["longitude"] if x else None for x in payloads]
+        if entry_key is None:
+            columnar[f"{prefix}_{list_field}"] = [list(x[list_field]) if x else None for x in payloads]
+        else:
+            columnar[f"{prefix}_{list_field}"] = [[entry[entry_key] for entry in x[list_field]] if x else None
+                                                  for x in payloads]
+    return columnar
+
+
+def from_columnar(columnar):
+    # rebuilds the payload columns from to_columnar's output
+    df = columnar.drop(columns=[x for x in columnar.columns if x.startswith(("osm_", "foursquare_", "google_places_",
+                                                                             "yelp_"))]).copy()
+
+    osm_payloads = []
+    osm_columns = zip(columnar["osm_id"].tolist(),
+                      columnar["osm_type"].tolist(),
+                      columnar["osm_latitude"].tolist(),
+                      columnar["osm_longitude"].tolist(),
+                      columnar["osm_tag_keys"].tolist(),
+                      columnar["osm_tag_values"].tolist())
+    for element_id, element_type, latitude, longitude, keys, values in osm_columns:
+        if keys is None:
+            osm_payloads.append(None)
+        else:
+            osm_payloads.append(OSMElement(int(element_id), element_type, dict(zip(map(str, keys), map(str, values))),
+                                           value_or_none(latitude), value_or_none(longitude)))
+    df["OSM Data"] = osm_payloads
+    df["OSM Tags"] = [str(x.tags()) if x else None for x in osm_payloads]
+
+    for column, (prefix, list_field, entry_key) in payload_list_fields.items():
+        payloads = []
+        provider_columns = zip(columnar[f"{prefix}_id"].tolist(),
+                               columnar[f"{prefix}_name"].tolist(),
+                               columnar[f"{prefix}_latitude"].tolist(),
+                               columnar[f"{prefix}_longitude"].tolist(),
+                               columnar[f"{prefix}_{list_field}"].tolist())
+        for payload_id, name, latitude, longitude, entries in provider_columns:
+            if entries is None:
+                payloads.append(None)
+                continue
+            if entry_key is None:
+                entries = [str(entry) for entry in entries]
+            else:
+                entries = [{entry_key: str(entry)} for entry in entries]
+            payloads.append({"id": payload_id,
+                             "name": name,
+                             list_field: entries,
+                             "latitude": value_or_none(latitude),
+                             "longitude": value_or_none(longitude)})
+        df[column] = payloads
+    return df
+
+
+def save_payloads(df, path, compression="zstd"):
+    # writes an enriched dataset as compressed Parquet, with the schema version in the file metadata
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pa.Table.from_pandas(to_columnar(df), preserve_index=True)
+    metadata = dict(table.schema.metadata or {})
+    metadata[enriched_schema_key] = str(enriched_schema_version).encode()
+    pq.write_table(table.replace_schema_metadata(metadata), path, compression=compression)
+
+
+def load_payloads(path):
+    import pyarrow.parquet as pq
+    table = pq.read_table(path)
+    version = (table.schema.metadata or {}).get(enriched_schema_key)
+    if version is None or int(version) != enriched_schema_version:
+        raise Exception(f"{path} is not an enriched dataset with schema version {enriched_schema_version} "
+                        f"(found {version.decode() if version else 'none'}), run the enrichment again to rebuild it.")
+    return from_columnar(table.to_pandas())
+
+
+def value_or_none(value):
+    # parquet gives missing numbers back as NaN
+    if value is None or value != value:
+        return None
+    return value
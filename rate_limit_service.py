@@ -0,0 +1,167 @@
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import os.path
+import sqlite3
+import threading
+import time
+
+# named budgets per data source. per_second is the sustained request rate, daily_quota is the number of
+# requests allowed per UTC day (None for no quota), and concurrency is how many requests may be in flight
+# across every process sharing the rate limit database.
+provider_budgets = {
+    "foursquare": {"per_second": 10, "daily_quota": None, "concurrency": 10},
+    "google_places": {"per_second": 10, "daily_quota": None, "concurrency": 10},
+    "yelp": {"per_second": 10, "daily_quota": 5000, "concurrency": 10},
+    # https://operations.osmfoundation.org/policies/nominatim/
+    "nominatim": {"per_second": 1 / 1.5, "daily_quota": None, "concurrency": 1},
+    # a Nominatim instance run for this tool (see -geocoder_url), which can take far more load than the public one
+    "nominatim_self_hosted": {"per_second": 20, "daily_quota": None, "concurrency": 8},
+    # https://wiki.openstreetmap.org/wiki/Overpass_API#Public_Overpass_API_instances
+    "overpass": {"per_second": 1, "daily_quota": 10000, "concurrency": 2},
+}
+
+# adaptive backoff: every 429 halves the request rate and doubles the pause, every success slowly recovers both.
+min_rate_scale = 0.1
+rate_recovery_step = 0.05
+max_backoff_seconds = 300
+# a lease that was never released (IE the process crashed) stops counting towards concurrency after this long.
+lease_seconds = 120
+
+# where the budgets are kept. This is state about the data sources rather than a cache of their results, so
+# invalidating the caches leaves it alone, see DataTool.invalidate_caches.
+rate_limits_path = 'caches/rate_limits.sqlite'
+
+rate_limit_services = {}
+rate_limit_services_lock = threading.Lock()
+
+
+def shared_rate_limits(path=rate_limits_path):
+    with rate_limit_services_lock:
+        if path not in rate_limit_services:
+            rate_limit_services[path] = RateLimitService(path)
+        return rate_limit_services[path]
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class RateLimitService:
+    # Token bucket rate limiter whose state lives in a SQLite database, so every thread and process that uses the
+    # same file draws from the same budget. Callers acquire a lease before each request and release it with the
+    # response status afterwards, which is how 429s and Retry-After headers feed back into the budget.
+    def __init__(self, path, budgets=None):
+        self.path = path
+        self.budgets = budgets if budgets is not None else provider_budgets
+        self.local = threading.local()
+
+    def acquire(self, name, timeout=None):
+        # returns a lease id once a request is allowed. With a timeout, raises TimeoutError instead of waiting past it.
+        budget = self.budgets[name]
+        give_up = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            connection = self.__connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                tokens, updated, rate_scale, blocked_until, day, day_count = self.__load_bucket(connection, name, now)
+
+                # refill the bucket for the time that passed, at the (possibly reduced) adaptive rate
+                rate = budget["per_second"] * rate_scale
+                capacity = max(1.0, budget["per_second"])
+                tokens = min(capacity, tokens + (now - updated) * rate)
+                today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+                if day != today:
+                    day = today
+                    day_count = 0
+                if budget["daily_quota"] is not None and day_count >= budget["daily_quota"]:
+                    raise RateLimitExceeded(f"Daily quota of {budget['daily_quota']} requests for {name} is used up.")
+
+                connection.execute("DELETE FROM leases WHERE expires < ?", (now,))
+                in_flight = connection.execute("SELECT COUNT(*) FROM leases WHERE name = ?", (name,)).fetchone()[0]
+
+                if now < blocked_until:
+                    wait = blocked_until - now
+                elif tokens < 1.0:
+                    wait = (1.0 - tokens) / rate
+                elif in_flight >= budget["concurrency"]:
+                    wait = 0.05
+                else:
+                    wait = 0.0
+                    tokens -= 1.0
+                    day_count += 1
+                    lease_id = connection.execute("INSERT INTO leases (name, expires) VALUES (?, ?)",
+                                                  (name, now + lease_seconds)).lastrowid
+                connection.execute("UPDATE buckets SET tokens = ?, updated = ?, day = ?, day_count = ? WHERE name = ?",
+                                   (tokens, now, day, day_count, name))
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            if wait == 0.0:
+                return lease_id
+            if give_up is not None and time.monotonic() + wait > give_up:
+                raise TimeoutError(f"No {name} request could be sent within {round(timeout, 1)}s.")
+            time.sleep(min(wait, 1.0))
+
+    def release(self, name, lease_id, status_code=None, retry_after=None):
+        connection = self.__connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            connection.execute("DELETE FROM leases WHERE id = ?", (lease_id,))
+            row = connection.execute("SELECT rate_scale, blocked_until, backoff FROM buckets WHERE name = ?",
+                                     (name,)).fetchone()
+            if row is not None:
+                rate_scale, blocked_until, backoff = row
+                if status_code == 429 or (status_code == 503 and retry_after is not None):
+                    backoff = min(max_backoff_seconds, max(1.0, backoff * 2))
+                    pause = self.parse_retry_after(retry_after)
+                    blocked_until = max(blocked_until, now + (pause if pause is not None else backoff))
+                    rate_scale = max(min_rate_scale, rate_scale / 2)
+                    print(f"WARNING: {name} is rate limiting requests, pausing for {round(blocked_until - now, 1)}s.")
+                elif status_code is not None and status_code < 400:
+                    backoff = backoff / 2 if backoff > 1.0 else 0.0
+                    rate_scale = min(1.0, rate_scale + rate_recovery_step)
+                connection.execute("UPDATE buckets SET rate_scale = ?, blocked_until = ?, backoff = ? WHERE name = ?",
+                                   (rate_scale, blocked_until, backoff, name))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def parse_retry_after(self, retry_after):
+        # Retry-After is either a number of seconds or an HTTP date
+        if retry_after is None:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def __load_bucket(self, connection, name, now):
+        row = connection.execute("SELECT tokens, updated, rate_scale, blocked_until, day, day_count "
+                                 "FROM buckets WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            row = (max(1.0, self.budgets[name]["per_second"]), now, 1.0, 0.0, "", 0)
+            connection.execute("INSERT INTO buckets (name, tokens, updated, rate_scale, blocked_until, backoff, day, "
+                               "day_count) VALUES (?, ?, ?, ?, ?, 0, ?, ?)", (name,) + row)
+        return row
+
+    def __connection(self):
+        # sqlite connections can't be shared between threads, so each thread opens its own
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL, "
+                               "rate_scale REAL, blocked_until REAL, backoff REAL, day TEXT, day_count INTEGER)")
+            connection.execute("CREATE TABLE IF NOT EXISTS leases (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, "
+                               "expires REAL)")
+            self.local.connection = connection
+        return connection
@@ -0,0 +1,164 @@
+from pikmin_decor_predictor import PikminDecorPredictor, provider_columns
+from osm_element import OSMElement
+from dataset import Dataset
+from tile_cache import bbox_tiles, fetch_tile, poi_key, poi_position, zoom_for_radius
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+import json
+import math
+import os
+
+
+class RegionGrid:
+    # Splits a bounding box into a grid of roughly square cells, cell_size meters on each side. Cells are indexed
+    # by (row, column), with row 0 along the south edge and column 0 along the west edge.
+    def __init__(self, min_lat, min_long, max_lat, max_long, cell_size=250):
+        self.min_lat = min_lat
+        self.min_long = min_long
+        self.max_lat = max_lat
+        self.max_long = max_long
+        self.cell_size = cell_size
+        center_latitude = (min_lat + max_lat) / 2
+        self.cell_height = cell_size / 111320
+        self.cell_width = cell_size / (111320 * max(0.01, math.cos(math.radians(center_latitude))))
+        self.rows = max(1, math.ceil((max_lat - min_lat) / self.cell_height))
+        self.columns = max(1, math.ceil((max_long - min_long) / self.cell_width))
+
+    def cells(self):
+        return [(row, column) for row in range(self.rows) for column in range(self.columns)]
+
+    def cell_of(self, latitude, longitude):
+        # the cell a point falls in, or None if it is outside the grid
+        row = math.floor((latitude - self.min_lat) / self.cell_height)
+        column = math.floor((longitude - self.min_long) / self.cell_width)
+        if 0 <= row < self.rows and 0 <= column < self.columns:
+            return row, column
+        return None
+
+    def cell_bounds(self, cell):
+        # (south, west, north, east) of a cell
+        row, column = cell
+        south = self.min_lat + row * self.cell_height
+        west = self.min_long + column * self.cell_width
+        return south, west, south + self.cell_height, west + self.cell_width
+
+    def tiles(self, max_radius=None):
+        # map tiles that cover the grid without overlapping, for the APIs that search by radius. They are sized so
+        # that the circle that fetches a tile is no larger than the one that would cover a single cell, and no larger
+        # than max_radius, the most the data source accepts.
+        radius = math.ceil(self.cell_size * math.sqrt(2) / 2)
+        widest_latitude = 0.0 if self.min_lat <= 0 <= self.max_lat else min(abs(self.min_lat), abs(self.max_lat))
+        zoom = zoom_for_radius(widest_latitude, min(radius, max_radius) if max_radius else radius)
+        return bbox_tiles(self.min_lat, self.min_long, self.max_lat, self.max_long, zoom)
+
+
+def fetch_region_pois(decor_predictor, grid, debug_mode=False):
+    # returns {cell: [(data column, compact POI)]}. OSM is fetched in boxes of the region, the APIs, which only
+    # search circles, one map tile at a time, and every POI is assigned to the one cell its coordinates fall in.
+    # The tiles don't overlap, so each is fetched once however many cells it touches, but the circle that fetches a
+    # tile reaches into its neighbours, so POIs near tile edges still come back from up to four tiles. They are
+    # deduplicated per data source by id, and POIs without coordinates are dropped as they can't be placed.
+    cell_pois = {}
+    seen = set()
+
+    def assign(dataset, pois):
+        for poi in pois:
+            key = (dataset, poi_key(poi))
+            position = poi_position(poi)
+            if key in seen or position is None:
+                continue
+            poi_cell = grid.cell_of(position[0], position[1])
+            if poi_cell is None:
+                continue
+            seen.add(key)
+            cell_pois.setdefault(poi_cell, []).append((provider_columns[dataset][0], poi))
+
+    for dataset, tool in decor_predictor.enabled_providers():
+        if dataset == Dataset.osm:
+            assign(dataset, tool.query_region(grid.min_lat, grid.min_long, grid.max_lat, grid.max_long))
+        else:
+            tile_keys = grid.tiles(tool.max_radius)
+            if decor_predictor.tile_cache:
+                # tiles already cached by earlier runs or lookups aren't fetched again
+                tiles = decor_predictor.tile_cache.fetch(dataset.value, tool.query_pois, tile_keys)
+            else:
+                fetch = lambda tile_key, tool=tool: fetch_tile(tool.query_pois, tile_key)
+                tiles = dict(zip(tile_keys, tool.transport.run_concurrently(fetch, tile_keys)))
+            for tile_key in tile_keys:
+                assign(dataset, tiles[tile_key])
+        if debug_mode:
+            print(f"DEBUG: {len([x for x in seen if x[0] == dataset])} {dataset.value} POIs in the region.")
+    return cell_pois
+
+
+def score_region(cell_pois, date, predictor_keys, workers=None):
+    # returns {cell: {decor: number of POIs that predict it}}, scoring the cells in a process pool. Every worker
+    # builds its own predictor from predictor_keys, which is only used to run the tag mappings.
+    workers = workers or os.cpu_count() or 1
+    cells = list(cell_pois.items())
+    if len(cells) == 0:
+        return {}
+    chunk_size = max(1, math.ceil(len(cells) / (workers * 4)))
+    chunks = [cells[start:start + chunk_size] for start in range(0, len(cells), chunk_size)]
+    counts = {}
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks)),
+                             initializer=init_region_worker,
+                             initargs=(predictor_keys,)) as executor:
+        for chunk_counts in executor.map(score_cells, chunks, [date] * len(chunks)):
+            counts.update(chunk_counts)
+    return counts
+
+
+region_predictor = None
+
+
+def init_region_worker(predictor_keys):
+    global region_predictor
+    region_predictor = PikminDecorPredictor(**predictor_keys)
+
+
+def score_cells(cells, date):
+    # scores each POI on its own, as a dataset row with only that POI's column filled in
+    counts = {}
+    for cell, pois in cells:
+        counter = Counter()
+        for column, poi in pois:
+            row = {"OSM Data": None, "Foursquare Data": None, "Google Places Data": None, "Yelp Data": None,
+                   "Date": date}
+            row[column] = OSMElement.from_compact(poi) if column == "OSM Data" else poi
+            counter.update({x.get_decor().value for x in region_predictor.predict_row(row, None)})
+        if len(counter) > 0:
+            counts[cell] = dict(counter)
+    return counts
+
+
+def write_geojson(grid, counts, output_file):
+    # one polygon per cell that has any decor, with its counts and most common decor
+    features = []
+    for (row, column), decors in sorted(counts.items()):
+        south, west, north, east = grid.cell_bounds((row, column))
+        features.append({"type": "Feature",
+                         "geometry": {"type": "Polygon",
+                                      "coordinates": [[[west, south], [east, south], [east, north], [west, north],
+                                                       [west, south]]]},
+                         "properties": {"row": row,
+                                        "column": column,
+                                        "decors": decors,
+                                        "top_decor": max(decors, key=decors.get)}})
+    with open(output_file, 'w') as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+
+
+def write_raster(grid, counts, output_file):
+    # a compressed numpy archive with a (rows, columns, decors) array of counts, row 0 being the south edge
+    import numpy as np
+    decors = sorted({decor for cell_counts in counts.values() for decor in cell_counts})
+    raster = np.zeros((grid.rows, grid.columns, len(decors)), dtype=np.uint32)
+    for (row, column), cell_counts in counts.items():
+        for decor, count in cell_counts.items():
+            raster[row, column, decors.index(decor)] = count
+    np.savez_compressed(output_file,
+                        counts=raster,
+                        decors=np.array(decors),
+                        bounds=np.array([grid.min_lat, grid.min_long, grid.max_lat, grid.max_long]),
+                        cell_size=grid.cell_size)
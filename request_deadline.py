@@ -0,0 +1,32 @@
+import threading
+import time
+
+# the deadline of the call running on each thread, as a time.monotonic() value
+deadlines = threading.local()
+
+
+def run_with_deadline(deadline, function, *args, **kwargs):
+    # runs function on this thread with deadline as the cut-off for every data source request it makes, so a call
+    # that timed out gives up its rate limit lease and connection instead of running on in the background
+    previous = current_deadline()
+    deadlines.deadline = deadline
+    try:
+        return function(*args, **kwargs)
+    finally:
+        deadlines.deadline = previous
+
+
+def current_deadline():
+    return getattr(deadlines, "deadline", None)
+
+
+def remaining_time():
+    # seconds left before the deadline of the call running on this thread, None when it has no deadline. Raises
+    # TimeoutError once the deadline has passed, so no new request is started.
+    deadline = current_deadline()
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("the request deadline has passed")
+    return remaining
@@ -0,0 +1,67 @@
+from request_deadline import remaining_time
+import threading
+
+single_flights = {}
+single_flights_lock = threading.Lock()
+
+
+def shared_single_flight(name):
+    # one SingleFlight per data source, shared by every tool instance in the process
+    with single_flights_lock:
+        if name not in single_flights:
+            single_flights[name] = SingleFlight()
+        return single_flights[name]
+
+
+def single_flight_stats():
+    with single_flights_lock:
+        return {name: single_flight.stats() for name, single_flight in single_flights.items()}
+
+
+def query_key(*values, digits=6):
+    # normalises query parameters into a key, rounding coordinates to about 10cm so the same point given with
+    # a different float representation still matches
+    return tuple(round(value, digits) if isinstance(value, float) else value for value in values)
+
+
+class SingleFlight:
+    # Coalesces identical queries that are in flight at the same time. The first caller for a key runs the query,
+    # and every caller that asks for the same key before it finishes waits for it and gets the same result (or
+    # exception), so each of them costs no quota. Nothing is kept once the query finishes, caching is left to the
+    # caches.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.requests = 0
+        self.upstream_calls = 0
+
+    def do(self, key, function):
+        with self.lock:
+            self.requests += 1
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self.calls[key] = call
+                self.upstream_calls += 1
+        if leader:
+            try:
+                call["result"] = function()
+            except Exception as e:
+                call["error"] = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call["done"].set()
+        elif not call["done"].wait(remaining_time()):
+            # the caller's deadline passed while waiting on the shared query, which goes on for its other callers
+            raise TimeoutError("the request deadline has passed")
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"]
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests,
+                    "upstream_calls": self.upstream_calls,
+                    "saved_calls": self.requests - self.upstream_calls}
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# modules the single point path must not load, they are only needed for datasets and analysis
+heavy_modules = ["pandas", "sklearn", "scipy", "pyarrow"]
+
+# predictor settings to time startup with, once with only OSM, and once with every API key set, which also builds
+# the API tools, their HTTP sessions and caches. The keys are placeholders, startup never queries the data sources.
+startup_configurations = {
+    "OSM only": {},
+    "all API keys": {"foursquare_key": "benchmark", "google_places_key": "benchmark", "yelp_key": "benchmark"},
+}
+
+# what a predict_decors.py run does before its first query: start python, import the script and build the predictor
+startup_script = """
+import json, sys, time
+start_time = time.perf_counter()
+import predict_decors
+from pikmin_decor_predictor import PikminDecorPredictor
+PikminDecorPredictor(**%r)
+print(json.dumps({"import_ms": (time.perf_counter() - start_time) * 1000,
+                  "loaded": [x for x in %r if x in sys.modules]}))
+"""
+
+
+def cli_to_args():
+    """
+    converts the command line interface to a series of args
+    """
+    cli = argparse.ArgumentParser(description="Benchmark that measures how long predict_decors.py takes to start, "
+                                              "up to its first query, and fails if it goes over the time budget or "
+                                              "loads the dataset dependencies (pandas, scikit-learn, etc.).")
+    cli.add_argument('-runs',
+                     type=int, default=5,
+                     help='How many fresh python processes to time. The median is compared to the budget.')
+    cli.add_argument('-budget_ms',
+                     type=float, default=500,
+                     help='Startup time budget in milliseconds, from starting python to a ready predictor.')
+    return cli.parse_args()
+
+
+def time_startup(predictor_keys):
+    # returns (total ms including interpreter startup, ms spent in imports and setup, heavy modules loaded)
+    start_time = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", startup_script % (predictor_keys, heavy_modules)],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            check=True, capture_output=True, text=True).stdout
+    total_ms = (time.perf_counter() - start_time) * 1000
+    result = json.loads(output.strip().splitlines()[-1])
+    return total_ms, result["import_ms"], result["loaded"]
+
+
+if __name__ == '__main__':
+    args = cli_to_args()
+
+    failed = False
+    for name, predictor_keys in startup_configurations.items():
+        runs = [time_startup(predictor_keys) for _ in range(args.runs)]
+        total_ms = statistics.median(x[0] for x in runs)
+        import_ms = statistics.median(x[1] for x in runs)
+        loaded = sorted({module for x in runs for module in x[2]})
+
+        print(f"Startup with {name}: {round(total_ms)}ms median over {args.runs} runs, {round(import_ms)}ms of it "
+              f"in imports and setup. Budget: {round(args.budget_ms)}ms.")
+        if total_ms > args.budget_ms:
+            print(f"FAILED: startup with {name} is {round(total_ms - args.budget_ms)}ms over budget.")
+            failed = True
+        if len(loaded) > 0:
+            print(f"FAILED: the single point path with {name} loaded {', '.join(loaded)}, which should only load "
+                  f"for datasets.")
+            failed = True
+    sys.exit(1 if failed else 0)
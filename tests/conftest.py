@@ -0,0 +1,13 @@
+import os
+import sys
+import pytest
+
+# the scripts import each other as top level modules, run from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # the tools keep their caches under ./caches, so each test runs in its own directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,95 @@
+from api_enrichment import fill_in_api_column
+from cache_store import CacheStore, Revalidation
+from rate_limit_service import RateLimitExceeded
+from yelp_tool import YelpTool
+import pandas as pd
+
+
+class FakeTransport:
+    def run_concurrently(self, function, items):
+        return [function(item) for item in items]
+
+
+def make_dataset():
+    return pd.DataFrame([{"Country": "Australia", "State": "WA", "Suburb": "Perth", "Location": "Cafe A"},
+                         {"Country": "Australia", "State": "WA", "Suburb": "Perth", "Location": "Cafe B"},
+                         {"Country": "Australia", "State": "WA", "Suburb": "Perth", "Location": "Cafe A"},
+                         {"Country": "Australia", "State": "WA", "Suburb": "Perth", "Location": "Nowhere"}])
+
+
+def fill_in(data, cache, queried, revalidation=None):
+    def fill_in_row(row_key, row):
+        queried.append(row_key)
+        cache[row_key] = {"name": row["Location"], "raw": True} if row["Location"] != "Nowhere" else None
+    return fill_in_api_column(data, "yelp", cache, lambda row: row["Location"], fill_in_row, FakeTransport(),
+                              "Yelp Data", lambda response: {"name": response["name"]}, revalidation)
+
+
+def test_each_uncached_row_key_is_queried_once(workdir):
+    cache = CacheStore("caches/yelp_cache.sqlite")
+    cache["Cafe B"] = {"name": "Cafe B", "raw": True}
+    queried = []
+    data = fill_in(make_dataset(), cache, queried)
+    assert sorted(queried) == ["Cafe A", "Nowhere"]
+    assert list(data["Yelp Data"]) == [{"name": "Cafe A"}, {"name": "Cafe B"}, {"name": "Cafe A"}, None]
+
+
+def test_revalidation_queries_expired_entries_again(workdir):
+    cache = CacheStore("caches/yelp_cache.sqlite")
+    fill_in(make_dataset(), cache, [])
+    queried = []
+    # matches never expire, "no match" results always do
+    fill_in(make_dataset(), cache, queried, Revalidation(positive_ttl=None, negative_ttl=0))
+    assert queried == ["Nowhere"]
+
+
+def test_failing_rows_are_skipped_and_not_cached(workdir, capsys):
+    cache = CacheStore("caches/yelp_cache.sqlite")
+    queried = []
+
+    def fill_in_row(row_key, row):
+        queried.append(row_key)
+        if row_key == "Cafe B":
+            raise RateLimitExceeded("Daily quota of 5000 requests for yelp is used up.")
+        cache[row_key] = {"name": row["Location"]}
+    data = fill_in_api_column(make_dataset(), "yelp", cache, lambda row: row["Location"], fill_in_row,
+                              FakeTransport(), "Yelp Data", lambda response: {"name": response["name"]})
+
+    assert sorted(queried) == ["Cafe A", "Cafe B", "Nowhere"]
+    assert "Cafe B" not in cache
+    assert list(data["Yelp Data"]) == [{"name": "Cafe A"}, None, {"name": "Cafe A"}, {"name": "Nowhere"}]
+    assert data.attrs["skipped_rows"] == [1]
+    assert "failed for 1 of 3 locations" in capsys.readouterr().out
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class FakeYelpTransport(FakeTransport):
+    def __init__(self, body):
+        self.body = body
+
+    def request(self, method, url, **kwargs):
+        return FakeResponse(self.body)
+
+
+class FakeLocationTool:
+    def lookup_location(self, row):
+        return type("Location", (), {"latitude": -31.95, "longitude": 115.86})()
+
+
+def test_error_responses_are_not_cached_as_no_match(workdir):
+    tool = YelpTool("key")
+    tool.transport = FakeYelpTransport({"error": {"code": "ACCESS_LIMIT_REACHED"}})
+    data = tool.fill_in_data(make_dataset(), FakeLocationTool())
+    assert list(data["Yelp Data"]) == [None] * 4
+    assert len(tool.dict) == 0
+
+    tool.transport = FakeYelpTransport({"businesses": []})
+    tool.fill_in_data(make_dataset(), FakeLocationTool())
+    assert len(tool.dict) == 3
@@ -0,0 +1,65 @@
+from batch_scorer import BatchScorer
+from dataset import Dataset
+from decor_type import DecorType
+from osm_element import OSMElement
+from pikmin_decor_predictor import PikminDecorPredictor
+import pandas as pd
+import pytest
+
+
+def osm(**tags):
+    return OSMElement(1, "node", tags, -31.95, 115.86)
+
+
+# rows with every mix of data sources, dates either side of the burger shop start, and missing provider data
+rows = [
+    ("12/01/2021", osm(amenity="fast_food"), None, None, None, DecorType.restaurant),
+    ("01/05/2022", osm(amenity="fast_food"), None, None, None, DecorType.burger_place),
+    ("01/05/2022", osm(amenity="fast_food", cuisine="burger"), None, None, None, DecorType.burger_place),
+    ("12/01/2021", osm(amenity="cafe", cuisine="coffee_shop"), None, None, None, DecorType.cafe),
+    ("06/10/2022", osm(shop="pastry"), {"categories": [{"name": "Diner"}, {"name": "Buffet"}]}, None, None,
+     DecorType.sweetshop),
+    ("06/10/2022", None, {"categories": [{"name": "Restaurant"}]}, {"types": ["cafe", "restaurant"]}, None,
+     DecorType.cafe),
+    ("06/10/2022", None, None, {"types": ["movie_theater"]}, {"categories": [{"alias": "pizza"},
+                                                                            {"alias": "chinese"}]},
+     DecorType.restaurant),
+    ("06/10/2022", None, None, None, {"categories": [{"alias": "steak"}, {"title": "no alias"}]},
+     DecorType.restaurant),
+    ("06/10/2022", osm(name="No decor tags"), {"categories": []}, {"types": []}, {"categories": []},
+     DecorType.roadside),
+    ("06/10/2022", None, None, None, None, DecorType.roadside),
+]
+
+
+def make_dataset():
+    data = pd.DataFrame([{"Location": f"Place {i}", "Date": date, "OSM Data": osm_data,
+                          "Foursquare Data": foursquare, "Google Places Data": google_places, "Yelp Data": yelp}
+                         for i, (date, osm_data, foursquare, google_places, yelp, truth) in enumerate(rows)])
+    truth = {index: row[-1] for index, row in zip(data.index, rows)}
+    return data, truth
+
+
+@pytest.mark.parametrize("keys", [{},
+                                  {"foursquare_key": "key", "google_places_key": "key", "yelp_key": "key"},
+                                  {"google_places_key": "key"}])
+def test_batch_scoring_matches_row_scoring(workdir, keys):
+    predictor = PikminDecorPredictor(**keys)
+    data, truth = make_dataset()
+    usages = []
+    predictor.print_tag_usage = usages.append
+
+    row_predictions = predictor.predict_dataset(data, truth)
+    batch_predictions = predictor.predict_dataset(data, truth, batch_mode=True)
+    assert batch_predictions["Decor"].tolist() == row_predictions["Decor"].tolist()
+    assert usages[1] == usages[0]
+
+    # every prediction predict_row makes, in the same order, is what the batch scorer picks from
+    scorer = BatchScorer(predictor.foursquare_enabled(), predictor.google_places_enabled(), predictor.yelp_enabled())
+    decor_predictions, usage = scorer.score(data, [truth[index] for index in data.index])
+    for index, decor in zip(data.index, decor_predictions):
+        predictions = [x.get_decor() for x in predictor.predict_row(data.loc[index], truth[index])]
+        assert decor == (truth[index] if truth[index] in predictions else
+                         predictions[0] if predictions else DecorType.roadside)
+    assert usage == usages[0]
+    assert any(len(counts) > 0 for dataset, counts in usage.items() if dataset != Dataset.osm) == (len(keys) > 0)
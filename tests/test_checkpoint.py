@@ -0,0 +1,101 @@
+from checkpoint import Checkpoint
+import pikmin_decor_predictor
+import pandas as pd
+import pytest
+
+
+class FakeLocationTool:
+    def __init__(self):
+        self.calls = []
+
+    def make_location_dict(self, df, revalidation=None):
+        self.calls.append(len(df.index))
+        return df
+
+
+class FakeOSMTool:
+    # fills in OSM Data as "<Location> data", and stops the run once fail_after chunks are done
+    def __init__(self, fail_after=None):
+        self.chunks = []
+        self.fail_after = fail_after
+
+    def fill_in_data(self, df, location_tool, debug_mode=False, revalidation=None):
+        if self.fail_after is not None and len(self.chunks) >= self.fail_after:
+            raise KeyboardInterrupt()
+        self.chunks.append(df.copy())
+        df["OSM Data"] = [f"{x} data" for x in df["Location"]]
+        df["OSM Tags"] = None
+        return df
+
+
+def make_dataset():
+    rows = []
+    for suburb in range(6):
+        for location in range(15):
+            rows.append({"Country": "Australia", "State": "Western Australia", "Suburb": f"Suburb {suburb}",
+                         "Location": f"Shop {suburb}.{location}", "Date": "12/18/2021"})
+    # interleave the suburbs, as datasets aren't sorted by location
+    data = pd.DataFrame(rows).sample(frac=1, random_state=1).reset_index(drop=True)
+    data["OSM Data"] = None
+    return data
+
+
+def make_predictor(osm_tool):
+    predictor = pikmin_decor_predictor.PikminDecorPredictor()
+    predictor.location_tool = FakeLocationTool()
+    predictor.osm_tool = osm_tool
+    return predictor
+
+
+def test_chunks_keep_locations_whole(workdir):
+    checkpoint = Checkpoint("checkpoint.sqlite", chunk_rows=20)
+    data = make_dataset()
+    checkpoint.start(data)
+    osm_tool = FakeOSMTool()
+    predictor = make_predictor(osm_tool)
+    predictor.fill_in_data(data, checkpoint=checkpoint)
+
+    # geocoding sees every row at once, and every suburb's rows are in a single data source chunk
+    assert predictor.location_tool.calls == [len(data.index)]
+    assert len(osm_tool.chunks) == 3
+    for chunk in osm_tool.chunks:
+        assert len(chunk.index) >= 20
+        for suburb, rows in chunk.groupby("Suburb"):
+            assert len(rows.index) == 15
+
+
+def test_resume_skips_finished_rows(workdir):
+    checkpoint = Checkpoint("checkpoint.sqlite", chunk_rows=20)
+    checkpoint.start(make_dataset())
+
+    interrupted = FakeOSMTool(fail_after=2)
+    with pytest.raises(KeyboardInterrupt):
+        make_predictor(interrupted).fill_in_data(checkpoint.dataset(), checkpoint=checkpoint)
+    done = {index for chunk in interrupted.chunks for index in chunk.index}
+
+    # a new process resumes on the stored dataset, and only fills in the rows that weren't done
+    resumed_checkpoint = Checkpoint("checkpoint.sqlite", chunk_rows=20)
+    data = resumed_checkpoint.dataset()
+    resumed = FakeOSMTool()
+    data = make_predictor(resumed).fill_in_data(data, checkpoint=resumed_checkpoint)
+    redone = {index for chunk in resumed.chunks for index in chunk.index}
+    assert len(done) == 60
+    assert redone == set(data.index) - done
+    assert data["OSM Data"].tolist() == [f"{x} data" for x in data["Location"]]
+
+
+class SkippingOSMTool(FakeOSMTool):
+    # fills in every row, but reports the rows of Suburb 0 as skipped, like an API data source out of quota
+    def fill_in_data(self, df, location_tool, debug_mode=False, revalidation=None):
+        df = super().fill_in_data(df, location_tool, debug_mode, revalidation)
+        df.attrs["skipped_rows"] = list(df.index[df["Suburb"] == "Suburb 0"])
+        return df
+
+
+def test_skipped_rows_are_not_recorded_as_done(workdir):
+    checkpoint = Checkpoint("checkpoint.sqlite", chunk_rows=20)
+    data = make_dataset()
+    checkpoint.start(data)
+    make_predictor(SkippingOSMTool()).fill_in_data(data, checkpoint=checkpoint)
+    done = set(checkpoint.completed("OSM"))
+    assert done == set(data.index[data["Suburb"] != "Suburb 0"])
@@ -0,0 +1,19 @@
+from data_tool import DataTool
+from rate_limit_service import RateLimitService
+import os
+import sqlite3
+
+
+def test_invalidate_caches_keeps_the_rate_limits(workdir):
+    data_tool = DataTool()
+    data_tool.generate_directories()
+    rate_limits = RateLimitService("caches/rate_limits.sqlite")
+    rate_limits.release("yelp", rate_limits.acquire("yelp"), 200)
+    with open("caches/yelp_cache.sqlite", "w") as f:
+        f.write("")
+
+    data_tool.invalidate_caches()
+    assert not os.path.exists("caches/yelp_cache.sqlite")
+    assert os.path.exists("caches/rate_limits.sqlite")
+    connection = sqlite3.connect("caches/rate_limits.sqlite")
+    assert connection.execute("SELECT day_count FROM buckets WHERE name = 'yelp'").fetchone()[0] == 1
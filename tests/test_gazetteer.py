@@ -0,0 +1,81 @@
+from gazetteer import Gazetteer
+from location_tool import LocationTool
+import pandas as pd
+import pytest
+
+
+def write_dump(directory):
+    # a few columns of https://download.geonames.org/export/dump/readme.txt, the rest left empty
+    places = [(1, "Richmond", -33.6, 150.75, "PPL", "02", 5000),
+              (2, "Richmond", -37.82, 145.0, "PPLX", "07", 30000),
+              (3, "Perth", -31.95, 115.86, "PPLA", "08", 2000000),
+              (4, "Fremantle", -32.05, 115.75, "PPL", "08", 30000)]
+    with open(directory / "cities500.txt", "w") as f:
+        for geoname_id, name, latitude, longitude, feature_code, admin1, population in places:
+            columns = [str(geoname_id), name, name, "", str(latitude), str(longitude), "P", feature_code, "AU", "",
+                       admin1, "", "", "", str(population), "", "", "Australia/Sydney", "2020-01-01"]
+            f.write("\t".join(columns) + "\n")
+    with open(directory / "admin1CodesASCII.txt", "w") as f:
+        f.write("AU.02\tNew South Wales\tNew South Wales\t2155400\n")
+        f.write("AU.07\tVictoria\tVictoria\t2145234\n")
+        f.write("AU.08\tWestern Australia\tWestern Australia\t2058645\n")
+    with open(directory / "countryInfo.txt", "w") as f:
+        f.write("#ISO\tISO3\tISO-Numeric\tfips\tCountry\n")
+        f.write("AU\tAUS\t036\tAS\tAustralia\n")
+    return str(directory / "cities500.txt")
+
+
+@pytest.fixture
+def gazetteer(workdir):
+    return Gazetteer(write_dump(workdir))
+
+
+def test_lookups_stay_in_the_given_state(gazetteer):
+    assert gazetteer.geocode("Richmond, Western Australia, Australia") is None
+    assert gazetteer.geocode("Richmond, New South Wales, Australia").latitude == -33.6
+    assert gazetteer.geocode("Richmond, Victoria, Australia").latitude == -37.82
+
+
+def test_states_can_be_given_by_admin1_code(gazetteer):
+    assert gazetteer.geocode("Richmond, 02, AU").latitude == -33.6
+
+
+def test_country_wide_lookup_only_when_the_state_is_unknown(gazetteer):
+    # the most populated Richmond
+    assert gazetteer.geocode("Richmond, Nowhere, Australia").latitude == -37.82
+    assert gazetteer.geocode("Richmnd, Nowhere, Australia") is None
+
+
+def test_spelling_fallback_within_the_state(gazetteer):
+    assert gazetteer.geocode("Fremantel, Western Australia, Australia").latitude == -32.05
+    assert gazetteer.geocode("Richmnd, Western Australia, Australia") is None
+
+
+def test_index_is_reused(workdir, gazetteer, capsys):
+    capsys.readouterr()
+    reloaded = Gazetteer(gazetteer.places_path)
+    assert "Building" not in capsys.readouterr().out
+    assert reloaded.geocode("Perth, Western Australia, Australia").latitude == -31.95
+
+
+def test_gazetteer_locations_are_not_cached(workdir):
+    class FakePool:
+        def __init__(self):
+            self.keys = []
+
+        def geocode_all(self, keys, on_result):
+            self.keys.extend(keys)
+            for key in keys:
+                on_result(key, None)
+
+    location_tool = LocationTool("test@example.com", gazetteer_path=write_dump(workdir))
+    location_tool.geocoder_pool = FakePool()
+    data = pd.DataFrame([{"Country": "Australia", "State": "Western Australia", "Suburb": "Perth"},
+                         {"Country": "Australia", "State": "Western Australia", "Suburb": "Richmond"}])
+    location_tool.make_location_dict(data)
+
+    assert location_tool.geocoder_pool.keys == ["Richmond, Western Australia, Australia"]
+    assert location_tool.lookup_location(data.iloc[0]).latitude == -31.95
+    assert location_tool.lookup_location(data.iloc[1]) is None
+    # a later run without the gazetteer geocodes Perth for real
+    assert "Perth, Western Australia, Australia" not in location_tool.location_dict
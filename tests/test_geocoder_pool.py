@@ -0,0 +1,63 @@
+from geocoder_pool import GeocoderPool
+from geopy.exc import GeocoderTimedOut
+import geocoder_pool
+import pytest
+
+
+class FakeRateLimits:
+    def acquire(self, name):
+        return 0
+
+    def release(self, name, lease_id, status_code=None, retry_after=None):
+        pass
+
+
+class FakeGeocoder:
+    # answers from a dict, timing out on each key as many times as given in timeouts
+    def __init__(self, locations, timeouts=None):
+        self.locations = locations
+        self.timeouts = dict(timeouts or {})
+        self.calls = []
+
+    def geocode(self, key):
+        self.calls.append(key)
+        if self.timeouts.get(key, 0) > 0:
+            self.timeouts[key] -= 1
+            raise GeocoderTimedOut("timed out")
+        return self.locations.get(key)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(geocoder_pool.time, "sleep", lambda seconds: None)
+
+
+def make_pool(geocoder, retries=3):
+    return GeocoderPool(None, endpoints=[("test", geocoder, 2)], retries=retries, rate_limits=FakeRateLimits())
+
+
+def test_empty_results_are_not_retried():
+    geocoder = FakeGeocoder({"Perth, Western Australia, Australia": "perth"})
+    results = {}
+    make_pool(geocoder).geocode_all(["Perth, Western Australia, Australia", "Nowhere, Nowhere, Nowhere"],
+                                    lambda key, location: results.__setitem__(key, location))
+    assert results == {"Perth, Western Australia, Australia": "perth", "Nowhere, Nowhere, Nowhere": None}
+    assert sorted(geocoder.calls) == ["Nowhere, Nowhere, Nowhere", "Perth, Western Australia, Australia"]
+
+
+def test_timeouts_are_retried():
+    geocoder = FakeGeocoder({"Perth, Western Australia, Australia": "perth"},
+                            timeouts={"Perth, Western Australia, Australia": 2})
+    results = {}
+    make_pool(geocoder).geocode_all(["Perth, Western Australia, Australia"],
+                                    lambda key, location: results.__setitem__(key, location))
+    assert results == {"Perth, Western Australia, Australia": "perth"}
+    assert len(geocoder.calls) == 3
+
+
+def test_timeouts_past_the_retries_are_raised():
+    geocoder = FakeGeocoder({}, timeouts={"Perth, Western Australia, Australia": 5})
+    with pytest.raises(GeocoderTimedOut):
+        make_pool(geocoder, retries=2).geocode_all(["Perth, Western Australia, Australia"],
+                                                   lambda key, location: None)
+    assert len(geocoder.calls) == 3
@@ -0,0 +1,62 @@
+from osm_offline_index import OSMOfflineIndex
+import os
+import pickle
+import pytest
+
+
+def write_extract(path, names):
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for node_id, name in enumerate(names, start=1):
+            f.write(f'<node id="{node_id}" lat="-31.95" lon="{115.86 + node_id * 0.001}">'
+                    f'<tag k="name" v="{name}"/><tag k="amenity" v="cafe"/></node>\n')
+        f.write('</osm>\n')
+
+
+@pytest.fixture
+def pickle_loads(monkeypatch):
+    # counts how many pickles are read, the header and the index are one each
+    loads = []
+    load = pickle.load
+
+    def counting_load(handle):
+        loads.append(1)
+        return load(handle)
+    monkeypatch.setattr(pickle, "load", counting_load)
+    return loads
+
+
+def test_current_index_is_read_once(workdir, pickle_loads, monkeypatch):
+    write_extract("extract.osm", ["Cafe A", "Cafe B"])
+    OSMOfflineIndex("extract.osm", ["amenity"])
+    assert pickle_loads == []
+
+    monkeypatch.setattr(OSMOfflineIndex, "build", lambda self: pytest.fail("the current index was rebuilt"))
+    index = OSMOfflineIndex("extract.osm", ["amenity"])
+    assert len(pickle_loads) == 2
+    assert [x.id() for x in index.query_bbox(-32, 115, -31, 116)] == [1, 2]
+
+
+def test_stale_index_only_reads_the_header(workdir, pickle_loads):
+    write_extract("extract.osm", ["Cafe A"])
+    OSMOfflineIndex("extract.osm", ["amenity"])
+    write_extract("extract.osm", ["Cafe A", "Cafe B", "Cafe C"])
+    os.utime("extract.osm", (0, 0))
+
+    index = OSMOfflineIndex("extract.osm", ["amenity"])
+    assert len(pickle_loads) == 1
+    assert [x.id() for x in index.query_bbox(-32, 115, -31, 116)] == [1, 2, 3]
+
+
+def test_extracts_with_the_same_name_get_their_own_index(workdir, monkeypatch):
+    os.makedirs("a")
+    os.makedirs("b")
+    write_extract("a/extract.osm", ["Cafe A"])
+    write_extract("b/extract.osm", ["Cafe A", "Cafe B"])
+    first = OSMOfflineIndex("a/extract.osm", ["amenity"])
+    second = OSMOfflineIndex("b/extract.osm", ["amenity"])
+    assert first.index_path != second.index_path
+
+    monkeypatch.setattr(OSMOfflineIndex, "build", lambda self: pytest.fail("a current index was rebuilt"))
+    assert len(OSMOfflineIndex("a/extract.osm", ["amenity"]).query_bbox(-32, 115, -31, 116)) == 1
+    assert len(OSMOfflineIndex("b/extract.osm", ["amenity"]).query_bbox(-32, 115, -31, 116)) == 2
@@ -0,0 +1,13 @@
+from point_input import date_type
+import argparse
+import pytest
+
+
+def test_date_type_accepts_m_d_y():
+    assert date_type("12/18/2021") == "12/18/2021"
+
+
+@pytest.mark.parametrize("date", ["2021-12-18", "13/45/2021", "today", ""])
+def test_date_type_rejects_other_dates(date):
+    with pytest.raises(argparse.ArgumentTypeError):
+        date_type(date)
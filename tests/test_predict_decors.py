@@ -0,0 +1,57 @@
+from predict_decors import predict_points
+from dataset import Dataset
+import argparse
+import json
+
+
+class FakePredictor:
+    def __init__(self):
+        self.points = []
+
+    def predict_providers(self, longitude, latitude, radius, date, debug_mode=False):
+        self.points.append((latitude, longitude, radius, date))
+        if latitude == 1.0:
+            raise RuntimeError("data source exploded")
+        return {Dataset.osm: ({}, None)}
+
+
+def run_batch(workdir, lines):
+    with open("points.jsonl", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    args = argparse.Namespace(input="points.jsonl", output="results.jsonl", workers=2, radius=150, date=None,
+                              debug=False)
+    predictor = FakePredictor()
+    predict_points(predictor, args)
+    with open("results.jsonl") as f:
+        return predictor, [json.loads(line) for line in f]
+
+
+def test_bad_lines_are_reported_and_the_rest_predicted(workdir):
+    predictor, results = run_batch(workdir, [
+        '{"id": 1, "latitude": -31.95, "longitude": 115.86}',
+        '{"id": 2, "latitude": null, "longitude": 115.86}',
+        '{"id": 3, "latitude": -31.95, "longitude": 115.86, "date": "2021-12-18"}',
+        '{"id": 4, "latitude": -31.95, "longitude": 115.86',
+        '[1, 2]',
+        '{"id": 6, "latitude": 1.0, "longitude": 115.86}',
+        '{"id": 7, "latitude": -31.95, "longitude": 115.86, "radius": "wide"}',
+        '{"id": 8, "latitude": -31.95, "longitude": 115.86, "date": "12/18/2021"}',
+    ])
+    assert len(results) == 8
+    by_id = {x.get("id", x.get("line")): x for x in results}
+    assert "results" in by_id[1] and "error" not in by_id[1]
+    assert "results" in by_id[8]
+    assert by_id[2]["error"].startswith("invalid point")
+    assert by_id[3]["error"].startswith("invalid point")
+    assert by_id[4]["error"].startswith("invalid JSON")
+    assert by_id[5]["error"].startswith("invalid JSON")
+    assert "data source exploded" in by_id[6]["error"]
+    assert by_id[7]["error"].startswith("invalid point")
+    # invalid points never reach the data sources
+    assert len(predictor.points) == 3
+
+
+def test_point_fields_and_defaults(workdir):
+    predictor, results = run_batch(workdir, ['{"name": "x", "latitude": "-31.95", "longitude": "115.86"}'])
+    assert results[0]["name"] == "x"
+    assert predictor.points == [(-31.95, 115.86, 150, None)]
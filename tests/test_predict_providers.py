@@ -0,0 +1,89 @@
+from dataset import Dataset
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http_transport import HttpTransport
+from pikmin_decor_predictor import PikminDecorPredictor
+from rate_limit_service import RateLimitService
+from request_deadline import remaining_time, run_with_deadline
+import pytest
+import sqlite3
+import threading
+import time
+
+
+class SlowTool:
+    # a data source that keeps working until its caller's deadline stops it
+    def __init__(self):
+        self.finished = threading.Event()
+
+    def predict(self, longitude, latitude, radius, seedling_date, burger_shop_start_date, debug_mode=False):
+        try:
+            while True:
+                remaining_time()
+                time.sleep(0.01)
+        finally:
+            self.finished.set()
+
+
+class FastTool:
+    def predict(self, longitude, latitude, radius, seedling_date, burger_shop_start_date, debug_mode=False):
+        return {"Cafe": []}
+
+
+def test_timed_out_lookups_stop_at_their_deadline(workdir):
+    predictor = PikminDecorPredictor()
+    predictor.osm_tool = SlowTool()
+    start_time = time.monotonic()
+    results = predictor.predict_providers(115.86, -31.95, 150, None, timeouts={Dataset.osm: 0.2})
+    assert time.monotonic() - start_time < 1
+    assert results[Dataset.osm][0] is None
+    assert "time" in results[Dataset.osm][1]
+    assert predictor.osm_tool.finished.wait(1)
+
+
+def test_lookups_share_one_bounded_executor(workdir):
+    predictor = PikminDecorPredictor()
+    predictor.osm_tool = FastTool()
+    executors = []
+    for _ in range(3):
+        results = predictor.predict_providers(115.86, -31.95, 150, None)
+        assert results[Dataset.osm] == ({"Cafe": []}, None)
+        executors.append(predictor.executor)
+    assert executors[0] is not None
+    assert all(executor is executors[0] for executor in executors)
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(2)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def slow_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/"
+    server.shutdown()
+    server.server_close()
+
+
+def test_requests_time_out_with_the_deadline_and_release_their_lease(workdir, slow_server):
+    transport = HttpTransport(rate_limit_name="yelp", retries=0)
+    transport.rate_limits = RateLimitService(str(workdir / "rate_limits.sqlite"))
+    start_time = time.monotonic()
+    with pytest.raises(Exception):
+        run_with_deadline(time.monotonic() + 0.3, transport.request, "GET", slow_server)
+    assert time.monotonic() - start_time < 1.5
+    with sqlite3.connect(str(workdir / "rate_limits.sqlite")) as connection:
+        assert connection.execute("SELECT COUNT(*) FROM leases").fetchone()[0] == 0
+
+
+def test_no_request_is_sent_after_the_deadline(workdir, slow_server):
+    transport = HttpTransport(retries=0)
+    with pytest.raises(TimeoutError):
+        run_with_deadline(time.monotonic() - 1, transport.request, "GET", slow_server)
@@ -0,0 +1,61 @@
+from prediction_service import PredictionService
+from http.server import ThreadingHTTPServer
+import json
+import pytest
+import socket
+import threading
+
+
+class FakePredictor:
+    def __init__(self):
+        self.calls = []
+
+    def predict_providers(self, longitude, latitude, radius, date, debug_mode=False):
+        self.calls.append((longitude, latitude, radius, date))
+        return {}
+
+
+@pytest.mark.parametrize("query", ["latitude=-31.95",
+                                   "latitude=-31.95&longitude=500",
+                                   "latitude=-31.95&longitude=115.86&radius=abc",
+                                   "latitude=-31.95&longitude=115.86&radius=60000",
+                                   "latitude=-31.95&longitude=115.86&date=2021-12-18",
+                                   "latitude=-31.95&longitude=115.86&date=13/45/2021"])
+def test_invalid_points_are_bad_requests(query):
+    predictor = FakePredictor()
+    status, response = PredictionService(predictor).handle("GET", f"/predict?{query}", b"")
+    assert status == 400
+    assert response["error"].startswith("invalid point")
+    assert predictor.calls == []
+
+
+def test_valid_point_is_predicted():
+    predictor = FakePredictor()
+    body = json.dumps({"latitude": -31.95, "longitude": 115.86, "radius": 50000, "date": "12/18/2021"}).encode()
+    status, response = PredictionService(predictor).handle("POST", "/predict", body)
+    assert status == 200
+    assert predictor.calls == [(115.86, -31.95, 50000, "12/18/2021")]
+
+
+@pytest.mark.parametrize("length", ["abc", "-1"])
+def test_invalid_content_length_is_a_bad_request(length):
+    service = PredictionService(FakePredictor())
+    server = ThreadingHTTPServer(("127.0.0.1", 0), service.make_handler())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with socket.create_connection(server.server_address, timeout=5) as connection:
+            connection.sendall(f"POST /predict HTTP/1.1\r\nHost: localhost\r\nContent-Length: {length}\r\n\r\n"
+                               .encode())
+            response = b""
+            while True:
+                chunk = connection.recv(4096)
+                if not chunk:
+                    break
+                response += chunk
+    finally:
+        server.shutdown()
+        server.server_close()
+    headers, body = response.split(b"\r\n\r\n", 1)
+    assert headers.startswith(b"HTTP/1.1 400")
+    assert json.loads(body)["error"].startswith("invalid Content-Length")
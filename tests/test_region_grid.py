@@ -0,0 +1,97 @@
+from dataset import Dataset
+from osm_tool import OSMTool
+from region_grid import RegionGrid, fetch_region_pois
+from tile_cache import TileCache, distance
+import math
+import osm_tool
+
+
+class FakeTransport:
+    def run_concurrently(self, function, items):
+        return [function(item) for item in items]
+
+
+class FakeYelpTool:
+    # businesses every 0.002 degrees, searched by circle like the Yelp API
+    max_radius = 40000
+
+    def __init__(self, min_lat, min_long, max_lat, max_long):
+        self.transport = FakeTransport()
+        self.queries = []
+        self.pois = []
+        steps_lat = round((max_lat - min_lat) / 0.002)
+        steps_long = round((max_long - min_long) / 0.002)
+        for row in range(steps_lat):
+            for column in range(steps_long):
+                self.pois.append({"id": f"{row}/{column}", "name": f"{row}/{column}",
+                                  "latitude": min_lat + 0.001 + row * 0.002,
+                                  "longitude": min_long + 0.001 + column * 0.002})
+
+    def query_pois(self, longitude, latitude, radius):
+        self.queries.append((longitude, latitude, radius))
+        return [x for x in self.pois if distance(latitude, longitude, x["latitude"], x["longitude"]) <= radius]
+
+
+class FakePredictor:
+    def __init__(self, providers, tile_cache=None):
+        self.providers = providers
+        self.tile_cache = tile_cache
+
+    def enabled_providers(self):
+        return self.providers
+
+
+def test_api_tiles_are_fetched_once_and_pois_counted_once(workdir):
+    grid = RegionGrid(-31.96, 115.85, -31.94, 115.87, cell_size=250)
+    tool = FakeYelpTool(grid.min_lat, grid.min_long, grid.max_lat, grid.max_long)
+    for tile_cache in (None, TileCache(ttl=3600)):
+        tool.queries = []
+        cell_pois = fetch_region_pois(FakePredictor([(Dataset.yelp, tool)], tile_cache), grid)
+
+        assert len(tool.queries) == len(set(tool.queries))
+        assert max(radius for longitude, latitude, radius in tool.queries) <= math.ceil(250 * math.sqrt(2) / 2)
+        pois = [poi for pois in cell_pois.values() for column, poi in pois]
+        assert sorted(x["id"] for x in pois) == sorted(x["id"] for x in tool.pois)
+        for cell, pois in cell_pois.items():
+            for column, poi in pois:
+                assert column == "Yelp Data"
+                assert grid.cell_of(poi["latitude"], poi["longitude"]) == cell
+
+
+def test_cached_tiles_are_not_fetched_again(workdir):
+    grid = RegionGrid(-31.96, 115.85, -31.94, 115.87, cell_size=250)
+    tool = FakeYelpTool(grid.min_lat, grid.min_long, grid.max_lat, grid.max_long)
+    tile_cache = TileCache(ttl=3600)
+    first = fetch_region_pois(FakePredictor([(Dataset.yelp, tool)], tile_cache), grid)
+    tool.queries = []
+    second = fetch_region_pois(FakePredictor([(Dataset.yelp, tool)], tile_cache), grid)
+    assert tool.queries == []
+    assert second == first
+
+
+def test_osm_region_is_split_into_sub_boxes(workdir, monkeypatch):
+    nodes = []
+    for row in range(13):
+        for column in range(13):
+            # every 0.01 degrees, so some nodes sit on the edges between sub-boxes
+            nodes.append((len(nodes) + 1, -32.0 + row * 0.01, 115.8 + column * 0.01))
+    with open("extract.osm", "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for node_id, latitude, longitude in nodes:
+            f.write(f'<node id="{node_id}" lat="{latitude}" lon="{longitude}">'
+                    f'<tag k="amenity" v="cafe"/></node>\n')
+        f.write('</osm>\n')
+    monkeypatch.setattr(osm_tool, "osm_region_box_size", 0.05)
+    tool = OSMTool(osm_extract="extract.osm")
+    boxes = []
+    query_bbox = tool.offline_index.query_bbox
+
+    def counting_query_bbox(*box):
+        boxes.append(box)
+        return query_bbox(*box)
+    tool.offline_index.query_bbox = counting_query_bbox
+
+    elements = tool.query_region(-32.0, 115.8, -31.88, 115.92)
+    assert len(boxes) == 9
+    assert all(north - south <= 0.05 and east - west <= 0.05 for south, west, north, east in boxes)
+    assert sorted(x[0] for x in elements) == [x[0] for x in nodes]
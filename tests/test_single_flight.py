@@ -0,0 +1,84 @@
+from single_flight import SingleFlight, query_key
+import pytest
+import threading
+import time
+
+callers = 8
+
+
+def wait_for_requests(single_flight, count, timeout=5):
+    deadline = time.time() + timeout
+    while single_flight.stats()["requests"] < count:
+        assert time.time() < deadline, "callers never reached the single flight"
+        time.sleep(0.001)
+
+
+def run_callers(single_flight, keys, function):
+    # calls single_flight.do from one thread per key, holding every upstream call until all callers are in flight
+    release = threading.Event()
+    results = [None] * len(keys)
+
+    def upstream(key):
+        release.wait(5)
+        return function(key)
+
+    def caller(index):
+        try:
+            results[index] = single_flight.do(keys[index], lambda: upstream(keys[index]))
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=caller, args=(index,)) for index in range(len(keys))]
+    for thread in threads:
+        thread.start()
+    wait_for_requests(single_flight, len(keys))
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_concurrent_identical_queries_share_one_call():
+    single_flight = SingleFlight()
+    upstream_calls = []
+    results = run_callers(single_flight, [query_key("query", -31.95, 115.86, 150)] * callers,
+                          lambda key: upstream_calls.append(key) or ["poi"])
+    assert len(upstream_calls) == 1
+    assert all(result is results[0] for result in results)
+    assert single_flight.stats() == {"requests": callers, "upstream_calls": 1, "saved_calls": callers - 1}
+
+
+def test_errors_are_shared_and_not_kept():
+    single_flight = SingleFlight()
+    error = Exception("quota exceeded")
+
+    def fail(key):
+        raise error
+    results = run_callers(single_flight, ["key"] * callers, fail)
+    assert all(result is error for result in results)
+    assert single_flight.stats()["upstream_calls"] == 1
+
+    # nothing is kept once the call finishes, so the next caller queries again
+    assert single_flight.do("key", lambda: "recovered") == "recovered"
+    assert single_flight.stats()["upstream_calls"] == 2
+
+
+def test_different_keys_are_not_coalesced():
+    single_flight = SingleFlight()
+    keys = [query_key("query", -31.95, 115.86, radius) for radius in range(100, 100 + callers)]
+    results = run_callers(single_flight, keys, lambda key: key[-1])
+    assert results == list(range(100, 100 + callers))
+    assert single_flight.stats()["upstream_calls"] == callers
+
+
+def test_query_key_ignores_float_noise():
+    assert query_key("query", -31.95, 115.86) == query_key("query", -31.950000000001, 115.8599999999999)
+    assert query_key("query", -31.95, 115.86) != query_key("query", -31.951, 115.86)
+
+
+def test_sequential_calls_are_not_coalesced():
+    single_flight = SingleFlight()
+    assert [single_flight.do("key", lambda value=value: value) for value in range(3)] == [0, 1, 2]
+    with pytest.raises(KeyError):
+        single_flight.do("key", lambda: {}["missing"])
+    assert single_flight.stats()["upstream_calls"] == 4
@@ -0,0 +1,107 @@
+from osm_tool import OSMTool
+from tile_cache import TileCache, distance
+import math
+import pytest
+
+center = (-31.95, 115.86)
+
+
+def offset(meters_north, meters_east, latitude=center[0], longitude=center[1]):
+    return (latitude + meters_north / 111320,
+            longitude + meters_east / (111320 * math.cos(math.radians(latitude))))
+
+
+class FakeSource:
+    # a data source with POIs on a grid around the center, searched by circle like the APIs
+    def __init__(self, spacing=40, extent=2000):
+        self.pois = []
+        steps = extent // spacing
+        for north in range(-steps, steps + 1):
+            for east in range(-steps, steps + 1):
+                latitude, longitude = offset(north * spacing, east * spacing)
+                self.pois.append({"id": f"{north}/{east}", "name": f"{north}/{east}",
+                                  "latitude": latitude, "longitude": longitude})
+        self.radiuses = []
+        self.error = None
+
+    def query_pois(self, longitude, latitude, radius):
+        self.radiuses.append(radius)
+        if self.error:
+            raise self.error
+        return [x for x in self.pois if distance(latitude, longitude, x["latitude"], x["longitude"]) <= radius]
+
+
+def test_failed_fetch_is_raised_and_not_cached(workdir):
+    tile_cache = TileCache(ttl=3600)
+    source = FakeSource()
+    source.error = Exception("quota exceeded")
+    with pytest.raises(Exception, match="quota exceeded"):
+        tile_cache.query("Yelp", source.query_pois, center[1], center[0], 150)
+
+    source.error = None
+    pois = tile_cache.query("Yelp", source.query_pois, center[1], center[0], 150)
+    assert len(pois) > 0
+
+
+@pytest.mark.parametrize("radius", [50, 150, 500, 2000, 10000])
+def test_tile_queries_are_no_larger_than_the_lookup(workdir, radius):
+    tile_cache = TileCache(ttl=3600)
+    source = FakeSource(spacing=max(10, radius // 10), extent=2 * radius)
+    tile_cache.query("Yelp", source.query_pois, center[1], center[0], radius)
+    assert 4 <= len(source.radiuses) <= 16
+    assert max(source.radiuses) <= radius
+
+
+def test_tile_queries_stay_under_the_data_source_limit(workdir):
+    tile_cache = TileCache(ttl=3600)
+    source = FakeSource(spacing=5000, extent=100000)
+    tile_cache.query("Yelp", source.query_pois, center[1], center[0], 60000, max_radius=40000)
+    assert max(source.radiuses) <= 40000
+
+
+@pytest.mark.parametrize("radius", [100, 150, 1000])
+def test_cached_lookup_returns_the_same_area_as_a_direct_one(workdir, radius):
+    tile_cache = TileCache(ttl=3600)
+    source = FakeSource(spacing=max(10, radius // 10), extent=3 * radius)
+    direct = {x["id"] for x in source.query_pois(center[1], center[0], radius)}
+    cached = {x["id"] for x in tile_cache.query("Yelp", source.query_pois, center[1], center[0], radius)}
+    assert cached == direct
+
+    # a second lookup nearby is answered from the tiles already fetched
+    calls = len(source.radiuses)
+    tile_cache.query("Yelp", source.query_pois, center[1], center[0], radius)
+    assert len(source.radiuses) == calls
+
+
+def test_osm_cached_and_uncached_lookups_match(workdir):
+    # one pharmacy 140m north, inside the radius, and one 150m north and east, inside the box but not the circle
+    nodes = [(1, offset(140, 0), "pharmacy"), (2, offset(150, 150), "pharmacy"), (3, offset(-60, 40), "cafe")]
+    with open("extract.osm", "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for node_id, (latitude, longitude), amenity in nodes:
+            f.write(f'<node id="{node_id}" lat="{latitude}" lon="{longitude}">'
+                    f'<tag k="amenity" v="{amenity}"/><tag k="name" v="{amenity} {node_id}"/></node>\n')
+        f.write('</osm>\n')
+    osm_tool = OSMTool("extract.osm")
+    tile_cache = TileCache(ttl=3600)
+
+    uncached = osm_tool.predict(center[1], center[0], 150, 0, 0)
+    cached = osm_tool.predict_pois(tile_cache.query("OSM", osm_tool.query_pois, center[1], center[0], 150),
+                                   0, 0)
+    assert set(uncached) == {"pharmacy 1", "cafe 3"}
+    assert cached == uncached
+
+
+def test_data_source_errors_are_raised_not_returned_as_empty(workdir, monkeypatch):
+    from yelp_tool import YelpTool
+
+    class Response:
+        def json(self):
+            return {"error": {"code": "VALIDATION_ERROR", "description": "radius is too large"}}
+
+    yelp_tool = YelpTool("key")
+    monkeypatch.setattr(yelp_tool.transport, "request", lambda *args, **kwargs: Response())
+    tile_cache = TileCache(ttl=3600)
+    with pytest.raises(Exception, match="radius is too large"):
+        tile_cache.query("Yelp", yelp_tool.query_pois, center[1], center[0], 150, yelp_tool.max_radius)
+    assert len(tile_cache.tiles) == 0
@@ -0,0 +1,194 @@
+from cache_store import CacheStore
+from request_deadline import current_deadline, run_with_deadline
+from concurrent.futures import ThreadPoolExecutor
+import math
+import time
+
+# coarsest and finest zoom used for tiles, a zoom 2 tile is a quarter of the world across, a zoom 22 tile about 10m
+min_tile_zoom = 2
+max_tile_zoom = 22
+# most tiles fetched at once, the shared transport still holds each data source to its own rate limit
+tile_fetch_workers = 16
+earth_radius = 6371000
+
+
+def tile_size(zoom):
+    # tiles are square in degrees, each zoom level halves them, starting from a 360 degree tile at zoom 0
+    return 360 / 2 ** zoom
+
+
+def tile_radius(zoom, latitude):
+    # distance in meters from the center of a tile to its corners, for a tile whose edge closest to the equator
+    # is at latitude. Tiles are widest there, so this covers the whole tile.
+    size = tile_size(zoom)
+    return math.ceil(distance(latitude, 0.0, latitude + size / 2, size / 2))
+
+
+def zoom_for_radius(latitude, radius):
+    # the coarsest zoom whose tiles are fetched with a query no larger than radius, so fetching a tile never asks a
+    # data source for a bigger area than the lookup itself would, keeping it under the data source's radius limit
+    # and result cap. A lookup then covers between 2x2 and 4x4 tiles, usually 3x3, or more when it is larger than
+    # the data source allows. latitude is the point of the lookup closest to the equator, the tiles it touches can
+    # reach one tile further.
+    for zoom in range(min_tile_zoom, max_tile_zoom + 1):
+        if tile_radius(zoom, max(0.0, abs(latitude) - tile_size(zoom))) <= radius:
+            return zoom
+    return max_tile_zoom
+
+
+def bbox_tiles(min_lat, min_long, max_lat, max_long, zoom):
+    # every tile that overlaps the box, as "zoom/row/column" keys. Tiles don't overlap each other.
+    size = tile_size(zoom)
+    rows = range(tile_index(max(-90.0, min_lat) + 90, size, 180),
+                 tile_index(min(90.0, max_lat) + 90, size, 180) + 1)
+    columns = range(tile_index(max(-180.0, min_long) + 180, size, 360),
+                    tile_index(min(180.0, max_long) + 180, size, 360) + 1)
+    return [f"{zoom}/{row}/{column}" for row in rows for column in columns]
+
+
+def tile_index(degrees, size, extent):
+    # tile row or column that holds degrees, measured from the south or west edge of the world. The last tile
+    # includes the far edge.
+    return min(math.floor(degrees / size), max(0, math.ceil(extent / size) - 1))
+
+
+def tile_bounds(tile_key):
+    # (south, west, north, east) of a tile
+    zoom, row, column = (int(x) for x in tile_key.split("/"))
+    size = tile_size(zoom)
+    south = -90 + row * size
+    west = -180 + column * size
+    return south, west, min(90.0, south + size), west + size
+
+
+def fetch_tile(query_pois, tile_key):
+    # the POIs inside a tile, queried from a data source that searches by circle
+    south, west, north, east = tile_bounds(tile_key)
+    center_latitude = (south + north) / 2
+    center_longitude = (west + east) / 2
+    # the circle through the tile's corners covers the whole tile
+    radius = math.ceil(max(distance(center_latitude, center_longitude, latitude, east)
+                           for latitude in (south, north)))
+    pois = []
+    for poi in query_pois(center_longitude, center_latitude, radius):
+        position = poi_position(poi)
+        # POIs without a position can't be placed in a tile, so they are kept with every tile they show up in
+        if position is None or (south <= position[0] < north and west <= position[1] < east):
+            pois.append(poi)
+    return pois
+
+
+def distance(latitude_1, longitude_1, latitude_2, longitude_2):
+    # haversine distance in meters
+    phi_1 = math.radians(latitude_1)
+    phi_2 = math.radians(latitude_2)
+    delta_phi = math.radians(latitude_2 - latitude_1)
+    delta_lambda = math.radians(longitude_2 - longitude_1)
+    a = math.sin(delta_phi / 2) ** 2 + math.cos(phi_1) * math.cos(phi_2) * math.sin(delta_lambda / 2) ** 2
+    return 2 * earth_radius * math.asin(math.sqrt(a))
+
+
+def radius_to_bounding_box(longitude, latitude, radius):
+    # (min long, min lat, max long, max lat) of the box that holds the circle of radius meters around the point
+    radius_latitude = radius / 111320
+    radius_longitude = radius / (111320 * max(0.01, math.cos(math.radians(latitude))))
+    return (longitude - radius_longitude, latitude - radius_latitude,
+            longitude + radius_longitude, latitude + radius_latitude)
+
+
+def within_radius(poi, longitude, latitude, radius):
+    # POIs without a position can't be placed, so they are kept
+    position = poi_position(poi)
+    return position is None or distance(latitude, longitude, position[0], position[1]) <= radius
+
+
+def poi_position(poi):
+    # (lat, long) of a POI, either a compact OSM tuple or a compact API payload, or None if it has none
+    if isinstance(poi, tuple):
+        latitude, longitude = poi[2], poi[3]
+    else:
+        latitude, longitude = poi.get("latitude"), poi.get("longitude")
+    if latitude is None or longitude is None:
+        return None
+    return latitude, longitude
+
+
+def poi_key(poi):
+    # identifies a POI across tiles, so overlapping tiles don't count it twice
+    if isinstance(poi, tuple):
+        return poi[1], poi[0]
+    if poi.get("id") is not None:
+        return poi["id"]
+    return poi.get("name"), poi.get("latitude"), poi.get("longitude")
+
+
+class TileCache:
+    # Spatial cache for predict lookups. The world is split into square tiles (in degrees) at zoom levels that halve
+    # the tile size each time, and each data source's POIs are cached per tile for ttl seconds. The zoom is picked
+    # from the lookup radius, so that the query that fetches a tile, a circle through the tile's corners, is no
+    # larger than the lookup, and never over the data source's own radius limit. A missing tile is fetched once and
+    # only the POIs inside the tile are kept. A lookup then merges the tiles it covers, drops duplicates and keeps
+    # the POIs within the radius, the same area an uncached lookup returns, so repeated and nearby lookups are
+    # answered without any API call. Only successful fetches are cached, a failing data source raises to the caller
+    # and its tiles are fetched again on the next lookup. A lookup whose tiles aren't cached costs one query per tile,
+    # usually 9 to 16, so the single point scripts only use the cache when asked to.
+    def __init__(self, path='caches/tile_cache.sqlite', ttl=86400):
+        self.ttl = ttl
+        self.tiles = CacheStore(path)
+        self.hits = 0
+        self.misses = 0
+
+    def query(self, provider, query_pois, longitude, latitude, radius, max_radius=None):
+        # query_pois(longitude, latitude, radius) fetches the compact POIs of provider around a point, raising if
+        # the data source fails. max_radius is the largest radius the data source accepts, None for no limit.
+        zoom = self.zoom_for_query(latitude, radius, max_radius)
+        tile_keys = self.covering_tiles(longitude, latitude, radius, zoom)
+        tiles = self.fetch(provider, query_pois, tile_keys)
+        merged = {}
+        for tile_key in tile_keys:
+            for poi in tiles[tile_key]:
+                if within_radius(poi, longitude, latitude, radius):
+                    merged.setdefault(poi_key(poi), poi)
+        return list(merged.values())
+
+    def fetch(self, provider, query_pois, tile_keys):
+        # {tile key: POIs in the tile}, from the cache when the tile hasn't expired, fetched concurrently otherwise
+        tiles = {}
+        missing = []
+        now = time.time()
+        for tile_key in tile_keys:
+            entry = self.tiles.entry((provider, tile_key))
+            if entry is not None and entry[1] is not None and now - entry[1] < self.ttl:
+                tiles[tile_key] = entry[0]
+            else:
+                missing.append(tile_key)
+        self.hits += len(tiles)
+        self.misses += len(missing)
+        if len(missing) > 0:
+            error = None
+            with ThreadPoolExecutor(max_workers=min(len(missing), tile_fetch_workers)) as executor:
+                # the tiles are fetched under the caller's deadline, if it has one
+                deadline = current_deadline()
+                futures = {tile_key: executor.submit(run_with_deadline, deadline, fetch_tile, query_pois, tile_key)
+                           for tile_key in missing}
+                for tile_key, future in futures.items():
+                    try:
+                        pois = future.result()
+                    except Exception as e:
+                        error = error or e
+                        continue
+                    self.tiles[(provider, tile_key)] = pois
+                    tiles[tile_key] = pois
+            if error is not None:
+                raise error
+        return tiles
+
+    def zoom_for_query(self, latitude, radius, max_radius=None):
+        # tiles are sized for the latitude of the query closest to the equator, where they are widest
+        widest_latitude = max(0.0, abs(latitude) - radius / 111320)
+        return zoom_for_radius(widest_latitude, min(radius, max_radius) if max_radius else radius)
+
+    def covering_tiles(self, longitude, latitude, radius, zoom):
+        # every tile that overlaps the bounding box of the query circle, as "zoom/row/column" keys
+        min_long, min_lat, max_long, max_lat = radius_to_bounding_box(longitude, latitude, radius)
+        return bbox_tiles(min_lat, min_long, max_lat, max_long, zoom)
@@ -1,25 +1,38 @@
 
 
-import requests
-import json
-import os.path
-import pickle
-from ratelimiter import RateLimiter
+from http_transport import shared_transport
+from api_enrichment import fill_in_api_column
+from single_flight import shared_single_flight, query_key
 from prediction import Prediction
 from dataset import Dataset
-from decor_to_tag_mapping import yelp_decors_to_tags
+from provider_payloads import compact_yelp
+from cache_store import CacheStore
+from decor_to_tag_mapping import yelp_tags_to_decors, first_tag_matches
 
 class YelpTool:
+    # largest radius a business search accepts, in meters:
+    # https://docs.developer.yelp.com/reference/v3_business_search
+    max_radius = 40000
+
     def __init__(self, api_key):
         self.api_key = api_key
-        self.cache = 'caches/yelp_cache.pickle'
-        self.dict = {}
+        self.cache = 'caches/yelp_cache.sqlite'
+        self.dict = CacheStore(self.cache, legacy_pickle='caches/yelp_cache.pickle')
+        self.transport = shared_transport("yelp")
+        self.single_flight = shared_single_flight("yelp")
 
     def predict_row(self, yelp_data, seedling_date, burger_shop_start_date):
         return self.__predict(yelp_data, seedling_date, burger_shop_start_date)
 
     def predict(self, longitude, latitude, radius, seedling_date, burger_shop_start_date, debug_mode=False):
         result = self.__query(longitude=longitude, latitude=latitude, radius=radius)
+        return self.predict_pois(result, seedling_date, burger_shop_start_date, debug_mode)
+
+    def query_pois(self, longitude, latitude, radius):
+        # every business around the point as a compact payload, which is what the tile cache stores
+        return [compact_yelp(x) for x in self.__query(longitude=longitude, latitude=latitude, radius=radius)]
+
+    def predict_pois(self, result, seedling_date, burger_shop_start_date, debug_mode=False):
         if debug_mode:
             print(f"DEBUG: {result}")
 
@@ -34,67 +47,39 @@ class YelpTool:
     def __predict(self, yelp_data, seedling_date, burger_shop_start_date):
         decors = []
         if "categories" in yelp_data:
-            categories = yelp_data["categories"]
-            for decor_type, tag_list in yelp_decors_to_tags.items():
-                result = self.find_match(tag_list, categories)
-                if result is not None:
-                    decors.append(Prediction(decor_type, Dataset.yelp, result))
+            aliases = [category["alias"] for category in yelp_data["categories"] if "alias" in category]
+            for decor_type, tag in first_tag_matches(yelp_tags_to_decors, aliases):
+                decors.append(Prediction(decor_type, Dataset.yelp, tag))
         return decors
 
-    def find_match(self, list, yelp_categories):
-        for tag in list:
-            for category in yelp_categories:
-                if "alias" in category:
-                    if category["alias"] == tag:
-                        return tag
-        return None
-
-    def fill_in_data(self, data, location_tool, debug_mode=False):
-        # initialize a dict to cache gps coords for locations
-        if os.path.exists(self.cache):
-            with open(self.cache, 'rb') as handle:
-                # print(f"Loading yelp data from disk")
-                self.dict = pickle.load(handle)
-        else:
-            print(f"No cache found, creating new yelp dictionary (This may take a while)...")
-            self.dict = {}
-
-        for index, row in data.iterrows():
-            row_key = self.__create_row_key(row)
-            if row_key not in self.dict:
-                # get GPS location of row
-                location = location_tool.lookup_location(row)
+    def fill_in_data(self, data, location_tool, debug_mode=False, revalidation=None):
+        return fill_in_api_column(data, "yelp", self.dict, self.__create_row_key,
+                                  lambda row_key, row: self.__fill_in_row(row_key, row, location_tool, debug_mode),
+                                  self.transport, "Yelp Data", compact_yelp, revalidation)
 
-                if location:
-                    if debug_mode:
-                        print(f"running {row['Location']} through yelp.")
+    def __fill_in_row(self, row_key, row, location_tool, debug_mode):
+        # get GPS location of row
+        location = location_tool.lookup_location(row)
 
-                    data_yelp = self.__query_location(location, self.__clean_decor_title(row["Location"]))
-                else:
-                    data_yelp = None
+        if location:
+            if debug_mode:
+                print(f"running {row['Location']} through yelp.")
 
-                if debug_mode and data_yelp is not None:
-                    print(f"{data_yelp}")
-
-                self.dict[row_key] = data_yelp
-            else:
-                # it exists, load from cache
-                data_yelp = self.dict[row_key]
-
-            if data_yelp:
-                # print(f"found yelp match for {row_key}")
-                data.loc[index, "Yelp Data"] = json.dumps(data_yelp)
-            else:
-                # print(f"NO MATCH found yelp match for {row_key}")
-                data.loc[index, "Yelp Data"] = None
+            data_yelp = self.__query_location(location, self.__clean_decor_title(row["Location"]))
+        else:
+            data_yelp = None
 
-        with open(self.cache, 'wb') as handle:
-            pickle.dump(self.dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        if debug_mode and data_yelp is not None:
+            print(f"{data_yelp}")
 
-        return data
+        self.dict[row_key] = data_yelp
 
-    @RateLimiter(max_calls=10, period=1)
     def __query(self, latitude, longitude, radius):
+        # identical queries that are in flight at the same time share one request
+        return self.single_flight.do(query_key("query", latitude, longitude, radius),
+                                     lambda: self.__query_upstream(latitude, longitude, radius))
+
+    def __query_upstream(self, latitude, longitude, radius):
         url = f"https://api.yelp.com/v3/businesses/search"
         payload = {
             "latitude": f"{latitude}",
@@ -104,12 +89,13 @@ class YelpTool:
         headers = {
             "Authorization": f"Bearer {self.api_key}"
         }
-        response = requests.request("GET", url, headers=headers, params=payload).json()
+        response = self.transport.request("GET", url, headers=headers, params=payload).json()
         if "businesses" in response:
             return response["businesses"]
-        return None
+        # an error, IE an invalid key, radius or an exceeded quota. Raised rather than treated as no results, so it
+        # isn't cached.
+        raise Exception(f"Yelp query failed: {response.get('error', response)}")
 
-    @RateLimiter(max_calls=10, period=1)
     def __query_location(self, location_osm, location_name):
         # Note that yelp doesn't support bounding boxes, so we instead convert the location
         # into a gps with a radius: https://www.yelp.com/developers/documentation/v3/business_search
@@ -127,13 +113,16 @@ class YelpTool:
         headers = {
             "Authorization" : f"Bearer {self.api_key}"
         }
-        response = requests.request("GET", url, headers=headers, params=payload).json()
-
-        if "businesses" in response:
-            for result in response["businesses"]:
-                if "name" in result:
-                    if location_name in result["name"]:
-                        return result
+        response = self.transport.request("GET", url, headers=headers, params=payload).json()
+
+        if "businesses" not in response:
+            # an error, IE an invalid key or an exceeded quota. Raised rather than treated as no match, so it isn't
+            # cached.
+            raise Exception(f"Yelp query failed: {response.get('error', response)}")
+        for result in response["businesses"]:
+            if "name" in result:
+                if location_name in result["name"]:
+                    return result
         return None
 
     def __clean_decor_title(self, title):